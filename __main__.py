@@ -0,0 +1,10 @@
+"""python -m energyservice, see cli.py"""
+import sys
+from pathlib import Path
+
+## modules of the service import each other by name
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from cli import main
+
+sys.exit(main())
@@ -0,0 +1,156 @@
+import pyarrow as pa # 3.0.0
+import pyarrow.parquet as pq
+import numpy as np # 1.19.5
+
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from reader import EnergyReader
+
+
+
+BATCH_SIZE = 100000 # rows held in memory before being written
+COMPRESSION = 'zstd'
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+POWER_SCHEMA = pa.schema([('time', pa.int64()), ('target', pa.string()),
+                          ('sensor', pa.string()), ('socket', pa.string()),
+                          ('scope', pa.string()), ('power', pa.float64())])
+HWPC_SCHEMA = pa.schema([('time', pa.int64()), ('sensor', pa.string()),
+                         ('target', pa.string()), ('group', pa.string()),
+                         ('socket', pa.string()), ('cpu', pa.string()),
+                         ('event', pa.string()), ('value', pa.int64())])
+
+
+
+class _BatchWriter:
+    """Write rows in a parquet file, one row group per batch, so only
+    a batch is held in memory."""
+    def __init__(self, path: Path, schema: pa.Schema):
+        self.schema = schema
+        self.writer = pq.ParquetWriter(str(path), schema, compression=COMPRESSION)
+        self.columns: Dict[str, List] = {name: [] for name in schema.names}
+        self.rows = 0
+
+    def extend(self, **columns):
+        for name, values in columns.items():
+            self.columns[name].extend(values)
+        if len(self.columns['time']) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        size = len(self.columns['time'])
+        if size:
+            self.writer.write_table(pa.table(self.columns, schema=self.schema))
+            self.rows += size
+            self.columns = {name: [] for name in self.schema.names}
+
+    def close(self) -> int:
+        self.flush()
+        self.writer.close()
+        return self.rows
+
+
+
+def export_influxdb(reader: EnergyReader, database: str, path: Path) -> int:
+    """Stream the power reports of a database into a parquet file.
+    Args:
+        reader: the reader of the InfluxDBs of the stack
+        database: the name of the database, e.g. power_<cpu_shortname>
+        path: the output file
+    Returns:
+        The number of exported points.
+    """
+    writer = _BatchWriter(path, POWER_SCHEMA)
+    for tags, timestamps, power in reader.iter_power(
+            database, tags=('target', 'sensor', 'socket', 'scope')):
+        size = len(timestamps)
+        writer.extend(time=timestamps.tolist(), power=power.tolist(),
+                      **{tag: [tags.get(tag)] * size
+                         for tag in ('target', 'sensor', 'socket', 'scope')})
+    return writer.close()
+
+
+
+def _from_extended_json(value):
+    """Get the python value of a mongoexport (extended json) value."""
+    if isinstance(value, dict):
+        if '$numberLong' in value:
+            return int(value['$numberLong'])
+        if '$date' in value:
+            date = _from_extended_json(value['$date'])
+            if isinstance(date, int): # milliseconds since epoch
+                return date * 1000000
+            date = datetime.fromisoformat(date.replace('Z', '+00:00'))
+            return (date - EPOCH) // timedelta(microseconds=1) * 1000
+    return value
+
+def export_hwpc(source: Path, path: Path) -> int:
+    """Convert the gzipped output of mongoexport of a collection of
+    HWPC reports into a parquet file, one row per event value.
+    Args:
+        source: the gzipped json lines exported from MongoDB
+        path: the output file
+    Returns:
+        The number of exported rows.
+    """
+    writer = _BatchWriter(path, HWPC_SCHEMA)
+    with gzip.open(source, 'rt') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            report = json.loads(line)
+            rows = [(group, socket, cpu, event, _from_extended_json(value))
+                    for group, sockets in report.get('groups', {}).items()
+                    for socket, cpus in sockets.items()
+                    for cpu, events in cpus.items()
+                    for event, value in events.items()]
+            if not rows:
+                continue
+            groups, sockets, cpus, events, values = zip(*rows)
+            writer.extend(time=[_from_extended_json(report['timestamp'])] * len(rows),
+                          sensor=[report.get('sensor')] * len(rows),
+                          target=[report.get('target')] * len(rows),
+                          group=groups, socket=sockets, cpu=cpus, event=events,
+                          value=values)
+    return writer.close()
+
+
+
+def iter_backup(path: Path, columns: Optional[List[str]] = None) -> Iterator[Dict[str, np.ndarray]]:
+    """Load an exported file row group by row group.
+    Args:
+        path: the parquet file
+        columns: the columns to load, all if None
+    Returns:
+        An iterator over dictionaries column -> numpy array.
+    """
+    parquet = pq.ParquetFile(str(path))
+    for index in range(parquet.num_row_groups):
+        table = parquet.read_row_group(index, columns=columns)
+        yield {name: table.column(name).to_numpy() for name in table.column_names}
+
+def load_power(path: Path) -> Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]]:
+    """Load an exported database of power reports for offline analysis.
+    Args:
+        path: the parquet file
+    Returns:
+        A dictionary (sensor, target) -> (timestamps in ns, power in
+        watts), the same as :py:meth:`EnergyReader.read_power`.
+    """
+    table = pq.read_table(str(path), columns=['time', 'sensor', 'target', 'power'])
+    times = table.column('time').to_numpy()
+    sensors = table.column('sensor').to_numpy(zero_copy_only=False)
+    targets = table.column('target').to_numpy(zero_copy_only=False)
+    power = table.column('power').to_numpy()
+    order = np.lexsort((times, targets, sensors))
+    times, sensors, targets, power = times[order], sensors[order], targets[order], power[order]
+    ## a series starts where its sensor or target changes
+    changes = np.flatnonzero((sensors[1:] != sensors[:-1]) | (targets[1:] != targets[:-1])) + 1
+    starts = np.concatenate(([0], changes)) if len(times) else changes
+    ends = np.append(starts[1:], len(times))
+    return {(sensors[start], targets[start]): (times[start:end], power[start:end])
+            for start, end in zip(starts.tolist(), ends.tolist())}
@@ -0,0 +1,376 @@
+"""Offline benchmark of Energy.deploy() and Energy.destroy(): plays and
+commands are recorded by a stand-in of enoslib instead of being run, and
+last a configurable latency. It reports how the number of plays, tasks,
+and the simulated wall time grow with the number of sensored hosts and
+CPU models, without reserving any machine.
+
+    python benchmark.py --hosts 10 100 1000 --models 1 4 16
+
+With --stream, it measures instead the latency and throughput of
+Energy.stream_power() against local fake InfluxDBs, which answer with
+reports of targets written at a given rate.
+
+    python benchmark.py --stream --models 1 4 16 --targets 100 --rate 2
+"""
+import argparse
+import asyncio
+import json
+import math
+import re
+import tempfile
+import threading
+import time
+import urllib.parse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+from unittest import mock
+
+import numpy as np # 1.19.5
+
+from enoslib.types import Host
+
+import energy
+from energy import Energy
+from cache import CPUCache
+from reader import EnergyReader, POWER_MEASUREMENT
+from stream import PowerStream, POLL_INTERVAL, DELAY
+
+import logging
+
+
+
+TASK_LATENCY = 0.5 # seconds of a task on a batch of forks hosts
+PLAY_LATENCY = 2. # seconds to start a play (ssh connections, facts…)
+COMMAND_LATENCY = 1. # seconds of an ad hoc command (run_command)
+FORKS = 100 # hosts that ansible handles at once (enoslib's default)
+SPEEDUP = 100. # simulated seconds per real second slept
+
+
+
+def get_hosts(count: int, prefix: str = 'node') -> List[Host]:
+    """Generate synthetic hosts, e.g. node-0.bench with address 10.0.0.0"""
+    return [Host(f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}',
+                 alias=f'{prefix}-{index}.bench')
+            for index in range(count)]
+
+def get_lscpu(model: int) -> str:
+    """Generate the plain text output of lscpu of a CPU model."""
+    return '\n'.join([
+        'Architecture:        x86_64',
+        'CPU(s):              32',
+        'Socket(s):           2',
+        f'Model name:          Intel(R) Xeon(R) CPU E5-{2600 + model} 0 @ 2.{model % 10}0GHz',
+        'CPU MHz:             2200.000',
+        'CPU max MHz:         3000.0000',
+        'CPU min MHz:         1200.0000'])
+
+
+
+class _RecordingPlay:
+    """Stand-in of play_on: each module call is recorded as a task, and
+    the play lasts its simulated latency when the context exits."""
+    def __init__(self, recorder: 'Recorder', pattern_hosts: str):
+        self.recorder = recorder
+        self.pattern_hosts = pattern_hosts
+        self.tasks: List[str] = []
+
+    def __enter__(self):
+        return self
+
+    def __getattr__(self, module: str):
+        def task(*args, **kwargs):
+            self.tasks.append(module)
+        return task
+
+    def __exit__(self, *args):
+        self.recorder.add_play(self.pattern_hosts, self.tasks)
+
+
+
+class Recorder:
+    """Record the plays and commands of a deployment instead of running
+    them, replacing play_on and run_command in the energy module."""
+    def __init__(self, roles: Dict[str, List[Host]], hostname_to_lscpu: Dict[str, str], *,
+                 task_latency: float = TASK_LATENCY, play_latency: float = PLAY_LATENCY,
+                 command_latency: float = COMMAND_LATENCY, forks: int = FORKS,
+                 speedup: float = SPEEDUP):
+        """Args:
+            roles: the roles of the deployment
+            hostname_to_lscpu: the output of lscpu of each sensored host
+            task_latency: seconds of a task on a batch of forks hosts
+            play_latency: seconds to start a play
+            command_latency: seconds of an ad hoc command
+            forks: the number of hosts that ansible handles at once
+            speedup: simulated seconds per real second slept, 0 to not sleep"""
+        self.roles = roles
+        self.hostname_to_lscpu = hostname_to_lscpu
+        self.task_latency = task_latency
+        self.play_latency = play_latency
+        self.command_latency = command_latency
+        self.forks = forks
+        self.speedup = speedup
+        self.plays: List[Dict] = []
+        self.commands: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def _get_hosts(self, pattern_hosts: str) -> List[str]:
+        """Get the inventory hostnames matched by a pattern of roles or
+        hostnames separated by colons."""
+        hostnames = set()
+        for pattern in pattern_hosts.split(':'):
+            if pattern == 'all':
+                hostnames.update(host.alias for hosts in self.roles.values() for host in hosts)
+            elif pattern in self.roles:
+                hostnames.update(host.alias for host in self.roles[pattern])
+            elif pattern:
+                hostnames.add(pattern)
+        return sorted(hostnames)
+
+    def _wait(self, seconds: float):
+        if self.speedup > 0:
+            time.sleep(seconds / self.speedup)
+
+    def add_play(self, pattern_hosts: str, tasks: List[str]):
+        hosts = self._get_hosts(pattern_hosts)
+        batches = max(1, math.ceil(len(hosts) / self.forks))
+        latency = self.play_latency + len(tasks) * batches * self.task_latency
+        with self._lock:
+            self.plays.append({'pattern': pattern_hosts, 'hosts': len(hosts),
+                               'tasks': list(tasks), 'latency': latency})
+        self._wait(latency)
+
+    def play_on(self, *, pattern_hosts: str = 'all', **kwargs) -> _RecordingPlay:
+        return _RecordingPlay(self, pattern_hosts)
+
+    def run_command(self, command: str, pattern_hosts: str = 'all', **kwargs) -> Dict:
+        hosts = self._get_hosts(pattern_hosts)
+        latency = self.command_latency * max(1, math.ceil(len(hosts) / self.forks))
+        with self._lock:
+            self.commands.append({'command': command, 'hosts': len(hosts), 'latency': latency})
+        self._wait(latency)
+        if 'lscpu' in command:
+            outputs = {hostname: self.hostname_to_lscpu[hostname] for hostname in hosts}
+        elif 'df -Pk' in command or 'MemAvailable' in command:
+            outputs = {hostname: str(1 << 40) for hostname in hosts} # kB
+        else: ## e.g. docker ps: nothing is running
+            outputs = {hostname: '' for hostname in hosts}
+        return {'ok': {hostname: {'stdout': stdout, 'stderr': ''}
+                       for hostname, stdout in outputs.items()},
+                'failed': {}}
+
+    @contextmanager
+    def patch(self):
+        """Replace play_on and run_command of the energy module."""
+        with mock.patch.object(energy, 'play_on', self.play_on), \
+             mock.patch.object(energy, 'run_command', self.run_command):
+            yield self
+
+
+
+def get_roles(hosts: int, collectors: int) -> Dict[str, List[Host]]:
+    control = get_hosts(collectors, prefix='control')
+    return {'sensors': get_hosts(hosts), 'mongos': control, 'formulas': control,
+            'influxdbs': control, 'grafana': control[:1]}
+
+def run(scenario: str, hosts: int, models: int, *, collectors: int = 1,
+        cpu_cache: Optional[CPUCache] = None, **latencies) -> Dict:
+    """Run a scenario (deploy, reconcile, destroy) against the recorder.
+    Args:
+        scenario: deploy (from scratch), reconcile (deploy with reconcile),
+            or destroy
+        hosts: the number of sensored hosts
+        models: the number of CPU models among sensored hosts
+        collectors: the number of hosts of mongos, formulas, and influxdbs
+        cpu_cache: the cache of cpus, a new empty one if None
+        latencies: the options of :py:class:`Recorder`
+    Returns:
+        A dictionary of measures.
+    """
+    roles = get_roles(hosts, collectors)
+    hostname_to_lscpu = {host.alias: get_lscpu(index % models)
+                         for index, host in enumerate(roles['sensors'])}
+    recorder = Recorder(roles, hostname_to_lscpu, **latencies)
+    with tempfile.TemporaryDirectory() as directory, recorder.patch():
+        service = Energy(sensors=roles['sensors'], mongos=roles['mongos'],
+                         formulas=roles['formulas'], influxdbs=roles['influxdbs'],
+                         grafana=roles['grafana'][0],
+                         cpu_cache=cpu_cache or CPUCache(directory),
+                         grafana_cache=str(Path(directory) / 'grafana'), state_path=None)
+        start = time.monotonic()
+        if scenario == 'destroy':
+            service.destroy()
+        else:
+            service.deploy(reconcile=scenario == 'reconcile')
+        elapsed = time.monotonic() - start
+
+    tasks = [len(play['tasks']) for play in recorder.plays]
+    return {'scenario': scenario, 'hosts': hosts, 'models': models,
+            'plays': len(recorder.plays), 'tasks': sum(tasks),
+            'tasks_per_play': sum(tasks) / max(1, len(tasks)),
+            'commands': len(recorder.commands), 'elapsed': elapsed,
+            'sequential': (sum(play['latency'] for play in recorder.plays) +
+                           sum(command['latency'] for command in recorder.commands))}
+
+def measure(scenario: str, hosts: int, models: int, *, speedup: float = SPEEDUP,
+            warm: bool = False, **options) -> Dict:
+    """Measure a scenario. The simulated wall time is the elapsed time
+    with latencies, where sleeping is sped up, minus the planning time
+    measured by a run without latencies, which must not be sped up.
+    Args:
+        warm: cpus are already in the cache, as in a redeployment"""
+    with tempfile.TemporaryDirectory() as directory:
+        cpu_cache = CPUCache(directory) if warm else None
+        if warm: ## fill the cache
+            run('deploy', hosts, models, cpu_cache=cpu_cache, speedup=0, **options)
+        overhead = run(scenario, hosts, models, cpu_cache=cpu_cache, speedup=0, **options)
+        result = run(scenario, hosts, models, cpu_cache=cpu_cache, speedup=speedup, **options)
+    planning = overhead['elapsed']
+    result['planning'] = planning
+    result['simulated'] = planning + max(0., result['elapsed'] - planning) * speedup
+    return result
+
+class FakeInfluxDB:
+    """Local stand-in of the InfluxDBs of a stack: each database holds
+    the reports of targets written every 1/rate seconds, up to now.
+    Queries must bound time, as those of :py:class:`PowerStream`."""
+    TIME = re.compile(r'time > (\d+) AND time <= (\d+)')
+
+    def __init__(self, targets: int, rate: float):
+        self.targets = [f'target-{index}' for index in range(targets)]
+        self.period = int(1e9 / rate) # ns
+        self.queries = 0
+        fake = self
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+            def do_GET(self):
+                fake.queries += 1
+                params = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+                body = json.dumps({'results': [fake.answer(params['q'][0])]}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def answer(self, query: str) -> Dict:
+        start, end = map(int, self.TIME.search(query).groups())
+        end = min(end, time.time_ns())
+        first = start // self.period + 1
+        timestamps = (np.arange(first, end // self.period + 1) * self.period).tolist()
+        if not timestamps:
+            return {'statement_id': 0}
+        return {'statement_id': 0, 'series': [
+            {'name': POWER_MEASUREMENT, 'tags': {'target': target, 'sensor': 'sensor-0'},
+             'columns': ['time', 'power'], 'values': [[timestamp, 10.] for timestamp in timestamps]}
+            for target in self.targets]}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def measure_stream(databases: int, targets: int, *, rate: float = 1., duration: float = 10.,
+                   interval: float = POLL_INTERVAL, delay: float = DELAY) -> Dict:
+    """Follow the reports of fake databases during duration seconds.
+    Args:
+        databases: the number of databases, i.e. of CPU models
+        targets: the number of targets per database
+        rate: the number of reports per second of each target
+        duration: the number of seconds during which reports are followed
+        interval: number of seconds between two polls of a database
+        delay: number of seconds before now at which each poll stops
+    Returns:
+        A dictionary of measures, latencies being the time between the
+        timestamp of reports and their reception, in seconds."""
+    fakes = [FakeInfluxDB(targets, rate) for _ in range(databases)]
+    reader = EnergyReader(SimpleNamespace(hostname_to_formulas={}))
+    reader.databases = {f'power_{index}': fake.url for index, fake in enumerate(fakes)}
+    stream = PowerStream(reader, interval=interval, delay=delay)
+    latencies, batches = [], 0
+
+    async def follow():
+        nonlocal batches
+        end = time.time() + duration
+        async for batch in stream:
+            received = time.time_ns()
+            batches += 1
+            for timestamps, _ in batch.values():
+                latencies.append((received - timestamps) / 1e9)
+            if time.time() >= end:
+                break
+
+    start = time.time()
+    try:
+        asyncio.run(follow())
+    finally:
+        for fake in fakes:
+            fake.close()
+    elapsed = time.time() - start
+    latencies = np.concatenate(latencies) if latencies else np.zeros(1)
+    return {'databases': databases, 'targets': targets, 'rate': rate,
+            'batches': batches, 'points': stream.points,
+            'points_per_s': stream.points / elapsed,
+            'queries': sum(fake.queries for fake in fakes),
+            'latency_mean': float(latencies.mean()),
+            'latency_p99': float(np.percentile(latencies, 99))}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hosts', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--models', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--collectors', type=int, default=1)
+    parser.add_argument('--scenarios', nargs='+', default=['deploy', 'reconcile', 'destroy'])
+    parser.add_argument('--warm', action='store_true', help='cpus are already cached')
+    parser.add_argument('--task-latency', type=float, default=TASK_LATENCY)
+    parser.add_argument('--play-latency', type=float, default=PLAY_LATENCY)
+    parser.add_argument('--command-latency', type=float, default=COMMAND_LATENCY)
+    parser.add_argument('--forks', type=int, default=FORKS)
+    parser.add_argument('--speedup', type=float, default=SPEEDUP)
+    parser.add_argument('--stream', action='store_true', help='benchmark stream_power instead')
+    parser.add_argument('--targets', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--rate', type=float, default=1., help='reports per second of a target')
+    parser.add_argument('--duration', type=float, default=10.)
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL)
+    parser.add_argument('--delay', type=float, default=DELAY)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.stream:
+        columns = ['databases', 'targets', 'batches', 'points', 'points_per_s',
+                   'queries', 'latency_mean', 'latency_p99']
+        print(' '.join(f'{column:>14}' for column in columns))
+        for databases in args.models:
+            for targets in args.targets:
+                result = measure_stream(databases, targets, rate=args.rate,
+                                        duration=args.duration,
+                                        interval=args.interval, delay=args.delay)
+                print(' '.join(f'{result[column]:>14.2f}' if isinstance(result[column], float)
+                               else f'{result[column]:>14}' for column in columns))
+        return
+
+    columns = ['scenario', 'hosts', 'models', 'plays', 'tasks', 'tasks_per_play',
+               'commands', 'planning', 'sequential', 'simulated']
+    print(' '.join(f'{column:>14}' for column in columns))
+    for scenario in args.scenarios:
+        for hosts in args.hosts:
+            for models in args.models:
+                if models > hosts:
+                    continue
+                result = measure(scenario, hosts, models, speedup=args.speedup,
+                                 warm=args.warm, collectors=args.collectors,
+                                 task_latency=args.task_latency,
+                                 play_latency=args.play_latency,
+                                 command_latency=args.command_latency,
+                                 forks=args.forks)
+                print(' '.join(f'{result[column]:>14.2f}' if isinstance(result[column], float)
+                               else f'{result[column]:>14}' for column in columns))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+from cpu import CPU
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+
+
+CPU_CACHE_PATH = './_tmp_enos_/cpu_cache'
+CPU_CACHE_TTL = 7 * 24 * 3600 # seconds, hardware rarely changes
+## fields of lscpu that change between runs on identical nodes
+VOLATILE_FIELDS = ('CPU MHz', 'CPU(s) scaling MHz', 'BogoMIPS')
+
+
+
+class CPUCache:
+    """On-disk cache of the lscpu output of hosts, shared between
+    processes. Entries are keyed by hostname and point to lscpu
+    contents stored by the hash of their stable fields, so identical
+    nodes share a single parsed :py:class:`CPU`."""
+    def __init__(self, path: str = CPU_CACHE_PATH, ttl: float = CPU_CACHE_TTL):
+        """Args:
+            path: the directory holding the cache
+            ttl: number of seconds after which an entry is stale and the
+                host must be probed again"""
+        self.path = Path(path)
+        self.ttl = ttl
+        self._index_path = self.path / 'index.json'
+        self._lock_path = self.path / '.lock'
+        self._lscpus_path = self.path / 'lscpus'
+        self._digest_to_cpu: Dict[str, CPU] = {}
+        self._lscpus_path.mkdir(parents=True, exist_ok=True)
+
+    @contextmanager
+    def _locked(self):
+        """Hold an exclusive lock on the cache across processes."""
+        with self._lock_path.open('a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _read_index(self) -> Dict[str, Dict]:
+        if not self._index_path.exists():
+            return {}
+        with self._index_path.open('r') as f:
+            return json.load(f)
+
+    def _write_index(self, index: Dict[str, Dict]):
+        """Atomically replace the index so readers never see a partial
+        file."""
+        _write_atomically(self._index_path, json.dumps(index))
+
+    def _get_cpu(self, digest: str) -> CPU:
+        """Parse the lscpu content of this digest once per process, from
+        the disk for cold lookups."""
+        if digest not in self._digest_to_cpu:
+            cpu = CPU(self._lscpus_path / digest)
+            cpu.get_cpu()
+            self._digest_to_cpu[digest] = cpu.intern()
+        return self._digest_to_cpu[digest]
+
+    def lookup(self, hostnames: Iterable[str]) -> Dict[str, CPU]:
+        """Get the CPU of hosts that have a fresh entry in the cache.
+        Args:
+            hostnames: the inventory hostnames to look for.
+        Returns:
+            A dictionary hostname -> CPU; missing or stale hosts are absent.
+        """
+        with self._locked():
+            index = self._read_index()
+        now = time.time()
+        hostname_to_cpu = {}
+        for hostname in hostnames:
+            entry = index.get(hostname)
+            if (entry is None or now - entry['time'] > self.ttl or
+                not (self._lscpus_path / entry['digest']).exists()):
+                continue
+            hostname_to_cpu[hostname] = self._get_cpu(entry['digest'])
+        return hostname_to_cpu
+
+    def put(self, hostname_to_lscpu: Dict[str, str]) -> Dict[str, CPU]:
+        """Store the lscpu output of hosts.
+        Args:
+            hostname_to_lscpu: dictionary hostname -> content of lscpu.
+        Returns:
+            A dictionary hostname -> CPU of the stored hosts.
+        """
+        now = time.time()
+        hostname_to_digest = {}
+        for hostname, lscpu in hostname_to_lscpu.items():
+            digest = get_digest(lscpu)
+            ## parsed from memory, the file only persists it
+            if digest not in self._digest_to_cpu:
+                self._digest_to_cpu[digest] = CPU.from_text(lscpu)
+            path = self._lscpus_path / digest
+            if not path.exists():
+                _write_atomically(path, lscpu)
+            hostname_to_digest[hostname] = digest
+
+        with self._locked():
+            index = self._read_index()
+            index.update({hostname: {'digest': digest, 'time': now}
+                          for hostname, digest in hostname_to_digest.items()})
+            self._write_index(index)
+
+        return {hostname: self._get_cpu(digest)
+                for hostname, digest in hostname_to_digest.items()}
+
+    def invalidate(self, hostnames: Optional[Iterable[str]] = None):
+        """Remove entries so the next lookup probes these hosts again.
+        Args:
+            hostnames: the hosts to forget, all of them if None.
+        """
+        with self._locked():
+            index = self._read_index()
+            if hostnames is None:
+                index = {}
+            else:
+                for hostname in hostnames:
+                    index.pop(hostname, None)
+            self._write_index(index)
+
+    def stale(self, hostnames: Iterable[str]) -> List[str]:
+        """Get the hosts that must be probed again.
+        Args:
+            hostnames: the inventory hostnames to check.
+        Returns:
+            The list of hostnames that are missing or stale.
+        """
+        hostnames = list(hostnames)
+        fresh = self.lookup(hostnames)
+        return [hostname for hostname in hostnames if hostname not in fresh]
+
+
+
+def get_digest(lscpu: str) -> str:
+    """Get the digest of the output of lscpu, without its volatile
+    fields (e.g. the current frequency), so identical nodes share it."""
+    fields = {field: value for field, value in CPU.parse_lscpu(lscpu).items()
+              if field not in VOLATILE_FIELDS}
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+def _write_atomically(path: Path, text: str):
+    """Replace a file so readers never see a partial one. Each writer,
+    e.g. concurrent deployments in threads, has its own temporary file."""
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
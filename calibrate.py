@@ -1,41 +1,79 @@
-from enoslib.api import play_on, discover_networks
+from enoslib.api import discover_networks, run_command
 from enoslib.infra.enos_g5k.provider import G5k
 from enoslib.infra.enos_g5k.g5k_api_utils import get_all_clusters_sites
 from enoslib.infra.enos_g5k.configuration import (Configuration,
                                                   NetworkConfiguration)
 
 from energy import Energy
+from sensorlogs import INVALID_EVENT, FAILED_PAYLOAD
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Dict, List, Tuple
 import json
-import shutil
+import time
 import logging
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=logging.INFO)
+
 
-
 
 CLUSTERS = {'econome'}
 EVENT_DATABASE_PATH = Path('./event_db.json')
-
-
-
-## #0 load a database of events if it exists, otherwise start anew
-event_db = {}
-if Path.exists(EVENT_DATABASE_PATH):
-    with EVENT_DATABASE_PATH.open('r') as f:
-        event_db = json.load(f.read())
-        logging.info(f"Loading event database from local file…")
-else:
-    logging.info(f"Event database not found locally, initialize one…")
-
-    
-cs = get_all_clusters_sites()
-
-for cluster in CLUSTERS:
-    if cluster not in cs:
-        raise Exception(f'Cluster {cluster} was not found in list of clusters…')
-
-    ## parallel callibration of clusters
+MAX_WORKERS = 8 # clusters calibrated concurrently
+MAX_ROUNDS = 5 # redeployments of a sensor without its invalid events
+SENSOR_WARMUP = 30 # seconds before reading the logs of a sensor
+MAX_LOG_LINES = 1000
+
+## candidate events, those that are invalid on a cpu are removed
+RAPL_EVENTS = ['RAPL_ENERGY_PKG', # power consumption of all cores + LLc cache
+               'RAPL_ENERGY_DRAM', # power consumption of DRAM
+               'RAPL_ENERGY_CORES', # power consumption of all cores on socket
+               'RAPL_ENERGY_GPU'] # power consumption of integrated GPU
+CORE_EVENTS = ['CPU_CLK_UNHALTED',
+               'CPU_CLK_THREAD_UNHALTED:REF_P', ## nehalem & westmere
+               'CPU_CLK_THREAD_UNHALTED:THREAD_P', ## nehalem & westmere
+               'CPU_CLK_THREAD_UNHALTED.REF_XCLK', # sandy -> broadwell archi, not scaled!
+               'LLC_MISSES', 'INSTRUCTIONS_RETIRED']
+
+
+
+def load_event_db(path: Path = EVENT_DATABASE_PATH) -> Dict[str, Dict]:
+    """Load the database of events if it exists, otherwise start anew.
+    Returns: a dictionary cpu_name -> events that work on it."""
+    if not path.exists():
+        logging.info(f"Event database not found locally, initialize one…")
+        return {}
+    logging.info(f"Loading event database from local file…")
+    with path.open('r') as f:
+        return json.load(f)
+
+def save_event_db(event_db: Dict[str, Dict], path: Path = EVENT_DATABASE_PATH):
+    """Save the database of events atomically, so an interrupted
+    calibration does not lose the clusters already calibrated."""
+    tmp = path.with_suffix('.tmp')
+    with tmp.open('w') as f:
+        json.dump(event_db, f, indent=2, sort_keys=True)
+    tmp.replace(path)
+
+def merge(event_db: Dict[str, Dict], cpu_name: str, entry: Dict):
+    """Merge the calibration of a cluster into the database, clusters
+    with the same cpu model share the same entry."""
+    known = event_db.get(cpu_name, {})
+    entry['clusters'] = sorted(set(known.get('clusters', [])) | set(entry['clusters']))
+    event_db[cpu_name] = entry
+
+def get_sensor_logs(roles, since: float) -> str:
+    """Get the recent logs of the sensor, without dumping its whole log."""
+    seconds = int(time.time() - since) + 1
+    result = run_command(f'docker logs --since {seconds}s powerapi-sensor 2>&1 | tail -n {MAX_LOG_LINES}',
+                         pattern_hosts='calibrate', roles=roles, on_error_continue=True)
+    return '\n'.join(output['stdout'] for output in result['ok'].values())
+
+def calibrate(cluster: str, site: str) -> Tuple[str, Dict]:
+    """Find the events that work on the cpu of a cluster: the sensor is
+    redeployed without the events it reports as invalid until it runs.
+    Returns: the name of the cpu model, and its entry in the database,
+    unverified if invalid events remain after MAX_ROUNDS redeployments."""
     conf = Configuration.from_settings(job_type='allow_classic_ssh',
                                        job_name=f'calibrate energy-service at {cluster}',
                                        walltime='01:00:00')
@@ -43,66 +81,82 @@ for cluster in CLUSTERS:
     network = NetworkConfiguration(id='n1',
                                    type='prod',
                                    roles=['my_network'],
-                                   site=cs[cluster])
-    
+                                   site=site)
     conf.add_network_conf(network)\
         .add_machine(roles=['calibrate'],
                      cluster=cluster,
                      nodes=1, ## we deploy everything on 1 machine
                      primary_network=network)\
         .finalize()
-    
+
     provider = G5k(conf)
     roles, networks = provider.init()
-
-    roles = discover_networks(roles, networks)
-
-    ## #A deploy the energy monitoring stack
-    ## (TODO) possible configurations (dram, cores, gpu)
-    ## cores: RAPL_ENERGY_PKG and/or RAPL_ENERGY_CORES
-    ## dram: RAPL_ENERGY_DRAM
-    ## integrated gpu: RAPL_ENERGY_GPU
-    ## -e TSC -e APERF -e MPERF
-    e = Energy(sensors=roles['calibrate'], mongos=roles['calibrate'],
-               formulas=roles['calibrate'], influxdbs=roles['calibrate'],
-               grafana=roles['calibrate'],
-               monitor={'dram':True, 'cores': False, 'gpu': False})
-
-    e.deploy()
-    
-    ## #B check if everything has deployed well
-    local_sensor_logs = './_tmp_enos_/sensor-logs'
-    remote_sensor_logs = 'tmp/sensor-logs'
-    ## #1 remove outdated data
-
-    localDirLogs = Path(f"{local_sensor_logs}/{roles['calibrate'][0].address}")
-    
-    if localDirLogs.exists() and localDirLogs.is_dir():
-        shutil.rmtree(localDirLogs)
-        
-    ## #2 retrieve new data
-    with play_on(pattern_hosts='calibrate', roles=roles) as p:
-        p.shell(f'sudo docker container logs powerapi-sensor > /{remote_sensor_logs}')
-        p.fetch(
-            display_name='Retrieving the logs of powerapi-sensor',
-            src=f'/{remote_sensor_logs}', dest=f'{local_sensor_logs}', flat=False,
-        )
-
-    pathFileLogs = localDirLogs / remote_sensor_logs
-    
-    with pathFileLogs.open('r') as f:
-        logs = f.read()
-        print(logs)
-
-    ## #3 let it run for some time
-    ## #4 double check the powerapi-sensor
-    ## #5 query influx_db to retrieve data if there are
-
-
-
-# When an event does not exists, eg. gpu
-# "event 'RAPL_ENERGY_GPU' is invalid or unsupported by this machine"
-
-# When dram && cores && gpu are false
-# "E: 21-01-13 14:43:09 perf<all>: cannot read perf values for group=rapl pkg=0 cpu=21
-#  E: 21-01-13 14:43:09 perf<all>: failed to populate payload for timestamp=1610548989669"
+    try:
+        roles = discover_networks(roles, networks)
+        hosts = roles['calibrate']
+
+        events = {'rapl': list(RAPL_EVENTS), 'core': list(CORE_EVENTS)}
+        invalid: List[str] = []
+        e = Energy(sensors=hosts, mongos=hosts, formulas=hosts, influxdbs=hosts,
+                   monitor={'dram': True, 'cores': True, 'gpu': True},
+                   events=events, state_path=None) ## clusters are calibrated concurrently
+        since = time.time()
+        e.deploy()
+        ## the logs of the last redeployment are checked as well
+        for round in range(MAX_ROUNDS + 1):
+            time.sleep(SENSOR_WARMUP)
+            logs = get_sensor_logs(roles, since)
+            found = [event for event in set(INVALID_EVENT.findall(logs))
+                     if event in events['rapl'] or event in events['core']]
+            if not found:
+                break
+            if round == MAX_ROUNDS:
+                logging.warning(f'{cluster}: invalid events {found} after {MAX_ROUNDS} '
+                                f'redeployments, the entry is unverified.')
+                break
+            logging.info(f'{cluster}: invalid events {found}, redeploying the sensor…')
+            invalid.extend(found)
+            events = {group: [event for event in names if event not in found]
+                      for group, names in events.items()}
+            e.events = events
+            since = time.time()
+            e.deploy(reconcile=True) ## only the sensor changed
+
+        cpu = e.hostname_to_cpu[hosts[0].alias]
+        return cpu.cpu_name, {'clusters': [cluster],
+                              'rapl': events['rapl'], 'core': events['core'],
+                              'invalid': sorted(invalid),
+                              'verified': not found, # no invalid events left
+                              'payload': FAILED_PAYLOAD.search(logs) is None}
+    finally:
+        provider.destroy()
+
+
+
+if __name__ == '__main__':
+    ## #0 load a database of events if it exists, and skip the clusters
+    ## it already knows
+    event_db = load_event_db()
+    known = {cluster for entry in event_db.values() for cluster in entry.get('clusters', [])}
+    cs = get_all_clusters_sites()
+    for cluster in CLUSTERS:
+        if cluster not in cs:
+            raise Exception(f'Cluster {cluster} was not found in list of clusters…')
+    clusters = sorted(CLUSTERS - known)
+    logging.info(f'Calibrating {clusters}, skipping already known {sorted(CLUSTERS & known)}…')
+
+    ## #1 parallel calibration of clusters, the database is saved as soon
+    ## as a cluster is done
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {executor.submit(calibrate, cluster, cs[cluster]): cluster
+                   for cluster in clusters}
+        for future in as_completed(futures):
+            cluster = futures[future]
+            try:
+                cpu_name, entry = future.result()
+            except Exception:
+                logging.exception(f'Calibration of {cluster} failed')
+                continue
+            merge(event_db, cpu_name, entry)
+            save_event_db(event_db)
+            logging.info(f'{cluster} ({cpu_name}): {entry}')
@@ -0,0 +1,186 @@
+"""Inspect a deployment of the energy service and read its results,
+from the state file that Energy saves after each deployment, without
+importing enoslib nor contacting the hosts unless needed:
+
+    python -m energyservice plan [--strategy cluster]
+    python -m energyservice status
+    python -m energyservice export --output ./backup
+    python -m energyservice energy --start 1610548989 --end 1610549289 --containers meow-world
+
+Dependencies are imported by the subcommands that need them: plan only
+needs the state, energy and status need numpy, export needs pyarrow.
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional
+
+from state import DeploymentState, Node, STATE_PATH
+from topology import STRATEGIES, DEFAULT_FREQUENCY_MS
+
+
+
+PROBE_TIMEOUT = 5. # seconds after which a probe fails
+FRESHNESS = 30. # seconds without report after which a sensor is stale
+
+
+
+def plan(args) -> int:
+    """Print the topology of the deployment, planned again from its
+    cpus, or from the output of lscpu of hosts."""
+    if args.lscpu:
+        from cpu import CPU
+        hostname_to_cpu = {Path(path).stem: CPU.from_text(Path(path).read_text())
+                           for path in args.lscpu}
+        if Path(args.state).exists():
+            state = DeploymentState.load(args.state)
+        else: ## a single host collects everything
+            collector = [Node('collector', 'collector')]
+            state = DeploymentState(roles={'mongos': collector, 'formulas': collector,
+                                           'influxdbs': collector, 'grafana': []},
+                                    hostname_to_cpu={}, hostname_to_mongo={},
+                                    hostname_to_influxdb={}, hostname_to_formulas={},
+                                    hostname_to_sensor_name={}, endpoints=[],
+                                    strategy='centralized',
+                                    frequency_ms=args.frequency_ms or DEFAULT_FREQUENCY_MS)
+        state.roles['sensors'] = [Node(hostname, hostname) for hostname in hostname_to_cpu]
+        state.hostname_to_cpu = hostname_to_cpu
+    else:
+        state = DeploymentState.load(args.state)
+    print(state.get_plan(args.strategy, args.frequency_ms).summary())
+    return 0
+
+def status(args) -> int:
+    """Probe the databases and Grafana of the deployment, and check that
+    sensors recently produced power reports.
+    Returns: 1 if a service is down or a sensor is stale, 0 otherwise."""
+    import asyncio
+    from reader import EnergyReader, POWER_MEASUREMENT
+
+    state = DeploymentState.load(args.state)
+    reader = EnergyReader(state, timeout=args.timeout)
+
+    async def probe(address: str, port: int) -> bool:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port),
+                                               args.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    def read_fresh(database: str):
+        query = (f'SELECT last(power) FROM {POWER_MEASUREMENT} '
+                 f'WHERE time > now() - {int(args.freshness)}s GROUP BY sensor')
+        return {series.get('tags', {}).get('sensor') for series in reader.query(database, query)}
+
+    async def check():
+        loop = asyncio.get_running_loop()
+        return await asyncio.gather(
+            asyncio.gather(*[probe(endpoint['address'], endpoint['port'])
+                             for endpoint in state.endpoints]),
+            asyncio.gather(*[loop.run_in_executor(None, read_fresh, database)
+                             for database in reader.databases], return_exceptions=True))
+
+    probes, freshes = asyncio.run(check())
+    healthy = True
+    for endpoint, ok in zip(state.endpoints, probes):
+        healthy &= ok
+        print(f'{"up" if ok else "DOWN":>5} {endpoint["role"]:<10} '
+              f'{endpoint["alias"]} ({endpoint["address"]}:{endpoint["port"]})')
+    fresh = set()
+    for database, result in zip(reader.databases, freshes):
+        if isinstance(result, BaseException):
+            healthy = False
+            print(f'Could not read {database}: {result!r}')
+        else:
+            fresh |= result
+    stale = sorted(hostname for hostname, sensor in state.hostname_to_sensor_name.items()
+                   if sensor not in fresh)
+    healthy &= not stale
+    print(f'{len(state.hostname_to_sensor_name) - len(stale)}/{len(state.hostname_to_sensor_name)} '
+          f'sensors reported in the last {args.freshness:g}s'
+          + (f', stale: {", ".join(stale)}' if stale else ''))
+    return 0 if healthy else 1
+
+def export(args) -> int:
+    """Export the power reports of the InfluxDBs to parquet files, as
+    Energy.backup does."""
+    from concurrent.futures import ThreadPoolExecutor
+    from reader import EnergyReader
+    from backup import export_influxdb
+
+    reader = EnergyReader(DeploymentState.load(args.state))
+    path = Path(args.output)
+    path.mkdir(parents=True, exist_ok=True)
+    databases = args.databases or list(reader.databases)
+    def export_database(database):
+        return export_influxdb(reader, database, path / f'{database}.power_consumption.parquet')
+    with ThreadPoolExecutor() as executor:
+        for database, rows in zip(databases, executor.map(export_database, databases)):
+            print(f'Exported {rows} power reports of {database}')
+    return 0
+
+def energy(args) -> int:
+    """Print the energy consumed by containers during a window, in
+    joules by container and socket, as JSON."""
+    from reader import EnergyReader
+
+    state = DeploymentState.load(args.state)
+    if args.host is not None and args.host not in state.hostname_to_sensor_name:
+        args.parser.error(f'unknown host {args.host}, sensored hosts are '
+                          f'{", ".join(sorted(state.hostname_to_sensor_name))}')
+    sensor = None if args.host is None else state.hostname_to_sensor_name[args.host]
+    result = EnergyReader(state).read_energy(args.start, args.end, args.containers,
+                                             sensor=sensor)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    return 0
+
+def _to_time(value: str) -> float:
+    """Parse seconds since epoch, or an ISO 8601 date."""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m energyservice',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('--state', default=STATE_PATH, help='the saved deployment')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_plan = subparsers.add_parser('plan', help=plan.__doc__.split('\n')[0])
+    parser_plan.add_argument('--strategy', choices=STRATEGIES)
+    parser_plan.add_argument('--frequency-ms', type=float)
+    parser_plan.add_argument('--lscpu', nargs='+', metavar='FILE',
+                             help='outputs of lscpu of sensored hosts, named after them')
+    parser_plan.set_defaults(run=plan)
+
+    parser_status = subparsers.add_parser('status', help=status.__doc__.split('\n')[0])
+    parser_status.add_argument('--timeout', type=float, default=PROBE_TIMEOUT)
+    parser_status.add_argument('--freshness', type=float, default=FRESHNESS)
+    parser_status.set_defaults(run=status)
+
+    parser_export = subparsers.add_parser('export', help=export.__doc__.split('\n')[0])
+    parser_export.add_argument('--output', default='./_tmp_enos_/backup')
+    parser_export.add_argument('--databases', nargs='+')
+    parser_export.set_defaults(run=export)
+
+    parser_energy = subparsers.add_parser('energy', help=energy.__doc__.split('\n')[0])
+    parser_energy.add_argument('--start', type=_to_time, required=True,
+                               help='seconds since epoch, or ISO 8601 date')
+    parser_energy.add_argument('--end', type=_to_time, default=time.time())
+    parser_energy.add_argument('--containers', nargs='+')
+    parser_energy.add_argument('--host', help='only the consumption measured on this host')
+    parser_energy.set_defaults(run=energy, parser=parser_energy)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
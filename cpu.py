@@ -1,40 +1,109 @@
 from pathlib import Path
-from engfmt import Quantity, quant_to_float # 1.1.0
-import subprocess
+from typing import Dict, List, Tuple
+import json
 import re
 
-
+
 
 class CPU:
     """Small utility class that retrieves some important data from
-    CPU."""
-    def __init__(self, path):
+    CPU. Hosts of the same CPU model share the same interned CPU (see
+    intern), so hundreds of sensored hosts cost a few objects."""
+    __slots__ = ('path', 'cpu_min', 'cpu_max', 'cpu_nom', 'cpu_name', 'cpu_shortname',
+                 'cpu_count', 'sockets')
+    _interned: Dict[Tuple, 'CPU'] = {}
+
+    def __init__(self, path = None):
         """Initialize with the path to the file containing the
         informations about CPU, got by the command lscpu.
 
         Args:
-            path: the path to the file"""
-        self.path = Path(path)
+            path: the path to the file, None when the CPU is built from
+                memory (see from_text and from_dict)"""
+        self.path = None if path is None else Path(path)
         self.cpu_min = None
         self.cpu_max = None
         self.cpu_nom = None
         self.cpu_name = None
         self.cpu_shortname = None
-    
+        self.cpu_count = 1
+        self.sockets = 1
+
+    @classmethod
+    def from_text(cls, lscpu: str) -> 'CPU':
+        """Build a CPU from the raw output of lscpu, either plain text
+        or JSON (lscpu -J).
+
+        Args:
+            lscpu: the output of the command lscpu"""
+        return cls.from_dict(cls.parse_lscpu(lscpu))
+
+    @classmethod
+    def from_dict(cls, cpu_dict: Dict[str, str]) -> 'CPU':
+        """Build a CPU from the already parsed entries of lscpu.
+
+        Args:
+            cpu_dict: dictionary field -> value, e.g. 'Model name' -> 'Intel…'"""
+        cpu = cls()
+        cpu._set_cpu(cpu_dict)
+        return cpu.intern()
+
+    @classmethod
+    def from_fields(cls, fields: Dict) -> 'CPU':
+        """Build a CPU from the fields of a saved one (see to_dict),
+        without parsing lscpu again."""
+        cpu = cls()
+        for key, value in fields.items():
+            setattr(cpu, key, value)
+        return cpu.intern()
+
+    def intern(self) -> 'CPU':
+        """Get the CPU of the process that has the same shortname and
+        fields, this one if it is the first."""
+        key = (self.cpu_shortname, self.cpu_min, self.cpu_max, self.cpu_nom,
+               self.cpu_count, self.sockets)
+        return CPU._interned.setdefault(key, self)
+
+    def __repr__(self):
+        return f'CPU({self.cpu_shortname})'
+
+    def to_dict(self) -> Dict:
+        """Get the fields of the CPU, e.g. to save a deployment."""
+        return {'cpu_min': self.cpu_min, 'cpu_max': self.cpu_max, 'cpu_nom': self.cpu_nom,
+                'cpu_name': self.cpu_name, 'cpu_shortname': self.cpu_shortname,
+                'cpu_count': self.cpu_count, 'sockets': self.sockets}
+
+    @staticmethod
+    def parse_lscpu(lscpu: str) -> Dict[str, str]:
+        """Parse the output of lscpu, either plain text or JSON (lscpu -J).
+        Returns: A dictionary field -> value."""
+        if lscpu.lstrip().startswith('{'):
+            def flatten(entries: List[Dict]):
+                for entry in entries:
+                    yield entry['field'].rstrip(':').strip(), (entry.get('data') or '').strip()
+                    yield from flatten(entry.get('children', []))
+            return dict(flatten(json.loads(lscpu)['lscpu']))
+
+        return {
+            k.strip(): v.strip()
+            for (k, v) in (line.split(':', maxsplit=1)
+                           for line in lscpu.split('\n')
+                           if ':' in line)
+        }
+
     def get_cpu(self):
         """The function retrieves and stores CPU information (min, max, nominal).
         Returns: True if the CPU data are extracted, false otherwise."""
         with self.path.open('r') as f:
             lscpu = f.read()
 
+        self._set_cpu(self.parse_lscpu(lscpu))
+
+    def _set_cpu(self, cpu_dict: Dict[str, str]):
+        ## only needed to parse lscpu, saved cpus do not pay its import
+        from engfmt import Quantity, quant_to_float # 1.1.0
+
         # #2 check entries exist
-        cpu_dict = {
-            k.strip(): v.strip()
-            for (k, v) in (line.split(':', maxsplit=1)
-                           for line in lscpu.split('\n')
-                           if not line == '')
-        }
-        
         consistent = ('CPU min MHz' in cpu_dict.keys() and
                  'CPU max MHz' in cpu_dict.keys() and
                  'Model name'  in cpu_dict.keys())
@@ -47,8 +116,10 @@ class CPU:
                 Quantity(cpu_dict['Model name'].split('@')[1]))/100000000)
             self.cpu_name = cpu_dict['Model name']
             self.cpu_shortname = re.sub('[^a-zA-Z0-9]', '', self.cpu_name)
+            ## only used to size storage volumes (see sizing)
+            self.cpu_count = int(cpu_dict.get('CPU(s)', 1))
+            self.sockets = int(cpu_dict.get('Socket(s)', 1))
         else:
             print("Error while loading file, entries do not match")
             raise
-            
 
@@ -1,10 +1,22 @@
 from cpu import CPU
+from cache import CPUCache
+from topology import TopologyPlan, TopologyIndex, DEFAULT_FREQUENCY_MS, STRATEGIES, get_cluster
+from scheduler import Stage, run_stages
+from timing import DeploymentTiming
+from region import RegionRecorder
+from grafana import provision, get_digest, GRAFANA_CACHE_PATH, PROVISIONING_DIR
+from state import DeploymentState, Node, STATE_PATH
+from reader import EnergyReader, MAX_GAP, Time
+from rollup import get_statements, ROLLUPS, INFINITE
+from sizing import estimate_mongo_bytes, estimate_influx_bytes, to_human, SAFETY_FACTOR
 
+import hashlib
+import math
+from concurrent.futures import ThreadPoolExecutor
 import json
-import shutil
 from pathlib import Path
-from typing import Dict, List, Optional
-from enoslib.api import play_on, __python3__, __default_python3__, __docker__
+from typing import Dict, List, Optional, Union
+from enoslib.api import play_on, run_command, __python3__, __default_python3__, __docker__
 from enoslib.types import Host, Roles, Network
 from enoslib.service.service import Service 
 from enoslib.service.utils import _check_path, _to_abs
@@ -14,6 +26,8 @@ import logging
 
 
 SENSORS_OUTPUT_DB_NAME = 'sensors_db'
+BACKUP_DIR = './_tmp_enos_/backup'
+DATA_DIR = '/tmp/energyservice' # remote directory of database volumes
 SMARTWATTS_CPU_ERROR_THRESHOLD = 2.0
 SMARTWATTS_DRAM_ERROR_THRESHOLD = 2.0
 
@@ -27,6 +41,32 @@ GRAFANA_VERSION = '7.3.6'
 HWPCSENSOR_VERSION = '0.1.1'
 SMARTWATTS_VERSION = '0.5.0'
 
+INFLUXDB_IMAGE = f'influxdb:{INFLUXDB_VERSION}'
+MONGODB_IMAGE = f'mongo:{MONGODB_VERSION}'
+GRAFANA_IMAGE = f'grafana/grafana:{GRAFANA_VERSION}'
+HWPCSENSOR_IMAGE = f'powerapi/hwpc-sensor:{HWPCSENSOR_VERSION}'
+SMARTWATTS_IMAGE = f'powerapi/smartwatts-formula:{SMARTWATTS_VERSION}'
+
+ROLE_TO_IMAGE = {'mongos': MONGODB_IMAGE, 'influxdbs': INFLUXDB_IMAGE,
+                 'sensors': HWPCSENSOR_IMAGE, 'formulas': SMARTWATTS_IMAGE,
+                 'grafana': GRAFANA_IMAGE}
+
+SPEC_LABEL = 'energyservice.spec'
+FORMULAS_CONTAINER = 'smartwatts' # container of all formulas of a host, when consolidated
+SMARTWATTS_ENTRYPOINT = 'python3 -m smartwatts'
+STORAGES = ('disk', 'tmpfs')
+BUFFERS = ('capped', 'ttl')
+BUFFER_SECONDS = 600 # reports kept in bounded collections of MongoDB
+MIN_CAPPED_BYTES = 1 << 20
+MONGODB_DATA = '/data/db'
+STATE_FORMULA_KEYS = ('name', 'container', 'collection', 'mongo', 'influxdb', 'database')
+INFLUXDB_DATA = '/var/lib/influxdb'
+# (TODO) check without volumes, it potentially uses volumes to read about
+# events and containers... maybe it is mandatory then.
+HWPCSENSOR_VOLUMES = ['/sys:/sys',
+                      '/var/lib/docker/containers:/var/lib/docker/containers:ro',
+                      '/tmp/powerapi-sensor-reporting:/reporting']
+
 
 
 class Energy (Service):
@@ -36,6 +76,24 @@ class Energy (Service):
                  network: Network = None,
                  priors: List[play_on] = [__python3__, __default_python3__, __docker__],
                  monitor: Dict[str, bool] = {}, # default {'dram': False, 'cores': True, 'gpu': False}
+                 cpu_cache: Optional[CPUCache] = None,
+                 image_cache: Optional[str] = None,
+                 grafana_cache: str = GRAFANA_CACHE_PATH,
+                 registry_mirror: Optional[str] = None,
+                 frequency_ms: int = DEFAULT_FREQUENCY_MS,
+                 duration: Optional[float] = None,
+                 storage: str = 'disk',
+                 data_dir: str = DATA_DIR,
+                 strict_storage: bool = False,
+                 buffer: Optional[str] = None,
+                 buffer_seconds: float = BUFFER_SECONDS,
+                 retention: str = INFINITE,
+                 rollups: List[str] = list(ROLLUPS),
+                 rollup_retention: str = INFINITE,
+                 consolidate_formulas: bool = False,
+                 strategy: str = 'centralized',
+                 events: Dict[str, List[str]] = {},
+                 state_path: Optional[str] = STATE_PATH,
     ):
         """Deploy an energy monitoring stack:
         HWPC-sensor(s) -> MongoDB(s) -> SmartWatts(s) -> InfluxDB(s) -> (Grafana).        
@@ -63,6 +121,47 @@ class Energy (Service):
             prior: priors to apply
             monitor: metrics that are collected by the sensors (dram, cores, gpu)
                 /!\ Some may not be available due to hardware or OS limitations
+            cpu_cache: on-disk cache of the cpu data of sensored hosts, only
+                missing or stale hosts are probed (default :py:class:`CPUCache`
+                in ./_tmp_enos_/cpu_cache, created when cpus are first retrieved)
+            image_cache: optional local directory of image tarballs (docker save)
+                named after images, e.g. powerapi_hwpc-sensor_0.1.1.tar, that are
+                loaded instead of pulled
+            grafana_cache: the local directory of the provisioning files of
+                Grafana, generated when the topology changes (see grafana.py)
+            registry_mirror: optional registry (host:port) to pull images from
+                before falling back to the default registry
+            frequency_ms: the sampling period of sensors in milliseconds
+            duration: the expected duration of the experiment in seconds, used
+                to size the volumes of databases (not checked if None)
+            storage: where databases store their data, 'disk' (in data_dir on
+                the host) or 'tmpfs' (in memory, lost when the container stops)
+            data_dir: the directory of database volumes on their host
+            strict_storage: fail the deployment instead of logging a warning
+                when the estimated volume of data exceeds the free space
+            buffer: bound the collections of sensors reports in MongoDB, which
+                is only a staging buffer between sensors and formulas: 'capped'
+                collections sized for buffer_seconds of reports, or a 'ttl'
+                index that expires reports after buffer_seconds (unbounded if None)
+            buffer_seconds: the number of seconds of reports kept in MongoDB
+            retention: the duration of raw power reports in InfluxDBs, e.g. 7d
+                (INF keeps them for ever)
+            rollups: resolutions at which power reports are continuously
+                downsampled (see rollup.py), used by Grafana; none if empty
+            rollup_retention: the duration of downsampled power reports
+            consolidate_formulas: run all the formulas of a host in a single
+                container, one process per formula, instead of one container
+                per formula
+            strategy: how sensored hosts share collectors: 'centralized' (mongos
+                and formulas serve all sensored hosts, by load), 'edge' (each
+                sensored host runs its own MongoDB and formula, only power
+                reports go to influxdbs; mongos and formulas are ignored), or
+                'cluster' (the sensored hosts of a cluster share the same mongo
+                and formula, chosen among mongos and formulas by load)
+            events: events of sensors by group (rapl, msr, core) that replace
+                the default ones, e.g. those known to work (see calibrate.py)
+            state_path: the file where each deployment is saved (see save),
+                not saved if None
         """
         # (TODO) include environment configurations back
         # Some initialisation and make mypy happy
@@ -72,6 +171,17 @@ class Energy (Service):
         self.influxdbs = influxdbs
         self.grafana = grafana
 
+        assert strategy in STRATEGIES, f'strategy must be one of {STRATEGIES}'
+        self.strategy = strategy
+        self.events = dict(events)
+        self.state_path = state_path
+        self.hostname_to_events: Dict[str, Dict[str, List[str]]] = {}
+        if strategy == 'edge':
+            if mongos or formulas:
+                logging.info('Edge strategy: sensored hosts are their own mongos and formulas.')
+            self.mongos = self.sensors
+            self.formulas = self.sensors
+
         self.monitor = {'dram': False, 'cores': True, 'gpu': False}
         self.monitor.update(monitor)
         
@@ -84,198 +194,509 @@ class Energy (Service):
         self._roles: Roles = {}
         self._roles.update(sensors=self.sensors, mongos=self.mongos,
                            formulas=self.formulas, influxdbs=self.influxdbs,
-                           grafana=self.grafana)
+                           grafana=self._as_list(self.grafana))
         
         self.priors = priors
+        self.cpu_cache = cpu_cache # created on first use, see _get_cpus
+        self.image_cache = image_cache
+        self.grafana_cache = grafana_cache
+        self.registry_mirror = registry_mirror
+
+        assert storage in STORAGES, f'storage must be one of {STORAGES}'
+        self.frequency_ms = frequency_ms
+        self.duration = duration
+        self.storage = storage
+        self.data_dir = data_dir
+        self.strict_storage = strict_storage
+        assert buffer is None or buffer in BUFFERS, f'buffer must be None or one of {BUFFERS}'
+        self.buffer = buffer
+        self.buffer_seconds = buffer_seconds
+        self.retention = retention
+        self.rollups = list(rollups)
+        self.rollup_retention = rollup_retention
+        self.consolidate_formulas = consolidate_formulas
 
+        self.plan: Optional[TopologyPlan] = None
+        self.index: Optional[TopologyIndex] = None # compact view of the plan for consumers
+        self.timing = DeploymentTiming() # of the last deployment
+        self._region_recorder = None
+        self._reconcile_mode = False
+        self._containers = {}
+        self._extra_vars = {}
         self.cpuname_to_cpu = {}
         self.hostname_to_cpu = {}
         self.hostname_to_mongo = {}
         self.hostname_to_influxdb = {}
+        self.hostname_to_sensor = {}
+        self._hostname_to_sensor_options = {} # the command of sensors without their name
+        self.hostname_to_formulas = {}
+        self.hostname_to_volume = {}
 
 
 
-    def deploy(self):
-        """Deploy the energy monitoring stack."""
+    def deploy(self, reconcile: bool = False, max_workers: Optional[int] = None,
+               timeouts: Dict[str, float] = {}):
+        """Deploy the energy monitoring stack. Stages that do not depend
+        on each other run concurrently, e.g., MongoDBs and InfluxDBs.
+
+        Args:
+            reconcile: only start, stop, or recreate the containers whose
+                specification (name, image, command, host) differs from the
+                running ones, instead of destroying and recreating everything.
+            max_workers: maximum number of stages running concurrently (1
+                runs them one after the other)
+            timeouts: number of seconds after which a stage is considered
+                failed, by stage name (requirements, images, cpus, sizing, clean,
+                mongos, sensors, influxdbs, formulas, grafana)
+
+        The duration of each stage, and of the steps of some stages, is
+        recorded in `timing` (see :py:class:`DeploymentTiming`).
+        """
+        self._reconcile_mode = reconcile
+        self.timing = DeploymentTiming()
+        hosts = lambda *roles: sorted({host.alias for role in roles for host in self._roles[role]})
+        everyone = hosts(*self._roles)
+        stages = [Stage('requirements', self._deploy_requirements, hosts=everyone),
+                  ## images are pulled while cpus are discovered
+                  Stage('images', self._deploy_images, requires=['requirements'], hosts=everyone),
+                  Stage('cpus', self._deploy_cpus, requires=['requirements'], hosts=hosts('sensors')),
+                  Stage('sizing', self._deploy_sizing, requires=['cpus'],
+                        hosts=hosts('mongos', 'influxdbs')),
+                  Stage('clean', self._deploy_clean, requires=['cpus'], hosts=everyone),
+                  ## MongoDB and InfluxDB are independent, the formulas need both
+                  Stage('mongos', self._deploy_mongos, requires=['clean', 'images', 'sizing'],
+                        hosts=hosts('mongos')),
+                  Stage('influxdbs', self._deploy_influxdbs, requires=['clean', 'images', 'sizing'],
+                        hosts=hosts('influxdbs')),
+                  Stage('sensors', self._deploy_sensors, requires=['mongos'], hosts=hosts('sensors')),
+                  Stage('formulas', self._deploy_formulas, requires=['mongos', 'influxdbs'],
+                        hosts=hosts('formulas'))]
+        if self.grafana is not None:
+            stages.append(Stage('grafana', self._deploy_grafana, requires=['influxdbs'],
+                                hosts=hosts('grafana')))
+        for stage in stages:
+            stage.timeout = timeouts.get(stage.name)
+
+        try:
+            run_stages(stages, max_workers=max_workers, timing=self.timing)
+        finally:
+            logging.info(self.timing.summary())
+        if self.state_path is not None:
+            self.save(self.state_path)
+
+    def _deploy_requirements(self):
+        """Install the requirements on all hosts."""
         ## #0A Retrieve requirements
         with play_on(pattern_hosts='all', roles=self._roles, priors=self.priors) as p:
             p.pip(display_name='Installing python-docker…', name='docker')
 
+    def _deploy_images(self):
+        """Pull the images needed by each host concurrently, unless they
+        are already present."""
+        hostname_to_images = {}
+        for role, image in ROLE_TO_IMAGE.items():
+            for host in self._roles[role]:
+                hostname_to_images.setdefault(host.alias, set()).add(image)
+
+        image_to_tarball = {}
+        if self.image_cache is not None:
+            for image in ROLE_TO_IMAGE.values():
+                tarball = Path(self.image_cache) / (image.replace('/', '_').replace(':', '_') + '.tar')
+                if tarball.exists():
+                    image_to_tarball[image] = tarball
+
+        hostname_to_tarballs = {}
+        hostname_to_pull = {}
+        for hostname, images in hostname_to_images.items():
+            hostname_to_tarballs[hostname] = [
+                {'src': str(image_to_tarball[image].resolve()),
+                 'dest': f'/tmp/{image_to_tarball[image].name}'}
+                for image in sorted(images) if image in image_to_tarball]
+            ## one background pull per image, the task fails if any fails
+            pulls = [f'({self._get_pull_command(image, image_to_tarball.get(image))}) & pids="$pids $!"'
+                     for image in sorted(images)]
+            hostname_to_pull[hostname] = '; '.join(
+                ['pids=""'] + pulls + ['for pid in $pids; do wait $pid || exit 1; done'])
+
+        with play_on(pattern_hosts='all', roles=self._roles,
+                     extra_vars={'ansible_hostname_to_tarballs': hostname_to_tarballs,
+                                 'ansible_hostname_to_pull': hostname_to_pull}) as p:
+            ## copy only transfers tarballs that differ from the remote ones
+            p.copy(
+                display_name='Copying cached images…',
+                src='{{item.src}}', dest='{{item.dest}}',
+                loop='{{ansible_hostname_to_tarballs.get(inventory_hostname, [])}}',
+            )
+            p.shell(
+                '{{ansible_hostname_to_pull[inventory_hostname]}}',
+                display_name='Pulling images…',
+                when='inventory_hostname in ansible_hostname_to_pull',
+            )
+
+    def _get_pull_command(self, image: str, tarball: Optional[Path] = None) -> str:
+        """Build the shell command that gets an image, from the first
+        source that works: already present, local tarball, registry
+        mirror, default registry."""
+        commands = [f'docker image inspect {image} > /dev/null 2>&1']
+        if tarball is not None:
+            commands.append(f'docker load -i /tmp/{tarball.name}')
+        if self.registry_mirror is not None:
+            commands.append(f'(docker pull {self.registry_mirror}/{image} && '
+                            f'docker tag {self.registry_mirror}/{image} {image})')
+        commands.append(f'docker pull {image}')
+        return ' || '.join(commands)
+
+    def _deploy_cpus(self):
+        """Discover the cpus of sensored hosts and plan the topology."""
         ## #0B retrieve cpu data from each host then perform a checking
-        self._get_cpus()
+        with self.timing.phase('cpus.discovery', stage='cpus',
+                               hosts=[host.alias for host in self.sensors]):
+            self._get_cpus()
         
         logging.debug(self.cpuname_to_cpu)
         logging.debug(self.hostname_to_cpu)
 
-        if (len(self.mongos) > len(self.cpuname_to_cpu) or
+        if self.strategy == 'centralized' and (
+            len(self.mongos) > len(self.cpuname_to_cpu) or
             len(self.formulas) > len(self.cpuname_to_cpu) or
             len(self.influxdbs) > len(self.formulas)):
             logging.warning("""There might be an issue with the setup: too many
             collectors (stack dbs and analysis), (or) not enough cpu types.
             It may waste resources.""")
 
+        with self.timing.phase('cpus.plan', stage='cpus'):
+            self._get_plan()
+            logging.info(f'Deployment plan:\n{self.plan.summary()}')
+            self._get_sensors()
+            self._get_formulas()
+            self._containers = self._get_containers()
 
-        ## #0C clean everything to make sure that interdependency
-        ## conditions are met (needed since restarting without it led
-        ## to early crashes of smartwatts formula…)
-        self.destroy()
-            
+    def _deploy_sizing(self):
+        """Estimate the volume of data that each database host stores
+        during the experiment, and check that it fits in its free space
+        (disk or memory depending on the storage)."""
+        self.hostname_to_volume = {}
+        if self.duration is None:
+            return
+
+        scopes = max(1, self.monitor['cores'] + self.monitor['dram'])
+        for hostname, cpu in self.hostname_to_cpu.items():
+            shard = self.plan.hostname_to_shard[hostname]
+            for host, name, size in (
+                    (shard['mongo'], 'mongodb', estimate_mongo_bytes(
+                        cpu, self._get_events(hostname), self.frequency_ms,
+                        self._get_buffer_duration())),
+                    (shard['influxdb'], 'influxdb', estimate_influx_bytes(
+                        cpu, scopes, self.frequency_ms, self.duration))):
+                volumes = self.hostname_to_volume.setdefault(host.alias, {})
+                volumes[name] = volumes.get(name, 0) + size
+
+        if self.storage == 'tmpfs':
+            command = "awk '/^MemAvailable:/ {print $2}' /proc/meminfo"
+        else:
+            command = (f"mkdir -p {self.data_dir} && "
+                       f"df -Pk {self.data_dir} | awk 'NR==2 {{print $4}}'")
+        ## some versions of enoslib do not forward on_error_continue, and
+        ## a failed check must not fail the deployment: it prints nothing
+        command = f'({command}) || true'
+        result = run_command(command, pattern_hosts=':'.join(self.hostname_to_volume),
+                             roles=self._roles, on_error_continue=True)
+        for hostname, output in result['failed'].items():
+            logging.warning(f'Could not check the free space of {hostname}: {output}')
+        for hostname, output in result['ok'].items():
+            try:
+                free = int(output['stdout'].strip()) * 1024 # kB
+            except ValueError: ## e.g. nothing printed by df
+                logging.warning(f'Could not check the free space of {hostname}: '
+                                f'unexpected output {output["stdout"]!r}')
+                continue
+            needed = sum(self.hostname_to_volume[hostname].values()) * SAFETY_FACTOR
+            logging.info(f'{hostname} needs about {to_human(needed)} of {self.storage} '
+                         f'for databases, {to_human(free)} are free.')
+            if needed > free:
+                message = (f'Not enough {self.storage} on {hostname} for databases: '
+                           f'{to_human(needed)} needed, {to_human(free)} free.')
+                if self.strict_storage:
+                    raise RuntimeError(message)
+                logging.warning(message)
+
+    def _get_buffer_duration(self) -> float:
+        """Get the number of seconds of reports stored in MongoDB."""
+        if self.buffer is None:
+            return self.duration
+        return min(self.duration, self.buffer_seconds)
+
+    def _get_storage(self, hosts: List[Host], name: str, path: str):
+        """Get the arguments of docker_container that mount the data
+        of a database, and the extra vars they use.
+        Args:
+            hosts: the hosts of the database
+            name: the name of the database container (mongodb, influxdb)
+            path: the data directory in the container
+        Returns:
+            A pair (docker_container arguments, extra vars).
+        """
+        if self.storage == 'disk':
+            return {'volumes': [f'{self.data_dir}/{name}:{path}']}, {}
+        ## tmpfs are sized per host, unbounded when the duration is unknown
+        hostname_to_tmpfs = {}
+        for host in hosts:
+            size = self.hostname_to_volume.get(host.alias, {}).get(name)
+            hostname_to_tmpfs[host.alias] = (
+                path if size is None else f'{path}:size={math.ceil(size * SAFETY_FACTOR / 1024)}k')
+        return ({'tmpfs': ['{{ansible_hostname_to_tmpfs[inventory_hostname]}}']},
+                {'ansible_hostname_to_tmpfs': hostname_to_tmpfs})
+
+    def _deploy_clean(self):
+        """Remove the containers that must be (re)created."""
+        if self._reconcile_mode:
+            ## #0C only touch containers that differ from the desired ones
+            with self.timing.phase('clean.reconcile', stage='clean', hosts=list(self._containers)):
+                to_deploy, to_remove = self._reconcile(self._containers)
+            with self.timing.phase('clean.remove', stage='clean',
+                                   hosts=[hostname for hostname, names in to_remove.items() if names]), \
+                 play_on(pattern_hosts='all', roles=self._roles,
+                         extra_vars={'ansible_to_remove': to_remove}) as p:
+                p.docker_container(
+                    display_name='Removing obsolete containers…',
+                    name='{{item}}', state='absent', force_kill=True,
+                    loop='{{ansible_to_remove.get(inventory_hostname, [])}}',
+                )
+        else:
+            ## #0C clean everything to make sure that interdependency
+            ## conditions are met (needed since restarting without it led
+            ## to early crashes of smartwatts formula…)
+            with self.timing.phase('clean.destroy', stage='clean', hosts=list(self._containers)):
+                self.destroy()
+            to_deploy = {hostname: list(names) for hostname, names in self._containers.items()}
+
+        self._extra_vars = {'ansible_containers': self._containers,
+                            'ansible_to_deploy': to_deploy}
+
+    def _deploy_mongos(self):
+        """Deploy the MongoDBs that store the reports of sensors."""
         ## #1 Deploy MongoDB collectors
-        with play_on(pattern_hosts='mongos', roles=self._roles) as p:
+        storage, storage_vars = self._get_storage(self.mongos, 'mongodb', MONGODB_DATA)
+        with play_on(pattern_hosts='mongos', roles=self._roles,
+                     extra_vars=dict(self._extra_vars, **storage_vars,
+                                     ansible_hostname_to_buffers=self._get_buffers())) as p:
             p.docker_container(
                 display_name='Installing mongodb…',
                 name='mongodb',
-                image=f'mongo:{MONGODB_VERSION}',
+                image=MONGODB_IMAGE,
                 detach=True, state='started', recreate=True,
                 exposed_ports=[f'27017'],
                 published_ports=[f'{MONGODB_PORT}:27017'],
-                volumes='/tmp/:/data/db',
+                **storage,
+                labels={SPEC_LABEL: "{{ansible_containers[inventory_hostname]['mongodb']}}"},
+                when="'mongodb' in ansible_to_deploy.get(inventory_hostname, [])",
             )
             p.wait_for(
                 display_name='Waiting for MongoDB to be ready…',
                 host='localhost', port='27017', state='started',
                 delay=2, timeout=120,
             )
+            if self.buffer is not None:
+                ## collections must exist before sensors write into them,
+                ## otherwise MongoDB creates them unbounded
+                p.shell(
+                    f"docker exec mongodb mongo --quiet {SENSORS_OUTPUT_DB_NAME} "
+                    "--eval '{{ansible_hostname_to_buffers[inventory_hostname]}}'",
+                    display_name=f'Creating {self.buffer} collections…',
+                    when='inventory_hostname in ansible_hostname_to_buffers',
+                )
 
+    def _get_buffers(self) -> Dict[str, str]:
+        """Build the mongo shell script that bounds the collections of
+        each MongoDB, depending on the buffer option. Capped collections
+        are sized after the number of sensors writing in them and their
+        sampling frequency. Scripts are idempotent, so they run at each
+        deployment, even when MongoDB is kept by reconcile.
+        Returns:
+            A dictionary inventory hostname -> script.
+        """
+        if self.buffer is None:
+            return {}
+        hostname_to_statements = {}
+        for shard in self.plan.shards:
+            collection = json.dumps(shard['collection'])
+            if self.buffer == 'capped':
+                size = sum(estimate_mongo_bytes(self.hostname_to_cpu[hostname],
+                                                self._get_events(hostname),
+                                                self.frequency_ms, self.buffer_seconds)
+                           for hostname in shard['hostnames'])
+                size = max(MIN_CAPPED_BYTES, math.ceil(size * SAFETY_FACTOR))
+                ## convertToCapped keeps the most recent reports of an
+                ## existing collection, created before the option was set
+                statement = (f'if (db.getCollectionNames().indexOf({collection}) < 0) '
+                             f'db.createCollection({collection}, {{capped: true, size: {size}}}); '
+                             f'else if (!db.getCollection({collection}).isCapped()) '
+                             f'db.runCommand({{convertToCapped: {collection}, size: {size}}});')
+            else:
+                ## reports are removed by the TTL monitor of MongoDB every minute
+                statement = (f'db.getCollection({collection}).createIndex('
+                             f'{{timestamp: 1}}, {{expireAfterSeconds: {int(self.buffer_seconds)}}});')
+            hostname_to_statements.setdefault(shard['mongo'].alias, []).append(statement)
+        return {hostname: ' '.join(statements)
+                for hostname, statements in hostname_to_statements.items()}
+
+    def redeploy_sensors(self, hostnames: List[str]):
+        """Recreate the sensors of some hosts of a deployed stack, e.g.
+        after their events changed, without touching other containers.
+        Args:
+            hostnames: the inventory hostnames of the sensored hosts
+        """
+        self._get_sensors()
+        self._containers = self._get_containers()
+        self.redeploy({hostname: ['powerapi-sensor'] for hostname in hostnames})
+
+    def redeploy(self, hostname_to_containers: Dict[str, List[str]]):
+        """Recreate some containers of a deployed stack, e.g. the failed
+        ones (see monitor.py), with the plays of their stages only: hosts
+        are not prepared again, and other containers are not touched,
+        except the sensors and formulas of recreated databases.
+        Args:
+            hostname_to_containers: the names of the containers to recreate
+                by inventory hostname
+        """
+        hostname_to_containers = {hostname: list(names)
+                                  for hostname, names in hostname_to_containers.items()}
+        self._add_dependents(hostname_to_containers)
+        self._extra_vars = {'ansible_containers': self._containers,
+                            'ansible_to_deploy': hostname_to_containers}
+        names = {name for names in hostname_to_containers.values() for name in names}
+        formulas = {formula['container'] for formulas in self.hostname_to_formulas.values()
+                    for formula in formulas}
+        ## databases first, since sensors and formulas write into them
+        for containers, deploy in ((['mongodb'], self._deploy_mongos),
+                                   (['influxdb'], self._deploy_influxdbs),
+                                   (['powerapi-sensor'], self._deploy_sensors),
+                                   (formulas, self._deploy_formulas),
+                                   (['grafana'], self._deploy_grafana)):
+            if names.intersection(containers):
+                deploy()
+
+    def _deploy_sensors(self):
+        """Deploy the sensors on monitored hosts."""
         ## #2 Deploy energy sensors        
-        cpunames = list(self.cpuname_to_cpu.keys())
-        for hostname, cpu in self.hostname_to_cpu.items():
-            mongo_index = cpunames.index(cpu.cpu_name)%len(self.mongos)
-            influxdb_index = cpunames.index(cpu.cpu_name)%len(self.influxdbs)
-            self.hostname_to_mongo[hostname] = self._get_address(self._roles['mongos'][mongo_index])
-            self.hostname_to_influxdb[hostname] = self._get_address(self._roles['influxdbs'][influxdb_index])
-        
+        ## sensors of a shard share their options, only their name differs:
+        ## hosts only carry the index of their options
+        option_ids = {}
+        hostname_to_options = {hostname: option_ids.setdefault(sensor_options, len(option_ids))
+                               for hostname, sensor_options in self._hostname_to_sensor_options.items()}
+        options = list(option_ids) # in the order of their ids
         with play_on(pattern_hosts='sensors', roles=self._roles,
-                     extra_vars={'ansible_hostname_to_mongo': self.hostname_to_mongo,
-                                 'ansible_hostname_to_cpu': self.hostname_to_cpu}) as p:
-            # (TODO) check without volumes, it potentially uses volumes to read about
-            # events and containers... maybe it is mandatory then.
-            volumes = ['/sys:/sys',
-                       '/var/lib/docker/containers:/var/lib/docker/containers:ro',
-                       '/tmp/powerapi-sensor-reporting:/reporting']            
-            command=['-n sensor-{{inventory_hostname_short}}',
-                     '-r mongodb -U mongodb://{{ansible_hostname_to_mongo[inventory_hostname]}}:27017',
-                     f'-D {SENSORS_OUTPUT_DB_NAME}', '-C col_{{ansible_hostname_to_cpu[inventory_hostname].cpu_shortname}}',
-                     '-s rapl -o',] ## RAPL: Running Average Power Limit (need privileged)
-            ## (TODO) double check if these options are available at hardware/OS level
-            if self.monitor['cores']: command.append('-e RAPL_ENERGY_PKG')  # power consumption of all cores + LLc cache
-            if self.monitor['dram'] : command.append('-e RAPL_ENERGY_DRAM')  # power consumption of DRAM
-            if self.monitor['cores']: command.append('-e RAPL_ENERGY_CORES')  # power consumption of all cores on socket
-            if self.monitor['gpu']  : command.append('-e RAPL_ENERGY_GPU')  # power consumption of GPU
-            command.extend(['-s msr -e TSC -e APERF -e MPERF',
-		            '-c core', ## CORE 
-                            # (TODO) does not seem to work properly this part
-                            # (TODO) check possible event names depending on cpu architecture
-                            #'-e "CPU_CLK_THREAD_UNHALTED:REF_P"', ## nehalem & westmere
-                            #'-e "CPU_CLK_THREAD_UNHALTED:THREAD_P"', ## nehalem & westmere
-                            #'-e "CPU_CLK_THREAD_UNHALTED.REF_XCLK"', # sandy -> broadwell archi, not scaled!
-                            #'-e "CPU_CLK_THREAD_UNHALTED.REF_XCLK"', # skylake and newer, must be scale by x4 base ratio.
-                            '-e CPU_CLK_UNHALTED',
-                            '-e LLC_MISSES -e INSTRUCTIONS_RETIRED'])
-
+                     extra_vars=dict(self._extra_vars, ansible_sensor_options=options,
+                                     ansible_hostname_to_options=hostname_to_options)) as p:
             p.docker_container(
                 display_name='Installing PowerAPI sensors…',
                 name='powerapi-sensor',
-                image=f'powerapi/hwpc-sensor:{HWPCSENSOR_VERSION}',
+                image=HWPCSENSOR_IMAGE,
                 detach=True, state='started', recreate=True, network_mode='host',
                 privileged=True,
-                volumes=volumes,
-                command=command,
+                volumes=HWPCSENSOR_VOLUMES,
+                ## the same name as _get_sensor_name
+                command='-n sensor-{{inventory_hostname_short}} '
+                        '{{ansible_sensor_options[ansible_hostname_to_options[inventory_hostname]]}}',
+                labels={SPEC_LABEL: "{{ansible_containers[inventory_hostname]['powerapi-sensor']}}"},
+                when="'powerapi-sensor' in ansible_to_deploy.get(inventory_hostname, [])",
             )
 
+    def _deploy_influxdbs(self):
+        """Deploy the InfluxDBs that store the output of formulas."""
         ## #3 deploy InfluxDB, it will be the output of SmartWatts and
         ## the input of the optional Grafana.
-        with play_on(pattern_hosts='influxdbs', roles=self._roles) as p:
+        storage, storage_vars = self._get_storage(self.influxdbs, 'influxdb', INFLUXDB_DATA)
+        hostname_to_statements = {}
+        for cpu_name, host in self.plan.cpuname_to_influxdb.items():
+            hostname_to_statements.setdefault(host.alias, []).extend(get_statements(
+                f'power_{self.cpuname_to_cpu[cpu_name].cpu_shortname}', self.retention,
+                self.rollups, self.rollup_retention))
+        with play_on(pattern_hosts='influxdbs', roles=self._roles,
+                     extra_vars=dict(self._extra_vars, **storage_vars,
+                                     ansible_hostname_to_statements=hostname_to_statements)) as p:
             p.docker_container(
                 display_name='Installing InfluxDB…',
-                name='influxdb', image=f'influxdb:{INFLUXDB_VERSION}',
+                name='influxdb', image=INFLUXDB_IMAGE,
                 detach=True, state='started', recreate=True,
                 exposed_ports='8086',
                 published_ports=f'{INFLUXDB_PORT}:8086',
+                **storage,
+                labels={SPEC_LABEL: "{{ansible_containers[inventory_hostname]['influxdb']}}"},
+                when="'influxdb' in ansible_to_deploy.get(inventory_hostname, [])",
             )
             p.wait_for(
                 display_name='Waiting for InfluxDB to be ready…',
                 host='localhost', port='8086', state='started',
                 delay=2, timeout=120,
             )
-            
+            ## one statement per request since influxdb skips the statements
+            ## following a failed one (e.g., already exists), which is
+            ## reported in the body of the response, not as an http error
+            p.uri(
+                display_name='Setting retention policies and rollups…',
+                url=f'http://localhost:{INFLUXDB_PORT}/query',
+                method='POST', body_format='form-urlencoded', status_code=[200],
+                body={'q': '{{item}}'},
+                loop='{{ansible_hostname_to_statements.get(inventory_hostname, [])}}',
+            )
+
+    def _deploy_formulas(self):
+        """Deploy the SmartWatts formulas."""
         ## #4 deploy SmartWatts (there may be multiple SmartWatts per machine)
-        ## (TODO) start multiple formulas in the same formula container?
-        ## (TODO) ansiblify instead of sequentially push commands
-        i = 0
-        for cpu_name, cpu in self.cpuname_to_cpu.items():            
-            cpunames = list(self.cpuname_to_cpu.keys())
-            mongo_index = cpunames.index(cpu.cpu_name)%len(self.mongos)
-            mongo_addr = self._get_address(self._roles['mongos'][mongo_index])
-            influxdbs_addr = self._get_address(self.influxdbs[i%len(self.influxdbs)])
-            smartwatts_name = self._get_smartwatts_name(cpu)
-            
-            with play_on(pattern_hosts =
-                         self._get_address(self.formulas[i%len(self.formulas)]),
-                         roles = self._roles) as p:                
-                command=['-s',
-                         '--input mongodb --model HWPCReport',
-                         f'--uri mongodb://{mongo_addr}:{MONGODB_PORT}',
-                         f'-d {SENSORS_OUTPUT_DB_NAME} -c col_{cpu.cpu_shortname}',
-                         # f"--output influxdb --name hwpc --model HPWCReport",
-                         # f"--uri {influxdbs_addr} --port {INFLUXDB_PORT} --db hwpc_report",
-                         f'--output influxdb --name power_{cpu.cpu_shortname} --model PowerReport',
-                         f'--uri {influxdbs_addr} --port {INFLUXDB_PORT} --db power_{cpu.cpu_shortname}',
-                         # vvv Formula report does not have to_influxdb (yet?)
-                         #f"--output influxdb --name formula --model FormulaReport",
-                         #f"--uri {influxdbs_addr} --port {INFLUXDB_PORT} --db formula_report",
-                         '--formula smartwatts', f'--cpu-ratio-base {cpu.cpu_nom}',
-                         f'--cpu-ratio-min {cpu.cpu_min}', f'--cpu-ratio-max {cpu.cpu_max}', 
-                         f'--cpu-error-threshold {SMARTWATTS_CPU_ERROR_THRESHOLD}',
-                         f'--dram-error-threshold {SMARTWATTS_DRAM_ERROR_THRESHOLD}',]
-                if not self.monitor['cores']: command.append('--disable-cpu-formula')
-                if not self.monitor['dram'] : command.append('--disable-dram-formula')
+        if self.consolidate_formulas:
+            hostname_to_script = {hostname: self._get_formulas_script(formulas)
+                                  for hostname, formulas in self.hostname_to_formulas.items()}
+            with play_on(pattern_hosts='formulas', roles=self._roles,
+                         extra_vars=dict(self._extra_vars, ansible_hostname_to_script=hostname_to_script)) as p:
                 p.docker_container(
-                    display_name='Installing smartwatts formula…',
-                    name=f'{smartwatts_name}',
-                    image=f'powerapi/smartwatts-formula:{SMARTWATTS_VERSION}',
+                    display_name='Installing smartwatts formulas…',
+                    name=FORMULAS_CONTAINER,
+                    image=SMARTWATTS_IMAGE,
                     detach=True, network_mode='host', recreate=True,
-                    command=command,
+                    entrypoint=['sh', '-c'],
+                    command=['{{ansible_hostname_to_script[inventory_hostname]}}'],
+                    labels={SPEC_LABEL: f"{{{{ansible_containers[inventory_hostname]['{FORMULAS_CONTAINER}']}}}}"},
+                    when=f"'{FORMULAS_CONTAINER}' in ansible_to_deploy.get(inventory_hostname, [])",
                 )
-            ++i
-        
-        ## #5 Deploy the optional grafana server
-        if self.grafana is None:
             return
 
-        
-        ## #A prepare dashboard
-        with open('grafana_dashboard.json', 'r') as f:
-            dashboard_json = json.load(f)
-            panel_targets = [None] * len(self.cpuname_to_cpu)
+        with play_on(pattern_hosts='formulas', roles=self._roles,
+                     extra_vars=dict(self._extra_vars, ansible_hostname_to_formulas=self.hostname_to_formulas)) as p:
+            p.docker_container(
+                display_name='Installing smartwatts formulas…',
+                name='{{item.name}}',
+                image=SMARTWATTS_IMAGE,
+                detach=True, network_mode='host', recreate=True,
+                command='{{item.command}}',
+                labels={SPEC_LABEL: '{{item.digest}}'},
+                loop='{{ansible_hostname_to_formulas[inventory_hostname] | default([])}}',
+                when="item.name in ansible_to_deploy.get(inventory_hostname, [])",
+            )
 
-        i = 0
-        for cpu_name, cpu in self.cpuname_to_cpu.items():
-            panel_targets[i] = {
-                'datasource': f'power-{cpu_name}',
-                'groupBy': [{'params':['$__interval'], 'type':'time'},
-                            {'params':['target'], 'type':'tag'}],
-                'measurement': 'power_consumption',
-                'orderByTime': 'ASC',
-                'policy': 'default',
-                'refId': f'{cpu.cpu_shortname}',
-                'resultFormat': 'time_series',
-                'select': [[{'params':['power'], 'type': 'field'},
-                            {'params':[], 'type': 'mean'}]],
-                'tags': [{'key':'target', 'operator':'!=', 'value':'global'},
-                         {'key':'target', 'operator':'!=', 'value':'powerapi-sensor'},
-                         {'key':'target', 'operator':'!=', 'value':'rapl'}]}
-            i = i + 1
-        dashboard_json['dashboard']['panels'][0]['targets'] = panel_targets
-
-        with play_on(pattern_hosts='grafana', roles=self._roles) as p:
+    def _deploy_grafana(self):
+        """Deploy Grafana with a dashboard of all containers. Datasources
+        and dashboard are provisioning files mounted in the container, so
+        Grafana is ready as soon as it starts."""
+        ## #A prepare datasources and dashboard, unless the topology is known
+        provisioning = provision(self._get_grafana_topology(), self.grafana_cache)
+
+        with play_on(pattern_hosts='grafana', roles=self._roles, extra_vars=self._extra_vars) as p:
+            p.copy(
+                display_name='Copying Grafana provisioning…',
+                src=f'{provisioning.resolve()}/', dest=f'{self.data_dir}/grafana/',
+                when="'grafana' in ansible_to_deploy.get(inventory_hostname, [])",
+            )
             p.docker_container(
                 display_name='Installing Grafana…',
-                name='grafana', image=f'grafana/grafana:{GRAFANA_VERSION}',
+                name='grafana', image=GRAFANA_IMAGE,
                 detach=True, recreate=True, state='started',
                 #exposed_ports='3000',
                 network_mode='host', # not very clean "host"
                 # published_ports=f'{GRAFANA_PORT}:3000',
+                volumes=[f'{self.data_dir}/grafana:{PROVISIONING_DIR}:ro'],
+                labels={SPEC_LABEL: "{{ansible_containers[inventory_hostname]['grafana']}}"},
+                when="'grafana' in ansible_to_deploy.get(inventory_hostname, [])",
             )
             p.wait_for(
                 display_name='Waiting for Grafana to be ready…',
@@ -283,64 +704,277 @@ class Energy (Service):
                 delay=2, timeout=120,
             )
 
-            ## #B add datasources and fill the dashboard
-            i = 0
-            for cpu_name, cpu in self.cpuname_to_cpu.items():
-                influxdbs_addr = self._get_address(self.influxdbs[i%len(self.influxdbs)])
-                smartwatts_name = self._get_smartwatts_name(cpu)
-                p.uri(
-                    display_name='Add InfluxDB power reports in Grafana…',
-                    url=f'http://localhost:{GRAFANA_PORT}/api/datasources',
-                    user='admin', password='admin', force_basic_auth=True,
-                    body_format='json', method='POST',
-                    status_code=[200, 409], # 409 means: already added
-                    body=json.dumps({'name': f'power-{cpu_name}',
-                                     'type': 'influxdb',
-                                     'url': f'http://{influxdbs_addr}:{INFLUXDB_PORT}',
-                                     'access': 'proxy',
-                                     'database': f'power_{cpu.cpu_shortname}',
-                                     'isDefault': True}),
-                )
-                i = i + 1
+    def _get_grafana_topology(self) -> Dict:
+        """Get what the provisioning of Grafana depends on: a datasource
+        per CPU model, and a panel per CPU model and cluster (see
+        grafana.py)."""
+        datasources, panels = [], []
+        for cpu_name, cpu in self.cpuname_to_cpu.items():
+            influxdb = self._get_address(self.plan.cpuname_to_influxdb[cpu_name])
+            datasources.append({'name': f'power-{cpu_name}',
+                                'url': f'http://{influxdb}:{INFLUXDB_PORT}',
+                                'database': f'power_{cpu.cpu_shortname}'})
+            cluster_to_sensors = {}
+            for hostname in self.plan.cpuname_to_hostnames[cpu_name]:
+                cluster_to_sensors.setdefault(get_cluster(hostname), []).append(
+                    self._get_sensor_name(hostname))
+            for cluster, sensors in sorted(cluster_to_sensors.items()):
+                panels.append({'cpu_name': cpu_name, 'cluster': cluster,
+                               'datasource': f'power-{cpu_name}',
+                               ## no filter when the cluster is the only one
+                               'sensors': sorted(sensors) if len(cluster_to_sensors) > 1 else None})
+        return {'datasources': datasources, 'panels': panels, 'rollups': list(self.rollups)}
 
-            p.uri(
-                display_name='Create a dashboard with all containers…',
-                url='http://localhost:3000/api/dashboards/import',
-                user='admin', password='admin', force_basic_auth=True,
-                body_format='json', method='POST', status_code=[200],
-                body=json.dumps(dashboard_json)
-            )
-        
-        ## (TODO) create a summary of established links between machines
-        
     def _get_cpus(self):
         """Retrieve cpu info of all sensored hosts and put it in
         dictionaries."""
         if self.hostname_to_cpu: ## lazy loading
             return
+        if self.cpu_cache is None:
+            self.cpu_cache = CPUCache()
 
-        local_lscpus = './_tmp_enos_/lscpus'
-        remote_lscpu = 'tmp/lscpu'        
-        ## #1 remove outdated data
-        if (Path(local_lscpus).exists() and Path(local_lscpus).is_dir()):
-            shutil.rmtree(Path(local_lscpus))
-        
-        ## #2 retrieve new data
-        with play_on(pattern_hosts='sensors', roles=self._roles) as p:
-            p.shell(f'lscpu > /{remote_lscpu}')
-            p.fetch(
-                display_name='Retrieving the result of lscpu…',
-                src=f'/{remote_lscpu}', dest=f'{local_lscpus}', flat=False,
-            )
-            
-        for path_host_name in Path(local_lscpus).iterdir():
-            path_host_name_lscpu = path_host_name / remote_lscpu
-            cpu = CPU(path_host_name_lscpu.resolve())
-            cpu.get_cpu()
+        hostname_to_cpu = self.cpu_cache.lookup(host.alias for host in self.sensors)
+        stale = [host.alias for host in self.sensors if host.alias not in hostname_to_cpu]
+
+        if stale:
+            ## single round trip: the output of lscpu is read from memory,
+            ## JSON when the installed lscpu supports it
+            result = run_command('LC_ALL=C lscpu -J 2>/dev/null || LC_ALL=C lscpu',
+                                 pattern_hosts=':'.join(stale), roles=self._roles)
+            hostname_to_lscpu = {hostname: output['stdout']
+                                 for hostname, output in result['ok'].items()}
+            hostname_to_cpu.update(self.cpu_cache.put(hostname_to_lscpu))
+
+        for host in self.sensors:
+            cpu = hostname_to_cpu[host.alias]
             self.cpuname_to_cpu[cpu.cpu_name] = cpu
-            self.hostname_to_cpu[path_host_name.name] = cpu
+            self.hostname_to_cpu[host.alias] = cpu
 
     
+    def _get_plan(self):
+        """Plan which collectors serve which sensored hosts, depending
+        on their load."""
+        self.plan = TopologyPlan(self.hostname_to_cpu, mongos=self.mongos,
+                                 formulas=self.formulas, influxdbs=self.influxdbs,
+                                 frequency_ms=self.frequency_ms, strategy=self.strategy)
+
+    def _get_sensors(self):
+        """Get the collectors of each sensored host from the plan, and
+        compute the command of its sensor."""
+        self.index = TopologyIndex(self.plan, mongo_port=MONGODB_PORT, influx_port=INFLUXDB_PORT,
+                                   get_address=self._get_address)
+        for hostname in self.hostname_to_cpu:
+            shard = self.plan.hostname_to_shard[hostname]
+            self.hostname_to_mongo[hostname] = self._get_address(shard['mongo'])
+            self.hostname_to_influxdb[hostname] = self._get_address(shard['influxdb'])
+
+            command=[f'-n {self._get_sensor_name(hostname)}',
+                     f'-r mongodb -U mongodb://{self.hostname_to_mongo[hostname]}:{MONGODB_PORT}',
+                     f'-D {SENSORS_OUTPUT_DB_NAME}', f'-C {shard["collection"]}',
+                     f'-f {self.frequency_ms}']
+            events = self._get_events(hostname)
+            ## RAPL: Running Average Power Limit (need privileged)
+            command.append('-s rapl -o')
+            command.extend(f'-e {event}' for event in events['rapl'])
+            command.append('-s msr')
+            command.extend(f'-e {event}' for event in events['msr'])
+            command.append('-c core') ## CORE
+            command.extend(f'-e {event}' for event in events['core'])
+            self.hostname_to_sensor[hostname] = ' '.join(command)
+            self._hostname_to_sensor_options[hostname] = ' '.join(command[1:])
+
+    def _get_events(self, hostname: Optional[str] = None) -> Dict[str, List[str]]:
+        """Get the events monitored by sensors, the default ones unless
+        they are replaced by the events option, or by the events of the
+        host (hostname_to_events, see sensorlogs.py).
+        Args:
+            hostname: the inventory hostname of the sensored host
+        Returns: A dictionary group (rapl, msr, core) -> names of events."""
+        rapl = []
+        ## (TODO) double check if these options are available at hardware/OS level
+        if self.monitor['cores']: rapl.append('RAPL_ENERGY_PKG')  # power consumption of all cores + LLc cache
+        if self.monitor['dram'] : rapl.append('RAPL_ENERGY_DRAM')  # power consumption of DRAM
+        if self.monitor['cores']: rapl.append('RAPL_ENERGY_CORES')  # power consumption of all cores on socket
+        if self.monitor['gpu']  : rapl.append('RAPL_ENERGY_GPU')  # power consumption of GPU
+        events = {'rapl': rapl,
+                  'msr': ['TSC', 'APERF', 'MPERF'],
+                  'core': [# (TODO) does not seem to work properly this part
+                           # (TODO) check possible event names depending on cpu architecture
+                           #'CPU_CLK_THREAD_UNHALTED:REF_P', ## nehalem & westmere
+                           #'CPU_CLK_THREAD_UNHALTED:THREAD_P', ## nehalem & westmere
+                           #'CPU_CLK_THREAD_UNHALTED.REF_XCLK', # sandy -> broadwell archi, not scaled!
+                           #'CPU_CLK_THREAD_UNHALTED.REF_XCLK', # skylake and newer, must be scale by x4 base ratio.
+                           'CPU_CLK_UNHALTED',
+                           'LLC_MISSES', 'INSTRUCTIONS_RETIRED']}
+        events.update(self.events)
+        events.update(self.hostname_to_events.get(hostname, {}))
+        return events
+
+    def _get_sensor_name(self, hostname: str) -> str:
+        """Get the name of the sensor of a host, as tagged in reports."""
+        return f'sensor-{hostname.split(".")[0]}'
+
+    def _get_formulas(self):
+        """Compute the specification of each SmartWatts formula of the
+        plan, and group them by the inventory hostname of the host running
+        them so a single play starts them all."""
+        self.hostname_to_formulas = {}
+        for shard in self.plan.shards:
+            cpu = shard['cpu']
+            mongo_addr = self._get_address(shard['mongo'])
+            spec = {
+                'name': shard['name'],
+                'mongo': mongo_addr,
+                'mongo_uri': f'mongodb://{mongo_addr}:{MONGODB_PORT}',
+                'collection': shard['collection'],
+                'influxdb': self._get_address(shard['influxdb']),
+                'database': shard['database'],
+                'cpu_nom': cpu.cpu_nom, 'cpu_min': cpu.cpu_min, 'cpu_max': cpu.cpu_max,
+            }
+            spec['command'] = self._get_formula_command(spec)
+            spec['digest'] = self._get_digest(SMARTWATTS_IMAGE, spec['command'])
+            spec['container'] = FORMULAS_CONTAINER if self.consolidate_formulas else spec['name']
+            self.hostname_to_formulas.setdefault(shard['formula'].alias, []).append(spec)
+
+        if self.consolidate_formulas:
+            ## the container changes whenever any of its formulas does
+            for formulas in self.hostname_to_formulas.values():
+                digest = self._get_digest(SMARTWATTS_IMAGE, [formula['command'] for formula in formulas])
+                for formula in formulas:
+                    formula['digest'] = digest
+
+    def _get_formulas_script(self, formulas: List[Dict]) -> str:
+        """Build the shell script of a container that runs several
+        formulas, one process each. The container stops as soon as one of
+        them stops, so the failure is visible (see monitor.py).
+        Args:
+            formulas: the specifications of the formulas (see _get_formulas)
+        Returns:
+            The script, run by sh -c.
+        """
+        lines = ['pids=""', 'trap \'kill $pids 2>/dev/null; exit 0\' TERM INT']
+        lines.extend(f'{SMARTWATTS_ENTRYPOINT} {formula["command"]} & pids="$pids $!"'
+                     for formula in formulas)
+        lines.append('while true; do for pid in $pids; do kill -0 $pid 2>/dev/null || '
+                     '{ kill $pids 2>/dev/null; exit 1; }; done; sleep 5; done')
+        return '; '.join(lines)
+
+    def _get_formula_command(self, spec) -> str:
+        """Build the command line of a SmartWatts formula.
+        Args:
+            spec: the specification of the formula (see _get_formulas).
+        Returns:
+            A string representing the arguments of the formula container.
+        """
+        command=['-s',
+                 '--input mongodb --model HWPCReport',
+                 f'--uri {spec["mongo_uri"]}',
+                 f'-d {SENSORS_OUTPUT_DB_NAME} -c {spec["collection"]}',
+                 # f"--output influxdb --name hwpc --model HPWCReport",
+                 # f"--uri {influxdbs_addr} --port {INFLUXDB_PORT} --db hwpc_report",
+                 f'--output influxdb --name {spec["database"]} --model PowerReport',
+                 f'--uri {spec["influxdb"]} --port {INFLUXDB_PORT} --db {spec["database"]}',
+                 # vvv Formula report does not have to_influxdb (yet?)
+                 #f"--output influxdb --name formula --model FormulaReport",
+                 #f"--uri {influxdbs_addr} --port {INFLUXDB_PORT} --db formula_report",
+                 '--formula smartwatts', f'--cpu-ratio-base {spec["cpu_nom"]}',
+                 f'--cpu-ratio-min {spec["cpu_min"]}', f'--cpu-ratio-max {spec["cpu_max"]}',
+                 f'--cpu-error-threshold {SMARTWATTS_CPU_ERROR_THRESHOLD}',
+                 f'--dram-error-threshold {SMARTWATTS_DRAM_ERROR_THRESHOLD}',]
+        if not self.monitor['cores']: command.append('--disable-cpu-formula')
+        if not self.monitor['dram'] : command.append('--disable-dram-formula')
+        return ' '.join(command)
+
+    def _get_containers(self) -> Dict[str, Dict[str, str]]:
+        """Compute the containers that each host must run.
+        Returns:
+            A dictionary inventory hostname -> container name -> digest of
+            the specification of the container (image, command, …).
+        """
+        containers = {}
+        def add(hostname, name, digest):
+            containers.setdefault(hostname, {})[name] = digest
+
+        for host in self.mongos:
+            add(host.alias, 'mongodb', self._get_digest(MONGODB_IMAGE, self.storage, self.data_dir))
+        for host in self.influxdbs:
+            add(host.alias, 'influxdb', self._get_digest(INFLUXDB_IMAGE, self.storage, self.data_dir))
+        for hostname, command in self.hostname_to_sensor.items():
+            add(hostname, 'powerapi-sensor',
+                self._get_digest(HWPCSENSOR_IMAGE, HWPCSENSOR_VOLUMES, command))
+        for hostname, formulas in self.hostname_to_formulas.items():
+            for formula in formulas:
+                add(hostname, formula['container'], formula['digest'])
+        for host in self._roles['grafana']:
+            add(host.alias, 'grafana', self._get_digest(GRAFANA_IMAGE, self.data_dir,
+                                                        get_digest(self._get_grafana_topology())))
+        return containers
+
+    def _reconcile(self, containers: Dict[str, Dict[str, str]]):
+        """Compare the desired containers with the running ones.
+        Args:
+            containers: the desired containers (see _get_containers).
+        Returns:
+            A pair of dictionaries inventory hostname -> container names:
+            the containers to (re)create, and the obsolete ones to remove.
+        """
+        ## containers deployed by this service carry the digest of
+        ## their specification as label
+        result = run_command(
+            "docker ps -a --filter label=" + SPEC_LABEL + " --format '{% raw %}"
+            "{{.Names}} {{.Label \"" + SPEC_LABEL + "\"}} {{.Status}}{% endraw %}' || true",
+            pattern_hosts='all', roles=self._roles, on_error_continue=True)
+        running = {}
+        for hostname, output in result['ok'].items():
+            for line in (output['stdout'] or '').splitlines():
+                name, digest, status = line.split(' ', maxsplit=2)
+                running.setdefault(hostname, {})[name] = digest if status.startswith('Up') else None
+
+        to_deploy = {hostname: [name for name, digest in names.items()
+                                if running.get(hostname, {}).get(name) != digest]
+                     for hostname, names in containers.items()}
+        to_remove = {hostname: [name for name in names
+                                if name not in containers.get(hostname, {})]
+                     for hostname, names in running.items()}
+
+        self._add_dependents(to_deploy)
+
+        logging.info(f'Containers to (re)create: {to_deploy}')
+        logging.info(f'Containers to remove: {to_remove}')
+        return to_deploy, to_remove
+
+    def _add_dependents(self, to_deploy: Dict[str, List[str]]):
+        """Add to the containers to (re)create those that depend on them.
+        Args:
+            to_deploy: the names of the containers to (re)create by
+                inventory hostname, modified in place
+        """
+        ## MongoDB -> SmartWatts: sensors and formulas crash when their
+        ## databases restart under them, so they restart as well
+        new_mongos = {self._get_address(host) for host in self.mongos
+                      if 'mongodb' in to_deploy.get(host.alias, [])}
+        new_influxdbs = {self._get_address(host) for host in self.influxdbs
+                         if 'influxdb' in to_deploy.get(host.alias, [])}
+        for hostname, mongo in self.hostname_to_mongo.items():
+            if mongo in new_mongos and 'powerapi-sensor' not in to_deploy.get(hostname, []):
+                to_deploy.setdefault(hostname, []).append('powerapi-sensor')
+        for hostname, formulas in self.hostname_to_formulas.items():
+            for formula in formulas:
+                if ((formula['mongo'] in new_mongos or formula['influxdb'] in new_influxdbs) and
+                    formula['container'] not in to_deploy.get(hostname, [])):
+                    to_deploy.setdefault(hostname, []).append(formula['container'])
+
+    def _get_digest(self, *spec) -> str:
+        """Get a short digest that identifies the specification of a
+        container."""
+        return hashlib.sha256(json.dumps(spec).encode()).hexdigest()[:16]
+
+    def _as_list(self, hosts) -> List[Host]:
+        """Get the hosts of a role that may be a single host, or none."""
+        if hosts is None:
+            return []
+        return hosts if isinstance(hosts, list) else [hosts]
+
     def _get_address(self, host) -> str:
         """Get the IP address of the host.
         Args:
@@ -348,19 +982,23 @@ class Energy (Service):
         Returns:
             A string representing the ip address of the host.
         """
+        if isinstance(host, Node): ## of a saved deployment, already resolved
+            return host.address
         # This assumes that `discover_network` has been run before
         # otherwise, extra is not set properly
         return host.address if self.network is None else host.extra[self.network + "_ip"]
 
-    def _get_smartwatts_name(self, cpu):
-        return 'smartwatts_' + cpu.cpu_shortname ## (TODO) remove this function
-
 
             
     def destroy(self):
         """ Destroy the energy monitoring stack. This destroys all
         containers."""
         self._get_cpus()
+        ## during a deployment, the plan of the cpus stage is read by the
+        ## sizing stage concurrently: it is not replaced
+        if self.plan is None:
+            self._get_plan()
+            self._get_formulas()
                 
         with play_on(pattern_hosts="grafana", roles=self._roles) as p:
             p.docker_container(
@@ -374,18 +1012,14 @@ class Energy (Service):
                 force_kill=True,
             )
 
-        i = 0
-        for cpu_name, cpu in self.cpuname_to_cpu.items():
-            with play_on(pattern_hosts =
-                         self._get_address(self.formulas[i%len(self.formulas)]),
-                         roles = self._roles) as p:
-                smartwatts_name = self._get_smartwatts_name(cpu)
-                p.docker_container(
-                    display_name="Destroying SmartWatts…",
-                    name=f"{smartwatts_name}", state="absent",
-                    force_kill=True,
-                )
-            ++i
+        with play_on(pattern_hosts="formulas", roles=self._roles,
+                     extra_vars={'ansible_hostname_to_formulas': self.hostname_to_formulas}) as p:
+            p.docker_container(
+                display_name="Destroying SmartWatts…",
+                name="{{item.container}}", state="absent",
+                force_kill=True,
+                loop="{{ansible_hostname_to_formulas[inventory_hostname] | default([])}}",
+            )
         
         with play_on(pattern_hosts="mongos", roles=self._roles) as p:
             p.docker_container(
@@ -401,6 +1035,170 @@ class Energy (Service):
 
 
 
-    def backup(self):
-        logging.warning("No backup performed")
+    def save(self, path: str = STATE_PATH):
+        """Save what the deployment is made of (hosts, cpus, databases of
+        sensored hosts, formulas), so it can be inspected and its results
+        read without deploying again, e.g. by `python -m energyservice`."""
+        endpoints = [{'role': role, 'alias': host.alias, 'address': self._get_address(host),
+                      'port': port}
+                     for role, port in (('mongos', MONGODB_PORT), ('influxdbs', INFLUXDB_PORT),
+                                        ('grafana', GRAFANA_PORT))
+                     for host in self._roles.get(role, [])]
+        DeploymentState(
+            roles={role: [Node(host.alias, self._get_address(host)) for host in hosts]
+                   for role, hosts in self._roles.items()},
+            hostname_to_cpu=self.hostname_to_cpu,
+            hostname_to_mongo=self.hostname_to_mongo,
+            hostname_to_influxdb=self.hostname_to_influxdb,
+            hostname_to_formulas={hostname: [{key: formula[key] for key in STATE_FORMULA_KEYS}
+                                             for formula in formulas]
+                                  for hostname, formulas in self.hostname_to_formulas.items()},
+            hostname_to_sensor_name={hostname: self._get_sensor_name(hostname)
+                                     for hostname in self.hostname_to_cpu},
+            endpoints=endpoints, strategy=self.strategy,
+            frequency_ms=self.frequency_ms).save(path)
+
+    def load(self, path: str = STATE_PATH):
+        """Restore the cpus, plan, databases, and formulas of a saved
+        deployment (see save), e.g. to read its results from another
+        process. The service must have the roles of the deployment to
+        monitor or redeploy it (see health_monitor, redeploy)."""
+        state = DeploymentState.load(path)
+        self.hostname_to_cpu = state.hostname_to_cpu
+        self.cpuname_to_cpu = {cpu.cpu_name: cpu for cpu in state.hostname_to_cpu.values()}
+        ## the plan of the saved hosts, whose addresses are resolved
+        self.plan = state.get_plan()
+        ## the databases of sensors, formulas, and containers, as
+        ## deploying this plan computes them
+        self._get_sensors()
+        self._get_formulas()
+        self._containers = self._get_containers()
+
+    def container_energy(self, container: Union[str, List[str]], start: Time, end: Time,
+                         host: Optional[Host] = None, max_gap: float = MAX_GAP,
+                         ) -> Dict[str, Dict[str, float]]:
+        """Compute the energy consumed by containers during a phase of
+        an experiment, by integrating their power over time.
+
+        Args:
+            container: the name, or the list of names, of containers
+            start: beginning of the phase (datetime or seconds since epoch)
+            end: end of the phase (datetime or seconds since epoch)
+            host: only account for the consumption measured on this host
+            max_gap: number of seconds between two reports above which the
+                interval is a sampling gap, and is not integrated
+        Returns:
+            A dictionary container -> socket -> energy in joules.
+        """
+        containers = [container] if isinstance(container, str) else container
+        sensor = None if host is None else self._get_sensor_name(host.alias)
+        return EnergyReader(self).read_energy(start, end, containers,
+                                              sensor=sensor, max_gap=max_gap)
+
+    def region(self, name: str, containers: Optional[List[str]] = None,
+               hosts: Optional[List[Host]] = None, **kwargs):
+        """Measure the energy of a phase of an experiment, as a context
+        manager or a decorator. The start and end of the region are
+        written in the power databases, and shown as annotations in
+        Grafana; its energy is computed in background once it is closed:
+
+            with energy.region('warmup', containers=['meow-world']) as warmup:
+                …
+            warmup.energy.result() # container -> socket -> joules
+
+        Args:
+            name: the name of the region, e.g. the phase of the experiment
+            containers: the containers whose energy is computed, all if None
+            hosts: the hosts running the containers, to only write in their
+                databases; all databases if None
+            kwargs: the options of :py:class:`RegionRecorder` (region.py),
+                applied when the first region is created
+        Returns:
+            A :py:class:`Region`.
+        """
+        if self._region_recorder is None:
+            self._region_recorder = RegionRecorder(self, **kwargs)
+        return self._region_recorder.region(name, containers, hosts=hosts)
+
+    def stream_power(self, targets: Optional[List[str]] = None, **kwargs):
+        """Follow the power reports of targets as they are written, e.g.,
+        to react to the energy of an experiment while it runs:
+
+            async for batch in energy.stream_power(['meow-world']):
+                for (sensor, target), (timestamps, power) in batch.items(): …
+
+        Args:
+            targets: the targets (e.g. container names) to follow, all if None
+            kwargs: the options of :py:class:`PowerStream` (stream.py)
+        Returns:
+            An async generator of batches of new reports, i.e., dictionaries
+            (sensor, target) -> (timestamps in ns, power in watts).
+        """
+        from stream import PowerStream
+        return PowerStream(EnergyReader(self), targets=targets, **kwargs).batches()
+
+    def health_monitor(self, **kwargs):
+        """Get a monitor that checks that the deployed stack is alive
+        and recreates its failed containers, either once (check) or in
+        background (start, stop).
+        Args:
+            kwargs: the options of :py:class:`HealthMonitor` (monitor.py)
+        """
+        from monitor import HealthMonitor
+        return HealthMonitor(self, **kwargs)
+
+    def backup(self, backup_dir: str = BACKUP_DIR):
+        """Export the reports of sensors (MongoDBs) and the power reports
+        of formulas (InfluxDBs) to compressed parquet files, one per CPU
+        model and measurement. Hosts are exported concurrently, and data
+        are streamed in batches. Exported files are loaded back with
+        backup.iter_backup or backup.load_power.
+
+        Args:
+            backup_dir: the local directory of exported files
+        """
+        ## optional dependency (pyarrow) only needed to backup
+        from backup import export_hwpc, export_influxdb
+
+        self._get_cpus()
+        self._get_plan()
+        self._get_formulas()
+        path = Path(backup_dir)
+        path.mkdir(parents=True, exist_ok=True)
+
+        hostname_to_collections = {}
+        for shard in self.plan.shards:
+            hostname_to_collections.setdefault(shard['mongo'].alias, []).append(shard['collection'])
+
+        def backup_mongos():
+            loop = '{{ansible_hostname_to_collections.get(inventory_hostname, [])}}'
+            with play_on(pattern_hosts='mongos', roles=self._roles,
+                         extra_vars={'ansible_hostname_to_collections': hostname_to_collections}) as p:
+                p.shell('docker exec mongodb mongoexport --quiet '
+                        f'--db {SENSORS_OUTPUT_DB_NAME} --collection {{{{item}}}} '
+                        '| gzip > /tmp/{{item}}.json.gz',
+                        display_name='Exporting sensor reports…', loop=loop)
+                p.fetch(display_name='Retrieving sensor reports…',
+                        src='/tmp/{{item}}.json.gz', dest=f'{path.resolve()}/{{{{item}}}}.json.gz',
+                        flat=True, loop=loop)
+                p.file(path='/tmp/{{item}}.json.gz', state='absent', loop=loop)
+
+            for collections in hostname_to_collections.values():
+                for collection in collections:
+                    source = path / f'{collection}.json.gz'
+                    rows = export_hwpc(source, path / f'{SENSORS_OUTPUT_DB_NAME}.{collection}.parquet')
+                    source.unlink()
+                    logging.info(f'Exported {rows} rows of {SENSORS_OUTPUT_DB_NAME}.{collection}')
+
+        def backup_influxdb(database):
+            rows = export_influxdb(reader, database, path / f'{database}.power_consumption.parquet')
+            logging.info(f'Exported {rows} power reports of {database}')
+
+        reader = EnergyReader(self)
+        with ThreadPoolExecutor() as executor:
+            futures = [executor.submit(backup_mongos)]
+            futures.extend(executor.submit(backup_influxdb, database)
+                           for database in reader.databases)
+            for future in futures:
+                future.result()
 
@@ -62,8 +62,7 @@ with play_on(pattern_hosts='compute', roles=roles) as p:
 
 
 with play_on(pattern_hosts='compute', roles=roles,
-             extra_vars={'ansible_hostname_to_cpu': m.hostname_to_cpu,
-                         'ansible_hostname_to_influxdb': m.hostname_to_influxdb}) as p:
+             extra_vars=m.index.get_extra_vars()) as p:
     p.docker_container(
         display_name='Installing meow-world service…',
         name='meow-world-{{inventory_hostname_short}}',
@@ -73,8 +72,8 @@ with play_on(pattern_hosts='compute', roles=roles,
         published_ports=['8080:8080'],
         cpuset_cpus="0-1",
         env={
-            'MONITORING_ENERGY': 'http://{{ansible_hostname_to_influxdb[inventory_hostname]}}:8086',
-            'MONITORING_ENERGY_DB': 'power_{{ansible_hostname_to_cpu[inventory_hostname].cpu_shortname}}',
+            'MONITORING_ENERGY': m.index.template('influx_url'),
+            'MONITORING_ENERGY_DB': m.index.template('database'),
             'MONITORING_ENERGY_CONTAINER': 'meow-world',
         },
     )
@@ -0,0 +1,152 @@
+import copy
+import hashlib
+import json
+import re
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Dict, List
+
+from reader import POWER_MEASUREMENT
+from rollup import get_measurement, ROLLUP_POLICY
+from region import MEASUREMENT as REGION_MEASUREMENT
+
+import logging
+
+
+
+GRAFANA_CACHE_PATH = './_tmp_enos_/grafana'
+DASHBOARD_TEMPLATE = 'grafana_dashboard.json'
+PROVISIONING_DIR = '/etc/grafana/provisioning' # in the container
+EXCLUDED_TARGETS = ('global', 'powerapi-sensor', 'rapl')
+PANEL_HEIGHT = 10
+PANELS_PER_ROW = 2 # panels of clusters side by side
+
+
+
+def get_digest(topology: Dict) -> str:
+    """Get a short digest that identifies the provisioning files of a
+    topology, and of the dashboard template they derive from."""
+    digest = hashlib.sha256(json.dumps(topology, sort_keys=True).encode())
+    digest.update(Path(DASHBOARD_TEMPLATE).read_bytes())
+    return digest.hexdigest()[:12]
+
+def provision(topology: Dict, path: str = GRAFANA_CACHE_PATH) -> Path:
+    """Get the local directory of the provisioning files of Grafana,
+    generated only when the topology changes.
+    Args:
+        topology: the datasources, panels, and rollups of the dashboard,
+            see :py:meth:`Energy._get_grafana_topology`
+        path: the directory holding the generated files by digest
+    Returns:
+        The directory to mount as /etc/grafana/provisioning.
+    """
+    directory = Path(path) / get_digest(topology)
+    if directory.exists():
+        logging.debug(f'Grafana provisioning found in {directory}')
+        return directory
+
+    ## a unique temporary directory per writer, renamed once complete
+    Path(path).mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f'.{directory.name}.', suffix='.tmp', dir=path))
+    tmp.chmod(0o755) ## readable by Grafana, unlike mkdtemp's default
+    (tmp / 'datasources').mkdir()
+    (tmp / 'dashboards').mkdir()
+    ## json is yaml
+    (tmp / 'datasources' / 'energyservice.yaml').write_text(
+        json.dumps(get_datasources(topology), indent=2))
+    (tmp / 'dashboards' / 'energyservice.yaml').write_text(json.dumps({
+        'apiVersion': 1,
+        'providers': [{'name': 'energyservice', 'type': 'file', 'disableDeletion': False,
+                       'allowUiUpdates': True,
+                       'options': {'path': f'{PROVISIONING_DIR}/dashboards'}}]}, indent=2))
+    (tmp / 'dashboards' / 'energyservice.json').write_text(
+        json.dumps(get_dashboard(topology), indent=2))
+    try:
+        tmp.rename(directory)
+    except OSError: ## generated meanwhile by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+    logging.debug(f'Grafana provisioning generated in {directory}')
+    return directory
+
+def get_datasources(topology: Dict) -> Dict:
+    """Get the provisioning of datasources, one per CPU model."""
+    return {'apiVersion': 1,
+            'datasources': [{'name': datasource['name'], 'type': 'influxdb',
+                             'access': 'proxy', 'url': datasource['url'],
+                             'database': datasource['database'],
+                             'isDefault': index == 0, 'editable': False}
+                            for index, datasource in enumerate(topology['datasources'])]}
+
+def get_dashboard(topology: Dict) -> Dict:
+    """Get the dashboard of all containers: a row per CPU model, and a
+    panel per cluster of this model."""
+    with open(DASHBOARD_TEMPLATE, 'r') as f:
+        dashboard = json.load(f)['dashboard']
+    template = dashboard['panels'][0]
+    rollups = topology['rollups']
+
+    panels, y = [], 0
+    cpuname_to_panels: Dict[str, List[Dict]] = {}
+    for panel in topology['panels']:
+        cpuname_to_panels.setdefault(panel['cpu_name'], []).append(panel)
+    for cpu_name, cpu_panels in cpuname_to_panels.items():
+        panels.append({'type': 'row', 'title': cpu_name, 'collapsed': False, 'panels': [],
+                       'id': len(panels) + 1, 'gridPos': {'h': 1, 'w': 24, 'x': 0, 'y': y}})
+        y += 1
+        width = 24 // min(PANELS_PER_ROW, len(cpu_panels))
+        for index, panel in enumerate(cpu_panels):
+            graph = copy.deepcopy(template)
+            graph.update({'id': len(panels) + 1, 'datasource': panel['datasource'],
+                          'title': f'{template["title"]} on {panel["cluster"]}',
+                          'targets': [_get_target(panel, rollups)],
+                          'gridPos': {'h': PANEL_HEIGHT, 'w': width,
+                                      'x': index % PANELS_PER_ROW * width,
+                                      'y': y + index // PANELS_PER_ROW * PANEL_HEIGHT}})
+            panels.append(graph)
+        y += (len(cpu_panels) + PANELS_PER_ROW - 1) // PANELS_PER_ROW * PANEL_HEIGHT
+    dashboard['panels'] = panels
+
+    if rollups:
+        dashboard['templating']['list'].append(_get_interval_variable(rollups))
+    dashboard['annotations']['list'].extend(_get_region_annotation(datasource['name'])
+                                            for datasource in topology['datasources'])
+    return dashboard
+
+def _get_target(panel: Dict, rollups: List[str]) -> Dict:
+    """Get the Grafana target that reads the power consumption of the
+    containers of the sensors of a panel, from the rollup of the
+    resolution chosen by the $interval variable of the dashboard, if any."""
+    conditions = [f'"target" != \'{target}\'' for target in EXCLUDED_TARGETS]
+    if panel['sensors'] is not None:
+        sensors = '|'.join(re.escape(sensor) for sensor in panel['sensors'])
+        conditions.append(f'"sensor" =~ /^({sensors})$/')
+    if rollups:
+        source, interval = f'"{ROLLUP_POLICY}"."{get_measurement("$interval")}"', '$interval'
+    else:
+        source, interval = f'"{POWER_MEASUREMENT}"', '$__interval'
+    return {'datasource': panel['datasource'], 'rawQuery': True,
+            'query': (f'SELECT mean("power") FROM {source} WHERE {" AND ".join(conditions)} '
+                      f'AND $timeFilter GROUP BY time({interval}), "target" fill(null)'),
+            'refId': 'A', 'resultFormat': 'time_series'}
+
+def _get_interval_variable(rollups: List[str]) -> Dict:
+    """Get the $interval variable of the dashboard, whose options are
+    the rollups; zooming out should go with a coarser rollup."""
+    options = [{'selected': index == 0, 'text': rollup, 'value': rollup}
+               for index, rollup in enumerate(rollups)]
+    ## no auto option: grafana rounds auto intervals to values (e.g.,
+    ## 20s, 2m) that may not be rollups
+    return {'name': 'interval', 'label': 'Resolution', 'type': 'interval',
+            'query': ','.join(rollups), 'auto': False,
+            'auto_count': 30, 'auto_min': rollups[0],
+            'current': dict(options[0]), 'options': options,
+            'hide': 0, 'refresh': 2, 'skipUrlSync': False}
+
+def _get_region_annotation(datasource: str) -> Dict:
+    """Get the Grafana annotation that shows the start and end of
+    regions (see region.py) written in the database of a datasource."""
+    return {'name': f'Regions {datasource}', 'datasource': datasource,
+            'enable': True, 'iconColor': 'rgba(255, 96, 96, 1)',
+            'query': f'SELECT "text", "containers" FROM "{REGION_MEASUREMENT}" WHERE $timeFilter',
+            'textColumn': 'text', 'tagsColumn': 'region'}
@@ -0,0 +1,12 @@
+"""Escaping of the line protocol of InfluxDB, shared by the modules
+that write points (timing.py, region.py)."""
+
+
+
+def escape_tag(value) -> str:
+    """Escape a measurement, tag key, or tag value of the line protocol."""
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+def quote_field(value: str) -> str:
+    """Quote a string field value of the line protocol."""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
@@ -0,0 +1,237 @@
+import asyncio
+import shlex
+import threading
+import time
+from typing import Dict, List, Optional, Set
+
+from energy import SPEC_LABEL, MONGODB_PORT, INFLUXDB_PORT, GRAFANA_PORT
+from reader import EnergyReader, POWER_MEASUREMENT
+
+import logging
+
+
+
+CHECK_INTERVAL = 60. # seconds between two checks of the background monitor
+PROBE_TIMEOUT = 5. # seconds after which a probe fails
+FRESHNESS = 30. # seconds without report after which a sensor is stale
+MAX_SSH = 64 # concurrent ssh connections
+
+ROLE_TO_ENDPOINT = {'mongos': ('mongodb', MONGODB_PORT),
+                    'influxdbs': ('influxdb', INFLUXDB_PORT),
+                    'grafana': ('grafana', GRAFANA_PORT)}
+
+
+
+class HealthMonitor:
+    """Check that the containers of an :py:class:`Energy` stack are
+    alive and well, and recreate the failed ones. A check probes all
+    endpoints, lists the containers of all hosts, and reads the latest
+    reports of all databases concurrently, so it lasts about the slowest
+    probe whatever the number of hosts.
+
+    It runs either as a one-shot check (check), or in a background
+    thread (start, stop)."""
+    def __init__(self, energy, *, interval: float = CHECK_INTERVAL,
+                 timeout: float = PROBE_TIMEOUT, freshness: float = FRESHNESS,
+                 recover: bool = True, max_ssh: int = MAX_SSH):
+        """Args:
+            energy: the deployed :py:class:`Energy` service
+            interval: number of seconds between two background checks
+            timeout: number of seconds after which a probe fails
+            freshness: number of seconds without power report after which
+                a sensor is considered failed; must exceed the time that
+                the stack takes to produce its first reports
+            recover: recreate failed containers in the background
+            max_ssh: maximum number of concurrent ssh connections"""
+        self.energy = energy
+        self.interval = interval
+        self.timeout = timeout
+        self.freshness = freshness
+        self.recover_failed = recover
+        self.max_ssh = max_ssh
+        self.last_report: Optional[Dict] = None
+        self.recoveries: List[Dict] = [] # reports that led to a recovery
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _get_hosts(self) -> Dict:
+        """Get the hosts of the stack by inventory hostname."""
+        return {host.alias: host for hosts in self.energy._roles.values() for host in hosts}
+
+    async def probe(self, address: str, port: int) -> bool:
+        """Check that a TCP endpoint accepts connections."""
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(address, port),
+                                               self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return False
+        writer.close()
+        return True
+
+    def _get_ssh_command(self, host, command: str) -> List[str]:
+        args = ['ssh', '-o', 'BatchMode=yes', '-o', 'StrictHostKeyChecking=no',
+                '-o', f'ConnectTimeout={max(1, int(self.timeout))}']
+        if host.port is not None:
+            args.extend(['-p', str(host.port)])
+        if host.keyfile is not None:
+            args.extend(['-i', str(host.keyfile)])
+        ## e.g., a jump host
+        args.extend(shlex.split(host.extra.get('ansible_ssh_common_args', '')))
+        args.append(host.address if host.user is None else f'{host.user}@{host.address}')
+        return args + [command]
+
+    async def ssh(self, host, command: str, semaphore: asyncio.Semaphore) -> Optional[str]:
+        """Run a command on a host.
+        Returns: its standard output, None if it failed."""
+        async with semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *self._get_ssh_command(host, command), stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), 2 * self.timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                logging.debug(f'ssh to {host.alias} timed out')
+                return None
+        if process.returncode != 0:
+            logging.debug(f'ssh to {host.alias} failed: {stderr.decode(errors="replace").strip()}')
+            return None
+        return stdout.decode(errors='replace')
+
+    async def _get_running(self, host, semaphore: asyncio.Semaphore) -> Optional[Set[str]]:
+        """Get the names of the running containers of the stack on a host,
+        None if the host is unreachable."""
+        stdout = await self.ssh(host, f"docker ps --filter label={SPEC_LABEL} "
+                                      "--format '{{.Names}}'", semaphore)
+        return None if stdout is None else set(stdout.split())
+
+    async def _get_fresh_sensors(self) -> Optional[Set[str]]:
+        """Get the names of sensors that recently produced power reports,
+        None if a database cannot be read."""
+        reader = EnergyReader(self.energy, timeout=self.timeout)
+        query = (f'SELECT last(power) FROM {POWER_MEASUREMENT} '
+                 f'WHERE time > now() - {int(self.freshness)}s GROUP BY sensor')
+        def read(database):
+            return {series.get('tags', {}).get('sensor')
+                    for series in reader.query(database, query)}
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(None, read, database)
+                                         for database in reader.databases],
+                                       return_exceptions=True)
+        sensors = set()
+        for database, result in zip(reader.databases, results):
+            if isinstance(result, BaseException):
+                logging.debug(f'Could not read {database}: {result!r}')
+                return None
+            sensors |= result
+        return sensors
+
+    async def check_async(self) -> Dict:
+        """Check the health of the stack, see check."""
+        start = time.monotonic()
+        energy = self.energy
+        hosts = self._get_hosts()
+
+        endpoints = [(host, name, port) for role, (name, port) in ROLE_TO_ENDPOINT.items()
+                     for host in energy._roles.get(role, [])]
+        semaphore = asyncio.Semaphore(self.max_ssh)
+        aliases = list(energy._containers)
+        probes, runnings, fresh = await asyncio.gather(
+            asyncio.gather(*[self.probe(energy._get_address(host), port)
+                             for host, _, port in endpoints]),
+            asyncio.gather(*[self._get_running(hosts[alias], semaphore) for alias in aliases]),
+            self._get_fresh_sensors())
+
+        failed: Dict[str, Set[str]] = {}
+        report = {'time': time.time(), 'endpoints': {}, 'unreachable': [],
+                  'stale': [], 'failed': failed}
+        for (host, name, port), ok in zip(endpoints, probes):
+            report['endpoints'][f'{host.alias}:{port}'] = ok
+            if not ok:
+                failed.setdefault(host.alias, set()).add(name)
+
+        for alias, running in zip(aliases, runnings):
+            if running is None:
+                report['unreachable'].append(alias)
+                continue
+            missing = set(energy._containers[alias]) - running
+            if missing:
+                failed.setdefault(alias, set()).update(missing)
+
+        ## sensors alive but without reports; formulas whose sensors all
+        ## went silent are the likely culprits
+        if fresh is not None and energy.plan is not None:
+            name_to_container = {formula['name']: formula['container']
+                                 for formulas in energy.hostname_to_formulas.values()
+                                 for formula in formulas}
+            for shard in energy.plan.shards:
+                stale = [hostname for hostname in shard['hostnames']
+                         if energy._get_sensor_name(hostname) not in fresh]
+                report['stale'].extend(stale)
+                for hostname in stale:
+                    failed.setdefault(hostname, set()).add('powerapi-sensor')
+                if stale and len(stale) == len(shard['hostnames']):
+                    failed.setdefault(shard['formula'].alias, set()).add(
+                        name_to_container.get(shard['name'], shard['name']))
+
+        report['failed'] = {alias: sorted(names) for alias, names in failed.items()}
+        report['duration'] = time.monotonic() - start
+        return report
+
+    def check(self) -> Dict:
+        """Check the health of the stack once.
+        Returns:
+            A report, i.e., a dictionary with the state of each endpoint
+            (endpoints), hosts that cannot be reached by ssh (unreachable),
+            sensored hosts without recent reports (stale), and the
+            containers to recreate by inventory hostname (failed).
+        """
+        self.last_report = asyncio.run(self.check_async())
+        return self.last_report
+
+    def recover(self, report: Dict):
+        """Recreate the failed containers of a report only (see
+        :py:meth:`Energy.redeploy`). Containers that still run are removed
+        first, so they are recreated."""
+        failed = {alias: names for alias, names in report['failed'].items()
+                  if alias not in report['unreachable']}
+        if not failed:
+            return
+        for alias, names in failed.items():
+            logging.warning(f'Recovering {", ".join(names)} on {alias}…')
+
+        hosts = self._get_hosts()
+        async def remove():
+            semaphore = asyncio.Semaphore(self.max_ssh)
+            await asyncio.gather(*[self.ssh(hosts[alias], f'docker rm -f {" ".join(names)}', semaphore)
+                                   for alias, names in failed.items()])
+        asyncio.run(remove())
+        self.energy.redeploy(failed)
+        self.recoveries.append(report)
+        logging.info(f'Recovered {sum(len(names) for names in failed.values())} containers.')
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                report = self.check()
+                logging.debug(f'Health check done in {report["duration"]:.2f}s')
+                if report['failed'] and self.recover_failed:
+                    self.recover(report)
+            except Exception:
+                logging.exception('Health check failed')
+
+    def start(self):
+        """Check the health of the stack every interval seconds in a
+        background thread, and recover failed containers."""
+        assert self._thread is None, 'The monitor is already running'
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='energy-monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread, once its current check is over."""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
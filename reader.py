@@ -0,0 +1,333 @@
+import numpy as np # 1.19.5
+
+import json
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import logging
+
+
+
+INFLUXDB_PORT = 8086
+POWER_MEASUREMENT = 'power_consumption'
+CHUNK_SIZE = 10000 # points per chunk of the influxdb response
+MAX_GAP = 5. # seconds without report after which power is unknown
+
+Time = Union[int, float, datetime, None] # datetime or seconds since epoch
+
+
+
+class EnergyReader:
+    """Read back the power reports of SmartWatts from the InfluxDBs of
+    an :py:class:`Energy` stack. Responses are streamed in chunks, so
+    memory stays bounded whatever the size of the experiment."""
+    def __init__(self, energy, *, chunk_size: int = CHUNK_SIZE,
+                 max_workers: Optional[int] = None, timeout: float = 60):
+        """Args:
+            energy: the deployed :py:class:`Energy` service
+            chunk_size: number of points per chunk of responses
+            max_workers: maximum number of databases read concurrently
+            timeout: timeout of http requests in seconds"""
+        self.chunk_size = chunk_size
+        self.max_workers = max_workers
+        self.timeout = timeout
+        ## database -> url of the influxdb storing it
+        self.databases: Dict[str, str] = {
+            formula['database']: f'http://{formula["influxdb"]}:{INFLUXDB_PORT}'
+            for formulas in energy.hostname_to_formulas.values()
+            for formula in formulas}
+
+    def query(self, database: str, query: str) -> Iterator[Dict]:
+        """Stream the series of an InfluxQL query, chunk by chunk.
+        Args:
+            database: the name of the database, e.g. power_<cpu_shortname>
+            query: the InfluxQL query
+        Returns:
+            An iterator over partial series (name, tags, columns, values),
+            with timestamps in nanoseconds since epoch.
+        """
+        params = urllib.parse.urlencode({'db': database, 'q': query, 'epoch': 'ns',
+                                         'chunked': 'true', 'chunk_size': self.chunk_size})
+        url = f'{self.databases[database]}/query?{params}'
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            ## each line is a self-contained json chunk
+            for line in response:
+                if not line.strip():
+                    continue
+                for result in json.loads(line).get('results', []):
+                    if 'error' in result:
+                        raise RuntimeError(f'InfluxDB error on {database}: {result["error"]}')
+                    yield from result.get('series', [])
+
+    def iter_power(self, database: str, start: Time = None, end: Time = None,
+                   targets: Optional[Iterable[str]] = None,
+                   tags: Iterable[str] = ('target', 'sensor'),
+                   sensor: Optional[str] = None) -> Iterator[Tuple[Dict, np.ndarray, np.ndarray]]:
+        """Stream the power consumption stored in a database.
+        Args:
+            database: the name of the database
+            start: beginning of the window (included)
+            end: end of the window (excluded)
+            targets: the targets (e.g. container names) to read, all if None
+            tags: the tags that split series
+            sensor: only read the reports of this sensor, e.g. sensor-<host>
+        Returns:
+            An iterator over (tags, timestamps in ns, power in watts) chunks.
+        """
+        query = (f'SELECT power FROM {POWER_MEASUREMENT}{_get_where(start, end, targets, sensor)}'
+                 f' GROUP BY {", ".join(tags)}')
+        for series in self.query(database, query):
+            if series.get('values'):
+                yield _to_arrays(series)
+
+    def read_power(self, start: Time = None, end: Time = None,
+                   targets: Optional[Iterable[str]] = None,
+                   databases: Optional[Iterable[str]] = None,
+                   ) -> Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]]:
+        """Read the power consumption of targets from all databases
+        concurrently. Sensors of a CPU model share a database and all
+        report the rapl and global targets, so series are split by sensor.
+        Args:
+            start: beginning of the window (included)
+            end: end of the window (excluded)
+            targets: the targets (e.g. container names) to read, all if None
+            databases: the databases to read, all if None
+        Returns:
+            A dictionary (sensor, target) -> (timestamps in ns, power in
+            watts) sorted by time.
+        """
+        targets = None if targets is None else list(targets)
+        databases = list(self.databases if databases is None else databases)
+        if targets == []:
+            return {}
+
+        def read(database):
+            key_to_chunks: Dict[Tuple[str, str], List[Tuple[np.ndarray, np.ndarray]]] = {}
+            for tags, timestamps, power in self.iter_power(database, start, end, targets):
+                key = (tags.get('sensor'), tags.get('target'))
+                key_to_chunks.setdefault(key, []).append((timestamps, power))
+            return key_to_chunks
+
+        key_to_chunks: Dict[Tuple[str, str], List[Tuple[np.ndarray, np.ndarray]]] = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for database, result in zip(databases, executor.map(read, databases)):
+                logging.debug(f'Read {sum(len(chunks) for chunks in result.values())} chunks from {database}')
+                for key, chunks in result.items():
+                    key_to_chunks.setdefault(key, []).extend(chunks)
+
+        key_to_power = {}
+        for key, chunks in key_to_chunks.items():
+            timestamps = np.concatenate([chunk[0] for chunk in chunks])
+            power = np.concatenate([chunk[1] for chunk in chunks])
+            order = np.argsort(timestamps, kind='stable')
+            key_to_power[key] = (timestamps[order], power[order])
+        return key_to_power
+
+    def read_energy(self, start: Time, end: Time, targets: Optional[Iterable[str]] = None,
+                    sensor: Optional[str] = None, max_gap: float = MAX_GAP,
+                    ) -> Dict[str, Dict[str, float]]:
+        """Compute the energy consumed by targets during a window, from
+        all databases concurrently.
+        Args:
+            start: beginning of the window (included)
+            end: end of the window (excluded)
+            targets: the targets (e.g. container names), all if None
+            sensor: only use the reports of this sensor, e.g. sensor-<host>
+            max_gap: number of seconds between two reports above which the
+                interval is not integrated (see integrate)
+        Returns:
+            A dictionary target -> socket -> energy in joules, the cpu and
+            dram scopes of a socket being summed, as well as the sensors
+            that report the target (e.g. rapl of all hosts of a CPU model).
+            The power at start and end is interpolated from the reports
+            around them.
+        """
+        targets = None if targets is None else list(targets)
+        if targets == []:
+            return {}
+        start = None if start is None else _to_ns(start)
+        end = None if end is None else _to_ns(end)
+        ## the reports around the window, within max_gap of its edges
+        query_start = None if start is None else start / 1e9 - max_gap
+        query_end = None if end is None else end / 1e9 + max_gap
+
+        def read(database):
+            return list(self.iter_power(database, query_start, query_end, targets,
+                                        tags=('target', 'sensor', 'socket', 'scope'),
+                                        sensor=sensor))
+
+        ## one group per series, i.e., (database, target, sensor, socket,
+        ## scope): the points of several sensors must not be interleaved
+        keys, group_ids, timestamps, power = [], [], [], []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for database, chunks in zip(self.databases, executor.map(read, self.databases)):
+                key_to_group = {}
+                for tags, chunk_timestamps, chunk_power in chunks:
+                    key = (tags.get('target'), tags.get('sensor'), tags.get('socket') or '',
+                           tags.get('scope') or '')
+                    if key not in key_to_group:
+                        key_to_group[key] = len(keys)
+                        keys.append(key)
+                    group_ids.append(np.full(len(chunk_timestamps), key_to_group[key], dtype=np.int64))
+                    timestamps.append(chunk_timestamps)
+                    power.append(chunk_power)
+        if not keys:
+            return {}
+
+        joules, _ = integrate(np.concatenate(group_ids), np.concatenate(timestamps),
+                              np.concatenate(power), len(keys), max_gap, start, end)
+
+        target_to_energy: Dict[str, Dict[str, float]] = {}
+        for (target, _sensor, socket, _scope), energy in zip(keys, joules.tolist()):
+            sockets = target_to_energy.setdefault(target, {})
+            sockets[socket] = sockets.get(socket, 0.) + energy
+        return target_to_energy
+
+
+
+def integrate(group_ids: np.ndarray, timestamps: np.ndarray, power: np.ndarray,
+              n_groups: int, max_gap: float = MAX_GAP, start: Optional[int] = None,
+              end: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Integrate power over time of many series at once, using the
+    trapezoidal rule, without any loop over points.
+
+    Args:
+        group_ids: the series of each point, in [0, n_groups)
+        timestamps: the time of each point in nanoseconds
+        power: the power of each point in watts
+        n_groups: the number of series
+        max_gap: number of seconds between two consecutive points above
+            which the interval is a sampling gap: its energy is unknown so
+            it is not integrated
+        start: the beginning of the window in nanoseconds, within an
+            interval the power being linear between its points; from the
+            first point if None
+        end: the end of the window in nanoseconds, up to the last point
+            if None
+    Returns:
+        A pair of arrays indexed by series: the energy in joules, and the
+        total duration of sampling gaps in seconds.
+    """
+    order = np.lexsort((timestamps, group_ids))
+    group_ids, timestamps, power = group_ids[order], timestamps[order], power[order]
+
+    groups = group_ids[1:]
+    same_group = groups == group_ids[:-1]
+    areas, durations, covered = _get_trapezoids(timestamps, power, max_gap)
+    if start is not None or end is not None:
+        ## only the part of intervals within the window
+        before, after = timestamps[:-1], timestamps[1:]
+        lower = before if start is None else np.maximum(before, start)
+        upper = after if end is None else np.minimum(after, end)
+        areas = _get_partial_areas(before, after, power[:-1], power[1:], lower, upper)
+        durations = np.maximum(upper - lower, 0) / 1e9
+    covered &= same_group
+    gaps = same_group & ~covered
+
+    joules = np.bincount(groups[covered], weights=areas[covered], minlength=n_groups)
+    missing = np.bincount(groups[gaps], weights=durations[gaps], minlength=n_groups)
+    return joules, missing
+
+def integrate_windows(timestamps: np.ndarray, power: np.ndarray, starts: np.ndarray,
+                      ends: np.ndarray, max_gap: float = MAX_GAP) -> np.ndarray:
+    """Integrate the power of a series over many windows at once, e.g.
+    the regions of an experiment, as integrate does: the power at the
+    edges of windows is interpolated, so windows shorter than the
+    sampling period get their share of the interval around them.
+
+    Args:
+        timestamps: the time of each point in nanoseconds, sorted
+        power: the power of each point in watts
+        starts: the beginning of each window in nanoseconds
+        ends: the end of each window in nanoseconds
+        max_gap: number of seconds between two consecutive points above
+            which the interval is not integrated
+    Returns:
+        The energy in joules of each window.
+    """
+    starts, ends = np.asarray(starts), np.asarray(ends)
+    if len(timestamps) < 2:
+        return np.zeros(len(starts))
+    areas, _, covered = _get_trapezoids(timestamps, power, max_gap)
+    ## energy between the first point and each point
+    cumulated = np.concatenate(([0.], np.cumsum(np.where(covered, areas, 0.))))
+    first = np.searchsorted(timestamps, starts, side='left') # first point after start
+    last = np.searchsorted(timestamps, ends, side='left') - 1 # last point before end
+    inside = last >= first
+    middle = np.where(last > first, cumulated[np.maximum(last, 0)]
+                      - cumulated[np.minimum(first, len(timestamps) - 1)], 0.)
+
+    def get_part(intervals, lower, upper):
+        """Get the energy of the parts [lower, upper] of intervals, given
+        by the index of their first point."""
+        valid = (intervals >= 0) & (intervals < len(timestamps) - 1)
+        intervals = np.clip(intervals, 0, len(timestamps) - 2)
+        areas = _get_partial_areas(timestamps[intervals], timestamps[intervals + 1],
+                                   power[intervals], power[intervals + 1], lower, upper)
+        return np.where(valid & covered[intervals], areas, 0.)
+
+    ## from start to the first point, or to end when no point is inside
+    left = get_part(first - 1, starts, np.where(
+        inside, timestamps[np.minimum(first, len(timestamps) - 1)], ends))
+    ## from the last point to end
+    right = np.where(inside, get_part(last, timestamps[np.maximum(last, 0)], ends), 0.)
+    return left + middle + right
+
+def _get_trapezoids(timestamps: np.ndarray, power: np.ndarray,
+                    max_gap: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Get the energy in joules and the duration in seconds of the
+    intervals between consecutive points, and whether they are integrated,
+    i.e., neither sampling gaps nor unknown power."""
+    durations = np.diff(timestamps) / 1e9
+    areas = (power[1:] + power[:-1]) / 2. * durations
+    return areas, durations, (durations <= max_gap) & ~np.isnan(areas)
+
+def _get_partial_areas(before: np.ndarray, after: np.ndarray, power_before: np.ndarray,
+                       power_after: np.ndarray, lower: np.ndarray, upper: np.ndarray) -> np.ndarray:
+    """Get the energy in joules of the parts [lower, upper] of intervals
+    [before, after], the power being linear between their points; 0 when
+    the part is empty."""
+    spans = after - before
+    slopes = np.where(spans > 0, (power_after - power_before) / np.where(spans > 0, spans, 1), 0.)
+    power_lower = power_before + slopes * (lower - before)
+    power_upper = power_before + slopes * (upper - before)
+    return np.where(upper > lower, (power_lower + power_upper) / 2. * (upper - lower) / 1e9, 0.)
+
+def _to_arrays(series: Dict) -> Tuple[Dict, np.ndarray, np.ndarray]:
+    """Convert a series of power reports, whose columns are time and
+    power, to (tags, timestamps in ns, power in watts)."""
+    values = series['values']
+    timestamps = np.fromiter((value[0] for value in values), dtype=np.int64,
+                             count=len(values))
+    power = np.array([value[1] for value in values], dtype=np.float64)
+    return series.get('tags', {}), timestamps, power
+
+def _to_ns(time: Time) -> int:
+    """Convert a datetime or a number of seconds since epoch to
+    nanoseconds since epoch."""
+    if isinstance(time, datetime):
+        time = time.timestamp()
+    return int(round(time * 1e9))
+
+def _quote(value: str) -> str:
+    return "'" + value.replace('\\', '\\\\').replace("'", "\\'") + "'"
+
+def _get_where(start: Time = None, end: Time = None,
+               targets: Optional[Iterable[str]] = None,
+               sensor: Optional[str] = None) -> str:
+    """Build the WHERE clause of a query on a time window, targets,
+    and sensor."""
+    conditions = []
+    if sensor is not None:
+        conditions.append(f'sensor = {_quote(sensor)}')
+    if start is not None:
+        conditions.append(f'time >= {_to_ns(start)}')
+    if end is not None:
+        conditions.append(f'time < {_to_ns(end)}')
+    if targets is not None:
+        conditions.append('(' + ' OR '.join(f'target = {_quote(target)}'
+                                            for target in targets) + ')')
+    return ' WHERE ' + ' AND '.join(conditions) if conditions else ''
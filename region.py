@@ -0,0 +1,225 @@
+import numpy as np # 1.19.5
+
+import atexit
+import collections
+import functools
+import queue
+import threading
+import time
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Deque, Dict, Iterable, List, Optional
+
+from reader import EnergyReader, MAX_GAP, integrate_windows
+from lineprotocol import escape_tag, quote_field
+
+import logging
+
+
+
+MEASUREMENT = 'energyservice_region'
+SETTLE = 2. # seconds after a region before its energy is read, i.e., written late
+WRITE_TIMEOUT = 10. # seconds of a write of markers
+WRITE_INTERVAL = 0.1 # seconds during which markers are batched before a write
+MAX_REGIONS = 1000 # closed regions kept by the recorder
+
+
+
+class Region:
+    """A phase of an experiment whose energy is measured: entering and
+    leaving it only read the clock and queue a marker, so it can wrap
+    tight loops. Markers are written in the background, and shown as
+    annotations in Grafana.
+
+        with energy.region('warmup', containers=['meow-world']) as warmup:
+            …
+        warmup.energy.result() # container -> socket -> joules
+
+    As a decorator, each call of the function is a new region, the
+    latest ones being kept in :py:attr:`RegionRecorder.regions`."""
+    def __init__(self, recorder: 'RegionRecorder', name: str,
+                 containers: Optional[List[str]], databases: List[str]):
+        self.recorder = recorder
+        self.name = name
+        self.containers = containers
+        self.databases = databases
+        self.start: Optional[int] = None # ns since epoch
+        self.end: Optional[int] = None
+        ## container -> socket -> energy in joules, once the region is closed
+        self.energy: Optional[Future] = None
+
+    @property
+    def duration(self) -> float:
+        """The duration of the region in seconds."""
+        return (self.end - self.start) / 1e9
+
+    def __enter__(self) -> 'Region':
+        assert self.start is None, f'Region {self.name} was already entered'
+        self.start = time.time_ns()
+        self.recorder._queue.put((self, 'start', self.start))
+        return self
+
+    def __exit__(self, *args):
+        self.end = time.time_ns()
+        self.energy = Future()
+        self.recorder._queue.put((self, 'end', self.end))
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapped(*args, **kwargs):
+            with self.recorder.region(self.name, self.containers, databases=self.databases):
+                return function(*args, **kwargs)
+        return wrapped
+
+
+
+class RegionRecorder:
+    """Write the markers of regions to the databases of the stack from a
+    background thread, the markers queued meanwhile being sent in one
+    write per database, and compute the energy of closed regions in
+    background too."""
+    def __init__(self, energy, *, settle: float = SETTLE, max_gap: float = MAX_GAP,
+                 max_workers: Optional[int] = None, max_regions: Optional[int] = MAX_REGIONS):
+        """Args:
+            energy: the deployed :py:class:`Energy` service
+            settle: number of seconds after the end of a region before its
+                energy is read, so the reports of its end are written
+            max_gap: number of seconds between two reports above which the
+                interval is not integrated (see reader.integrate)
+            max_workers: maximum number of batches of regions measured
+                concurrently
+            max_regions: number of closed regions kept in regions, the
+                oldest being dropped, all of them if None"""
+        self.energy = energy
+        self.reader = EnergyReader(energy)
+        self.settle = settle
+        self.max_gap = max_gap
+        self.regions: Deque[Region] = collections.deque(maxlen=max_regions) # closed, by end
+        ## markers, and events of flushes set once the markers before them are written
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='energy-region')
+        self._writer = threading.Thread(target=self._write, name='energy-region-writer',
+                                        daemon=True)
+        self._writer.start()
+        atexit.register(self.flush)
+
+    def region(self, name: str, containers: Optional[Iterable[str]] = None, *,
+               hosts: Optional[Iterable] = None,
+               databases: Optional[List[str]] = None) -> Region:
+        """Get a region to enter, see :py:meth:`Energy.region`."""
+        if databases is None:
+            if hosts is None:
+                databases = list(self.reader.databases)
+            else:
+                shards = self.energy.plan.hostname_to_shard
+                databases = sorted({shards[host.alias]['database'] for host in hosts})
+        return Region(self, name, None if containers is None else list(containers), databases)
+
+    def _measure(self, regions: List[Region]):
+        """Compute the energy of closed regions, once their reports are
+        written, and set it as the result of their futures. Each database
+        is read once for all the regions, so regions of tight loops do not
+        cost a query each."""
+        time.sleep(max(0., max(region.end for region in regions) / 1e9 + self.settle - time.time()))
+        regions = [region for region in regions if region.energy.set_running_or_notify_cancel()]
+        try:
+            region_to_energy = {id(region): {} for region in regions}
+            database_to_regions: Dict[str, List[Region]] = {}
+            for region in regions:
+                for database in region.databases:
+                    database_to_regions.setdefault(database, []).append(region)
+            for database, database_regions in database_to_regions.items():
+                self._integrate(database, database_regions, region_to_energy)
+            for region in regions:
+                region.energy.set_result(region_to_energy[id(region)])
+        except Exception as error:
+            for region in regions:
+                region.energy.set_exception(error)
+
+    def _integrate(self, database: str, regions: List[Region],
+                   region_to_energy: Dict[int, Dict[str, Dict[str, float]]]):
+        """Add the energy of the series of a database to regions, the cpu
+        and dram scopes of a socket, and the sensors, being summed, as in
+        read_energy."""
+        targets = None
+        if all(region.containers is not None for region in regions):
+            targets = sorted({container for region in regions for container in region.containers})
+            if not targets:
+                return
+        key_to_chunks: Dict[tuple, List[tuple]] = {}
+        ## the reports around regions too, to interpolate their edges
+        for tags, timestamps, power in self.reader.iter_power(
+                database, min(region.start for region in regions) / 1e9 - self.max_gap,
+                max(region.end for region in regions) / 1e9 + self.max_gap, targets,
+                tags=('target', 'sensor', 'socket', 'scope')):
+            ## the points of several sensors must not be interleaved
+            key = (tags.get('target'), tags.get('sensor'), tags.get('socket') or '',
+                   tags.get('scope') or '')
+            key_to_chunks.setdefault(key, []).append((timestamps, power))
+
+        starts = np.array([region.start for region in regions], dtype=np.int64)
+        ends = np.array([region.end for region in regions], dtype=np.int64)
+        for (target, _sensor, socket, _scope), chunks in key_to_chunks.items():
+            timestamps = np.concatenate([chunk[0] for chunk in chunks])
+            power = np.concatenate([chunk[1] for chunk in chunks])
+            order = np.argsort(timestamps, kind='stable')
+            joules = integrate_windows(timestamps[order], power[order], starts, ends,
+                                       self.max_gap)
+            for region, energy in zip(regions, joules.tolist()):
+                if region.containers is not None and target not in region.containers:
+                    continue
+                sockets = region_to_energy[id(region)].setdefault(target, {})
+                sockets[socket] = sockets.get(socket, 0.) + energy
+
+    def _get_line(self, region: Region, marker: str, timestamp: int) -> str:
+        return (f'{MEASUREMENT},region={escape_tag(region.name)},marker={marker} '
+                f'text={quote_field(f"{region.name} {marker}")},'
+                f'containers={quote_field(",".join(region.containers or []))} {timestamp}')
+
+    def _write(self):
+        while True:
+            items = [self._queue.get()]
+            ## markers are written together, unless they are flushed
+            if not isinstance(items[0], threading.Event):
+                time.sleep(WRITE_INTERVAL)
+            while True:
+                try:
+                    items.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            flushes = [item for item in items if isinstance(item, threading.Event)]
+            markers = [item for item in items if not isinstance(item, threading.Event)]
+            database_to_lines: Dict[str, List[str]] = {}
+            closed = []
+            for region, marker, timestamp in markers:
+                line = self._get_line(region, marker, timestamp)
+                for database in region.databases:
+                    database_to_lines.setdefault(database, []).append(line)
+                if marker == 'end':
+                    closed.append(region)
+            for database, lines in database_to_lines.items():
+                try:
+                    self._post(database, lines)
+                except Exception as error:
+                    logging.warning(f'Could not write {len(lines)} markers of regions '
+                                    f'to {database}: {error!r}')
+            if closed:
+                self.regions.extend(closed)
+                self._executor.submit(self._measure, closed)
+            for flush in flushes:
+                flush.set()
+
+    def _post(self, database: str, lines: List[str]):
+        request = urllib.request.Request(
+            f'{self.reader.databases[database]}/write?db={database}&precision=ns',
+            data='\n'.join(lines).encode(), method='POST')
+        with urllib.request.urlopen(request, timeout=WRITE_TIMEOUT):
+            pass
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until the queued markers are written.
+        Returns: False if they are still not written after timeout seconds."""
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        return flushed.wait(timeout)
@@ -0,0 +1,80 @@
+import re
+from typing import Iterable, List
+
+from reader import POWER_MEASUREMENT
+
+
+
+ROLLUPS = ('10s', '1m', '10m') # resolutions of downsampled power reports
+ROLLUP_POLICY = 'rollup' # retention policy of downsampled power reports
+RAW_POLICY = 'autogen' # default retention policy, written by formulas
+INFINITE = 'INF'
+RESAMPLE_INTERVALS = 3 # intervals computed again, as formulas write reports late
+
+_UNIT_TO_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+
+def get_measurement(rollup: str) -> str:
+    """Get the measurement of power reports downsampled at a resolution,
+    e.g. power_consumption_10s."""
+    return f'{POWER_MEASUREMENT}_{rollup}'
+
+def get_statements(database: str, retention: str = INFINITE,
+                   rollups: Iterable[str] = ROLLUPS,
+                   rollup_retention: str = INFINITE) -> List[str]:
+    """Build the InfluxQL statements that set the retention of power
+    reports in a database, and continuously downsample them. Each rollup
+    keeps the mean power of each series (target, sensor, socket, scope).
+    Each run computes the last RESAMPLE_INTERVALS intervals again, so
+    the reports that formulas write a few intervals late are included.
+    Statements can run at each deployment, one at a time: those that
+    create what already exists fail without side effects.
+
+    Args:
+        database: the name of the database, e.g. power_<cpu_shortname>
+        retention: the duration of raw power reports, e.g. 7d, INF for ever
+        rollups: the resolutions of downsampled power reports
+        rollup_retention: the duration of downsampled power reports
+    Returns:
+        The list of statements.
+    """
+    statements = [f'CREATE DATABASE "{database}"',
+                  f'ALTER RETENTION POLICY "{RAW_POLICY}" ON "{database}" '
+                  f'DURATION {retention} {_get_shard_duration(retention)} DEFAULT']
+    rollups = list(rollups)
+    if not rollups:
+        return statements
+
+    policy = f'DURATION {rollup_retention} REPLICATION 1 {_get_shard_duration(rollup_retention)}'
+    statements.extend([f'CREATE RETENTION POLICY "{ROLLUP_POLICY}" ON "{database}" {policy}',
+                       f'ALTER RETENTION POLICY "{ROLLUP_POLICY}" ON "{database}" {policy}'])
+    for rollup in rollups:
+        name = f'cq_{get_measurement(rollup)}'
+        ## continuous queries cannot be altered, they are recreated
+        statements.extend([
+            f'DROP CONTINUOUS QUERY "{name}" ON "{database}"',
+            f'CREATE CONTINUOUS QUERY "{name}" ON "{database}" '
+            f'RESAMPLE EVERY {rollup} FOR {_get_seconds(rollup) * RESAMPLE_INTERVALS}s BEGIN '
+            f'SELECT mean(power) AS power '
+            f'INTO "{database}"."{ROLLUP_POLICY}"."{get_measurement(rollup)}" '
+            f'FROM "{database}"."{RAW_POLICY}"."{POWER_MEASUREMENT}" '
+            f'GROUP BY time({rollup}), * END'])
+    return statements
+
+def _get_seconds(duration: str) -> int:
+    """Get the number of seconds of an InfluxDB duration, e.g. 1h30m."""
+    return sum(int(value) * _UNIT_TO_SECONDS[unit]
+               for value, unit in re.findall(r'(\d+)([smhdw])', duration))
+
+def _get_shard_duration(retention: str) -> str:
+    """Get the shard duration that InfluxDB would choose for a retention,
+    since altering the retention does not update it."""
+    if retention.upper() == INFINITE:
+        return 'SHARD DURATION 7d'
+    seconds = _get_seconds(retention)
+    if seconds < 2 * 86400:
+        return 'SHARD DURATION 1h'
+    if seconds <= 180 * 86400:
+        return 'SHARD DURATION 1d'
+    return 'SHARD DURATION 7d'
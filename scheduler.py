@@ -0,0 +1,110 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional
+
+from timing import DeploymentTiming
+
+
+
+class Stage:
+    """A step of a deployment that runs once all the stages it
+    requires succeeded."""
+    def __init__(self, name: str, run: Callable[[], None], *,
+                 requires: Iterable[str] = (), timeout: Optional[float] = None,
+                 hosts: Iterable[str] = ()):
+        """Args:
+            name: the unique name of the stage
+            run: the function performing the stage, e.g. a play_on
+            requires: the names of the stages that must succeed before
+            timeout: number of seconds after which the stage is considered
+                as failed (it cannot be interrupted though)
+            hosts: the inventory hostnames the stage acts on, for timing"""
+        self.name = name
+        self.run = run
+        self.requires = set(requires)
+        self.timeout = timeout
+        self.hosts = list(hosts)
+
+
+
+class StageError(Exception):
+    """Raised when a stage fails, its dependents are not run."""
+    def __init__(self, name: str, error: BaseException):
+        super().__init__(f'Stage {name} failed: {error!r}')
+        self.name = name
+        self.error = error
+
+
+
+def run_stages(stages: List[Stage], max_workers: Optional[int] = None,
+               timing: Optional[DeploymentTiming] = None):
+    """Run stages as soon as the stages they require succeeded, with as
+    much concurrency as the dependency graph allows. End-to-end time is
+    the critical path of the graph instead of the sum of stages.
+
+    Args:
+        stages: the stages to run
+        max_workers: the maximum number of concurrent stages (1 runs
+            stages sequentially, in an order that respects dependencies)
+        timing: records the duration of each stage that runs
+    Raises:
+        StageError: of the first stage that failed or timed out, once
+            the other running stages are over
+    """
+    name_to_stage: Dict[str, Stage] = {stage.name: stage for stage in stages}
+    for stage in stages:
+        unknown = stage.requires - name_to_stage.keys()
+        assert not unknown, f'Stage {stage.name} requires unknown stages {unknown}'
+
+    pending = dict(name_to_stage)
+    done = set()
+    running = {} # future -> (stage, start)
+    error: Optional[StageError] = None
+    timed_out = False
+
+    executor = ThreadPoolExecutor(max_workers=max_workers,
+                                  thread_name_prefix='energy-stage')
+    try:
+        while True:
+            if error is None:
+                for name, stage in list(pending.items()):
+                    if stage.requires <= done:
+                        logging.debug(f'Starting stage {name}…')
+                        run = (stage.run if timing is None else
+                               timing.timed(name, stage.run, hosts=stage.hosts))
+                        running[executor.submit(run)] = (stage, time.monotonic())
+                        del pending[name]
+            if not running:
+                break
+
+            deadlines = [start + stage.timeout - time.monotonic()
+                         for stage, start in running.values() if stage.timeout is not None]
+            finished, _ = wait(running, return_when=FIRST_COMPLETED,
+                               timeout=max(0, min(deadlines)) if deadlines else None)
+
+            for future in finished:
+                stage, start = running.pop(future)
+                exception = future.exception()
+                if exception is None:
+                    logging.debug(f'Stage {stage.name} done in {time.monotonic() - start:.1f}s')
+                    done.add(stage.name)
+                elif error is None:
+                    error = StageError(stage.name, exception)
+
+            for future, (stage, start) in list(running.items()):
+                if stage.timeout is not None and time.monotonic() - start > stage.timeout:
+                    del running[future]
+                    timed_out = True
+                    if error is None:
+                        error = StageError(stage.name, TimeoutError(
+                            f'still running after {stage.timeout}s'))
+    finally:
+        ## timed out stages cannot be interrupted, do not wait for them
+        executor.shutdown(wait=not timed_out)
+
+    if error is not None:
+        if pending:
+            logging.error(f'Stages not run because {error.name} failed: {sorted(pending)}')
+        raise error
+    assert not pending, f'Stages with circular requirements: {sorted(pending)}'
@@ -0,0 +1,168 @@
+from enoslib.api import run_command
+
+import json
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+import logging
+
+
+
+SENSOR_CONTAINER = 'powerapi-sensor'
+MAX_LOG_LINES = 1000 # lines read per host and update
+CONFIGURABLE_GROUPS = ('rapl', 'core') # groups whose events depend on the cpu
+
+# When an event does not exists, eg. gpu
+# "event 'RAPL_ENERGY_GPU' is invalid or unsupported by this machine"
+INVALID_EVENT = re.compile(r"event '([^']+)' is invalid or unsupported")
+# When dram && cores && gpu are false
+# "E: 21-01-13 14:43:09 perf<all>: cannot read perf values for group=rapl pkg=0 cpu=21
+#  E: 21-01-13 14:43:09 perf<all>: failed to populate payload for timestamp=1610548989669"
+UNREADABLE_GROUP = re.compile(r'cannot read perf values for group=(\w+)')
+FAILED_PAYLOAD = re.compile(r'failed to populate payload')
+## docker logs --timestamps prefixes lines with a fixed-width RFC3339 date,
+## so dates compare as strings
+TIMESTAMP = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d\.\d+Z$')
+
+
+
+class SensorLogAnalyzer:
+    """Read the logs of sensors incrementally, and remove the events that
+    sensors report as invalid from the events of all the hosts with the
+    same CPU model. Only the sensors whose events change are recreated.
+
+        analyzer = SensorLogAnalyzer(energy)
+        analyzer.update() # after each phase, or periodically
+    """
+    def __init__(self, energy, *, max_lines: int = MAX_LOG_LINES):
+        """Args:
+            energy: the deployed :py:class:`Energy` service
+            max_lines: the maximum number of lines read per host and update,
+                the oldest unread ones first"""
+        self.energy = energy
+        self.max_lines = max_lines
+        ## date of the last line read by host, the next read starts there
+        self.hostname_to_cursor: Dict[str, str] = {}
+        self.cpuname_to_invalid: Dict[str, Set[str]] = {}
+        ## hostname -> group -> number of reports that could not be built
+        self.hostname_to_failures: Dict[str, Dict[str, int]] = {}
+
+    def use_event_db(self, path: str = './event_db.json'):
+        """Start from the events known to work on each CPU model, see
+        calibrate.py."""
+        with Path(path).open('r') as f:
+            event_db = json.load(f)
+        for hostname, cpu in self.energy.hostname_to_cpu.items():
+            entry = event_db.get(cpu.cpu_name)
+            if entry is None:
+                continue
+            if not entry.get('verified', True) and cpu.cpu_name not in self.cpuname_to_invalid:
+                logging.warning(f'The events of {cpu.cpu_name} are unverified (see '
+                                f'calibrate.py), its sensors may report invalid events.')
+            self.cpuname_to_invalid.setdefault(cpu.cpu_name, set()).update(entry.get('invalid', []))
+            self.energy.hostname_to_events[hostname] = {
+                group: list(entry[group]) for group in CONFIGURABLE_GROUPS if group in entry}
+
+    def tail(self, hostnames: Optional[Iterable[str]] = None) -> Dict[str, List[str]]:
+        """Read the lines that sensors logged since the previous read, all
+        hosts at once. At most max_lines lines are read per host, the oldest
+        ones: the next read continues from the first line left unread.
+        Args:
+            hostnames: the sensored hosts to read, all if None
+        Returns:
+            A dictionary inventory hostname -> new lines.
+        """
+        hostnames = list(self.energy.hostname_to_cpu if hostnames is None else hostnames)
+        if not hostnames:
+            return {}
+        result = run_command(
+            "docker logs --timestamps "
+            "--since {{ansible_hostname_to_cursor.get(inventory_hostname, '0')}} "
+            f"{SENSOR_CONTAINER} 2>&1 | head -n {self.max_lines} || true",
+            pattern_hosts=':'.join(hostnames), roles=self.energy._roles,
+            extra_vars={'ansible_hostname_to_cursor': self.hostname_to_cursor},
+            on_error_continue=True)
+
+        hostname_to_lines = {}
+        for hostname, output in result['ok'].items():
+            cursor = self.hostname_to_cursor.get(hostname, '')
+            lines = []
+            for line in (output['stdout'] or '').splitlines():
+                timestamp, _, message = line.partition(' ')
+                ## --since is inclusive; other lines are errors of docker
+                if not TIMESTAMP.match(timestamp) or timestamp <= cursor:
+                    continue
+                lines.append(message)
+                cursor = timestamp
+            if cursor:
+                self.hostname_to_cursor[hostname] = cursor
+            hostname_to_lines[hostname] = lines
+        return hostname_to_lines
+
+    def analyze(self, hostname_to_lines: Dict[str, List[str]]) -> Set[str]:
+        """Match the known failures of sensors in their logs.
+        Args:
+            hostname_to_lines: the lines logged by each sensor (see tail)
+        Returns:
+            The CPU models that got new invalid events.
+        """
+        changed = set()
+        for hostname, lines in hostname_to_lines.items():
+            cpu_name = self.energy.hostname_to_cpu[hostname].cpu_name
+            invalid = self.cpuname_to_invalid.setdefault(cpu_name, set())
+            failures = {}
+            unreadable = None
+            for line in lines:
+                match = INVALID_EVENT.search(line)
+                if match and match.group(1) not in invalid:
+                    logging.info(f'{match.group(1)} is not supported by {cpu_name} ({hostname})')
+                    invalid.add(match.group(1))
+                    changed.add(cpu_name)
+                match = UNREADABLE_GROUP.search(line)
+                if match:
+                    unreadable = match.group(1)
+                if FAILED_PAYLOAD.search(line):
+                    group = unreadable or 'unknown'
+                    failures[group] = failures.get(group, 0) + 1
+            if failures:
+                logging.warning(f'The sensor of {hostname} failed to build reports: {failures}')
+            total = self.hostname_to_failures.setdefault(hostname, {})
+            for group, count in failures.items():
+                total[group] = total.get(group, 0) + count
+        return changed
+
+    def configure(self) -> List[str]:
+        """Remove the invalid events of their CPU model from the events of
+        each sensored host (see :py:attr:`Energy.hostname_to_events`).
+        Returns:
+            The hosts whose events changed.
+        """
+        changed = []
+        for hostname, cpu in self.energy.hostname_to_cpu.items():
+            invalid = self.cpuname_to_invalid.get(cpu.cpu_name, set())
+            events = self.energy._get_events(hostname)
+            host_events = {group: [event for event in events.get(group, []) if event not in invalid]
+                           for group in CONFIGURABLE_GROUPS}
+            if any(host_events[group] != events.get(group, []) for group in CONFIGURABLE_GROUPS):
+                self.energy.hostname_to_events[hostname] = host_events
+                changed.append(hostname)
+        return changed
+
+    def update(self, redeploy: bool = True) -> List[str]:
+        """Read the new logs of sensors, and recreate the sensors whose
+        events changed.
+        Args:
+            redeploy: recreate the sensors, otherwise only their events change
+        Returns:
+            The hosts whose events changed.
+        """
+        self.analyze(self.tail())
+        hostnames = self.configure()
+        if hostnames and redeploy:
+            logging.info(f'Redeploying the sensors of {hostnames}…')
+            self.energy.redeploy_sensors(hostnames)
+            ## recreated containers start a new log
+            for hostname in hostnames:
+                self.hostname_to_cursor.pop(hostname, None)
+        return hostnames
@@ -0,0 +1,67 @@
+from typing import Dict, List
+
+
+
+BSON_REPORT_BYTES = 160 # _id, timestamp, sensor, target, and nesting of a report
+BSON_EVENT_BYTES = 32 # key and int64 value of an event in a report
+INFLUX_POINT_BYTES = 32 # compressed point with its share of index and WAL
+CONTAINERS_PER_HOST = 10 # reports are per target: all, and each container
+SAFETY_FACTOR = 1.5 # padding of volumes above the estimated volume
+
+
+
+def get_ticks(frequency_ms: float, duration: float) -> float:
+    """Number of reports of a sensor during an experiment.
+    Args:
+        frequency_ms: the sampling period of sensors in milliseconds
+        duration: the duration of the experiment in seconds"""
+    return duration * 1000. / frequency_ms
+
+def estimate_mongo_bytes(cpu, events: Dict[str, List[str]], frequency_ms: float,
+                         duration: float, containers: int = CONTAINERS_PER_HOST) -> int:
+    """Estimate the volume of HWPC reports of one sensor in MongoDB.
+    System groups (rapl, msr) are only reported for the whole machine,
+    while the core group is reported for every monitored container.
+
+    Args:
+        cpu: the :py:class:`CPU` of the sensored host
+        events: group of events (rapl, msr, core) -> names of events
+        frequency_ms: the sampling period of the sensor in milliseconds
+        duration: the duration of the experiment in seconds
+        containers: the expected number of containers on the host
+    Returns:
+        The estimated number of bytes.
+    """
+    cpus, sockets = getattr(cpu, 'cpu_count', 1), getattr(cpu, 'sockets', 1)
+    system_events = (sockets * len(events.get('rapl', [])) +
+                     cpus * len(events.get('msr', [])))
+    core_events = cpus * len(events.get('core', []))
+    tick = ((1 + containers) * (BSON_REPORT_BYTES + BSON_EVENT_BYTES * core_events) +
+            BSON_EVENT_BYTES * system_events)
+    return int(tick * get_ticks(frequency_ms, duration))
+
+def estimate_influx_bytes(cpu, scopes: int, frequency_ms: float, duration: float,
+                          containers: int = CONTAINERS_PER_HOST) -> int:
+    """Estimate the volume of power reports of one sensored host in
+    InfluxDB: one point per target (all, rapl, and each container),
+    socket, and scope (cpu, dram).
+
+    Args:
+        cpu: the :py:class:`CPU` of the sensored host
+        scopes: the number of formulas enabled (cpu, dram)
+        frequency_ms: the sampling period of the sensor in milliseconds
+        duration: the duration of the experiment in seconds
+        containers: the expected number of containers on the host
+    Returns:
+        The estimated number of bytes.
+    """
+    points = (2 + containers) * getattr(cpu, 'sockets', 1) * scopes
+    return int(INFLUX_POINT_BYTES * points * get_ticks(frequency_ms, duration))
+
+def to_human(size: float) -> str:
+    """Format a number of bytes, e.g. 1.5GiB."""
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return f'{size:.1f}{unit}'
+        size /= 1024
+    return f'{size:.1f}TiB'
@@ -0,0 +1,133 @@
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from cpu import CPU
+from topology import TopologyPlan
+
+
+
+STATE_PATH = './_tmp_enos_/energyservice.json'
+STATE_VERSION = 1
+
+
+
+class Node:
+    """A host of a saved deployment: enough to plan the topology, and to
+    reach the services of the host, without enoslib."""
+    def __init__(self, alias: str, address: str):
+        self.alias = alias
+        self.address = address
+
+    def __repr__(self):
+        return f'Node({self.alias!r}, {self.address!r})'
+
+
+
+class DeploymentState:
+    """What a deployment of :py:class:`Energy` is made of, saved in a
+    JSON file after each deployment (see :py:meth:`Energy.save`) so that
+    tools can inspect it and read its results without importing enoslib
+    nor contacting the hosts (see cli.py)."""
+    def __init__(self, *, roles: Dict[str, List[Node]], hostname_to_cpu: Dict[str, CPU],
+                 hostname_to_mongo: Dict[str, str], hostname_to_influxdb: Dict[str, str],
+                 hostname_to_formulas: Dict[str, List[Dict]],
+                 hostname_to_sensor_name: Dict[str, str], endpoints: List[Dict],
+                 strategy: str, frequency_ms: float, created: Optional[float] = None):
+        """Args:
+            roles: the hosts of each role (sensors, mongos, formulas,
+                influxdbs, grafana)
+            hostname_to_cpu: the :py:class:`CPU` of each sensored host
+            hostname_to_mongo: the address of the MongoDB of each sensored host
+            hostname_to_influxdb: the address of the InfluxDB of each sensored host
+            hostname_to_formulas: the formulas run by each host, as name,
+                container, collection, mongo, influxdb, and database
+            hostname_to_sensor_name: the name of the sensor of each sensored
+                host, as tagged in reports
+            endpoints: the services to probe, as role, alias, address, port
+            strategy: how sensored hosts share collectors (see topology.py)
+            frequency_ms: the sampling period of sensors in milliseconds
+            created: the time of the deployment in seconds since epoch"""
+        self.roles = roles
+        self.hostname_to_cpu = hostname_to_cpu
+        self.hostname_to_mongo = hostname_to_mongo
+        self.hostname_to_influxdb = hostname_to_influxdb
+        self.hostname_to_formulas = hostname_to_formulas
+        self.hostname_to_sensor_name = hostname_to_sensor_name
+        self.endpoints = endpoints
+        self.strategy = strategy
+        self.frequency_ms = frequency_ms
+        self.created = time.time() if created is None else created
+
+    def get_plan(self, strategy: Optional[str] = None,
+                 frequency_ms: Optional[float] = None) -> TopologyPlan:
+        """Plan the topology of the deployment again, possibly with
+        another strategy or sampling period."""
+        strategy = strategy or self.strategy
+        sensors = self.roles['sensors']
+        return TopologyPlan(self.hostname_to_cpu,
+                            mongos=sensors if strategy == 'edge' else self.roles['mongos'],
+                            formulas=sensors if strategy == 'edge' else self.roles['formulas'],
+                            influxdbs=self.roles['influxdbs'],
+                            frequency_ms=frequency_ms or self.frequency_ms, strategy=strategy)
+
+    def to_dict(self) -> Dict:
+        ## identical cpus are saved once
+        cpus, key_to_index, hostname_to_cpu = [], {}, {}
+        for hostname, cpu in self.hostname_to_cpu.items():
+            fields = cpu.to_dict()
+            key = json.dumps(fields, sort_keys=True)
+            if key not in key_to_index:
+                key_to_index[key] = len(cpus)
+                cpus.append(fields)
+            hostname_to_cpu[hostname] = key_to_index[key]
+        return {'version': STATE_VERSION, 'created': self.created,
+                'strategy': self.strategy, 'frequency_ms': self.frequency_ms,
+                'roles': {role: [[node.alias, node.address] for node in nodes]
+                          for role, nodes in self.roles.items()},
+                'cpus': cpus, 'hostname_to_cpu': hostname_to_cpu,
+                'hostname_to_mongo': self.hostname_to_mongo,
+                'hostname_to_influxdb': self.hostname_to_influxdb,
+                'hostname_to_formulas': self.hostname_to_formulas,
+                'hostname_to_sensor_name': self.hostname_to_sensor_name,
+                'endpoints': self.endpoints}
+
+    @classmethod
+    def from_dict(cls, state: Dict) -> 'DeploymentState':
+        if state.get('version') != STATE_VERSION:
+            raise ValueError(f'Unsupported state version {state.get("version")}, '
+                             f'expected {STATE_VERSION}')
+        cpus = [CPU.from_fields(fields) for fields in state['cpus']]
+        return cls(roles={role: [Node(alias, address) for alias, address in nodes]
+                          for role, nodes in state['roles'].items()},
+                   hostname_to_cpu={hostname: cpus[index]
+                                    for hostname, index in state['hostname_to_cpu'].items()},
+                   hostname_to_mongo=state['hostname_to_mongo'],
+                   hostname_to_influxdb=state['hostname_to_influxdb'],
+                   hostname_to_formulas=state['hostname_to_formulas'],
+                   hostname_to_sensor_name=state['hostname_to_sensor_name'],
+                   endpoints=state['endpoints'], strategy=state['strategy'],
+                   frequency_ms=state['frequency_ms'], created=state['created'])
+
+    def save(self, path: str = STATE_PATH):
+        """Atomically write the state, so readers never see a partial file.
+        Deployments of threads of a process may save concurrently, so each
+        save writes its own temporary file."""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.to_dict(), f, indent=1)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path: str = STATE_PATH) -> 'DeploymentState':
+        with Path(path).open('r') as f:
+            return cls.from_dict(json.load(f))
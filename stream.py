@@ -0,0 +1,141 @@
+import numpy as np # 1.19.5
+
+import asyncio
+import time
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Tuple
+
+from reader import EnergyReader, Time, POWER_MEASUREMENT, _to_arrays, _to_ns, _quote
+
+import logging
+
+
+
+POLL_INTERVAL = 0.5 # seconds between two polls of a database
+DELAY = 0.5 # seconds of reports left for the next poll, i.e., written late
+MAX_BATCHES = 64 # batches queued before pollers wait for the consumer
+
+## (sensor, target) -> (timestamps in ns, power in watts)
+Batch = Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]]
+
+
+
+class PowerStream:
+    """Follow the power reports of SmartWatts as they are written. Each
+    database is polled by its own task, which only asks for the reports
+    after the latest one it got (its high-water mark), so a poll costs
+    the new reports only, whatever the duration of the experiment.
+
+    Reports are written late by formulas, so each poll stops delay
+    seconds before now: a report older than that when it is written is
+    missed. Larger delays miss fewer reports, but they are yielded later.
+
+    Sensors of a CPU model share a database and all report the rapl and
+    global targets, so series are split by sensor, as in read_power.
+
+        async for batch in PowerStream(EnergyReader(energy)):
+            for (sensor, target), (timestamps, power) in batch.items(): …
+    """
+    def __init__(self, reader: EnergyReader, *,
+                 targets: Optional[Iterable[str]] = None,
+                 databases: Optional[Iterable[str]] = None,
+                 start: Time = None, interval: float = POLL_INTERVAL,
+                 delay: float = DELAY, max_batches: int = MAX_BATCHES):
+        """Args:
+            reader: the reader of the databases
+            targets: the targets (e.g. container names) to follow, all if None
+            databases: the databases to poll, all if None
+            start: the reports before start are skipped, now if None
+            interval: number of seconds between two polls of a database
+            delay: number of seconds before now at which each poll stops
+            max_batches: number of batches queued before polls wait"""
+        self.reader = reader
+        self.targets = None if targets is None else list(targets)
+        self.databases = list(reader.databases if databases is None else databases)
+        start = time.time() if start is None else start
+        ## database -> time of the latest report yielded in ns
+        self.database_to_mark: Dict[str, int] = {database: _to_ns(start) - 1
+                                                 for database in self.databases}
+        self._where_targets = '' if not self.targets else (
+            ' AND (' + ' OR '.join(f'target = {_quote(target)}' for target in self.targets) + ')')
+        self.interval = interval
+        self.delay = delay
+        self.max_batches = max_batches
+        self.polls = 0
+        self.points = 0
+
+    def _poll(self, database: str) -> Batch:
+        """Read the new reports of a database, and move its high-water mark."""
+        mark = self.database_to_mark[database]
+        ## marks are exact integers, seconds as floats would round them
+        query = (f'SELECT power FROM {POWER_MEASUREMENT} WHERE time > {mark}'
+                 f' AND time <= {_to_ns(time.time() - self.delay)}{self._where_targets}'
+                 ' GROUP BY target, sensor')
+        batch: Dict[Tuple[str, str], List[Tuple[np.ndarray, np.ndarray]]] = {}
+        for series in self.reader.query(database, query):
+            if not series.get('values'):
+                continue
+            tags, timestamps, power = _to_arrays(series)
+            batch.setdefault((tags.get('sensor'), tags.get('target')), []).append((timestamps, power))
+            mark = max(mark, int(timestamps.max()))
+        self.database_to_mark[database] = mark
+        return {key: (np.concatenate([chunk[0] for chunk in chunks]),
+                      np.concatenate([chunk[1] for chunk in chunks]))
+                for key, chunks in batch.items()}
+
+    async def _follow(self, database: str, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            try:
+                batch = await loop.run_in_executor(None, self._poll, database)
+            except Exception as error:
+                ## the database may restart, e.g., recovered by the monitor
+                logging.debug(f'Could not poll {database}: {error!r}')
+                batch = {}
+            self.polls += 1
+            if batch:
+                await queue.put(batch)
+            await asyncio.sleep(max(0., self.interval - (loop.time() - started)))
+
+    def __aiter__(self) -> AsyncIterator[Batch]:
+        return self.batches()
+
+    async def batches(self) -> AsyncIterator[Batch]:
+        """Yield the new reports of all databases, as a dictionary
+        (sensor, target) -> (timestamps in ns, power in watts). Batches that are queued
+        while the consumer is busy are merged into one."""
+        if self.targets == [] or not self.databases:
+            return
+        queue: asyncio.Queue = asyncio.Queue(self.max_batches)
+        tasks = [asyncio.create_task(self._follow(database, queue))
+                 for database in self.databases]
+        try:
+            while True:
+                batches = [await queue.get()]
+                while not queue.empty():
+                    batches.append(queue.get_nowait())
+                batch = _merge(batches)
+                self.points += sum(len(timestamps) for timestamps, _ in batch.values())
+                yield batch
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+
+def _merge(batches: List[Batch]) -> Batch:
+    """Merge batches into one, sorted by time per sensor and target."""
+    if len(batches) == 1:
+        return batches[0]
+    key_to_chunks: Dict[Tuple[str, str], List[Tuple[np.ndarray, np.ndarray]]] = {}
+    for batch in batches:
+        for key, chunk in batch.items():
+            key_to_chunks.setdefault(key, []).append(chunk)
+    merged = {}
+    for key, chunks in key_to_chunks.items():
+        timestamps = np.concatenate([chunk[0] for chunk in chunks])
+        power = np.concatenate([chunk[1] for chunk in chunks])
+        order = np.argsort(timestamps, kind='stable')
+        merged[key] = (timestamps[order], power[order])
+    return merged
@@ -0,0 +1,47 @@
+import pytest
+
+## the deployment is recorded (see benchmark.py), but enoslib must import
+try:
+    import enoslib
+except Exception as error: ## e.g. a dependency of enoslib missing or too old
+    pytest.skip(f'enoslib cannot be imported: {error!r}', allow_module_level=True)
+
+from benchmark import Recorder, get_lscpu, get_roles
+from cache import CPUCache
+from energy import Energy
+
+
+
+def get_service(roles, directory, **kwargs) -> Energy:
+    return Energy(sensors=roles['sensors'], mongos=roles['mongos'],
+                  formulas=roles['formulas'], influxdbs=roles['influxdbs'],
+                  grafana=roles['grafana'][0], cpu_cache=CPUCache(directory / 'cpus'),
+                  grafana_cache=str(directory / 'grafana'), **kwargs)
+
+
+
+def test_load_redeploy(tmp_path):
+    roles = get_roles(6, 2)
+    hostname_to_lscpu = {host.alias: get_lscpu(index % 2)
+                         for index, host in enumerate(roles['sensors'])}
+    recorder = Recorder(roles, hostname_to_lscpu, speedup=0)
+    with recorder.patch():
+        deployed = get_service(roles, tmp_path, state_path=str(tmp_path / 'state.json'))
+        deployed.deploy()
+
+        ## another process restores the deployment, and recreates containers
+        loaded = get_service(roles, tmp_path, state_path=None)
+        loaded.load(str(tmp_path / 'state.json'))
+        assert loaded._containers == deployed._containers
+        plays = len(recorder.plays)
+        loaded.redeploy_sensors(['node-0.bench'])
+        assert loaded._extra_vars['ansible_to_deploy'] == {'node-0.bench': ['powerapi-sensor']}
+        assert len(recorder.plays) == plays + 1
+
+        ## the sensors and formulas of a recreated MongoDB restart as well
+        mongo = deployed.plan.hostname_to_shard['node-0.bench']['mongo'].alias
+        loaded.redeploy({mongo: ['mongodb']})
+        to_deploy = loaded._extra_vars['ansible_to_deploy']
+        assert 'powerapi-sensor' in to_deploy['node-0.bench']
+        assert any(name.startswith('smartwatts') for names in to_deploy.values()
+                   for name in names)
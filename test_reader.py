@@ -0,0 +1,163 @@
+import numpy as np # 1.19.5
+import pytest
+
+import json
+import threading
+import urllib.parse
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+from reader import EnergyReader, integrate, integrate_windows
+
+
+
+class FakeEnergy:
+    hostname_to_formulas = {'node-0': [{'database': 'power_cpu', 'influxdb': 'localhost'}]}
+
+class FakeReader(EnergyReader):
+    """Answer queries with series, as InfluxDB splits them by the
+    tags of GROUP BY."""
+    def __init__(self, series):
+        super().__init__(FakeEnergy())
+        self.series = series
+
+    def query(self, database, query):
+        tags = query.split(' GROUP BY ')[1].split(', ')
+        key_to_series = {}
+        for series in self.series:
+            key = tuple(series['tags'].get(tag) for tag in tags)
+            grouped = key_to_series.setdefault(key, {
+                'name': 'power_consumption', 'columns': ['time', 'power'], 'values': [],
+                'tags': {tag: series['tags'].get(tag) for tag in tags}})
+            grouped['values'].extend(series['values'])
+        return iter(key_to_series.values())
+
+@contextmanager
+def serve_influxdb(chunks):
+    """Serve the chunks of json of any query as InfluxDB does when
+    chunked is true: a line per chunk, with chunked transfer encoding."""
+    queries = []
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        def log_message(self, *args):
+            pass
+        def do_GET(self):
+            queries.append(urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in chunks:
+                line = (json.dumps(chunk) + '\n').encode()
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+            self.wfile.write(b'0\r\n\r\n')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    reader = EnergyReader(SimpleNamespace(hostname_to_formulas={}), chunk_size=2)
+    reader.databases = {'power_cpu': f'http://127.0.0.1:{server.server_address[1]}'}
+    try:
+        yield reader, queries
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def get_chunk(sensor, values):
+    return {'results': [{'statement_id': 0, 'partial': True, 'series': [{
+        'name': 'power_consumption', 'tags': {'sensor': sensor, 'target': 'rapl'},
+        'columns': ['time', 'power'], 'values': values}]}]}
+
+def get_series(sensor, target, watts, seconds):
+    """A report per second of a sensor, shifted by 1ms from the other
+    sensors as sensors are not synchronized."""
+    shift = 10**6 * int(sensor[-1], 16)
+    return {'tags': {'sensor': sensor, 'target': target, 'socket': '0', 'scope': 'cpu'},
+            'values': [[second * 10**9 + shift, watts] for second in range(seconds + 1)]}
+
+
+
+def test_query_chunked():
+    chunks = [get_chunk('sensor-a', [[0, 10.], [10**9, 10.]]),
+              get_chunk('sensor-a', [[2 * 10**9, 10.]]),
+              get_chunk('sensor-b', [[0, 20.]])]
+    with serve_influxdb(chunks) as (reader, queries):
+        series = list(reader.query('power_cpu', 'SELECT power FROM power_consumption'))
+        key_to_power = reader.read_power()
+    assert [len(partial['values']) for partial in series] == [2, 1, 1]
+    assert queries[0]['db'] == ['power_cpu'] and queries[0]['chunked'] == ['true']
+    assert queries[0]['chunk_size'] == ['2'] and queries[0]['epoch'] == ['ns']
+    ## the partial series of a sensor are concatenated
+    timestamps, power = key_to_power['sensor-a', 'rapl']
+    assert timestamps.tolist() == [0, 10**9, 2 * 10**9] and power.tolist() == [10.] * 3
+
+def test_query_error():
+    chunks = [get_chunk('sensor-a', [[0, 10.]]),
+              {'results': [{'statement_id': 0, 'error': 'database not found: power_cpu'}]}]
+    with serve_influxdb(chunks) as (reader, _):
+        with pytest.raises(RuntimeError, match='database not found'):
+            list(reader.query('power_cpu', 'SELECT power FROM power_consumption'))
+
+def test_integrate():
+    group_ids = np.array([0, 0, 0, 1, 1, 1])
+    timestamps = np.array([0, 1, 2, 0, 1, 10], dtype=np.int64) * 10**9
+    power = np.array([10., 20., 30., 5., 5., 5.])
+    joules, missing = integrate(group_ids, timestamps, power, 2, max_gap=5.)
+    assert joules.tolist() == [15. + 25., 5.]
+    assert missing.tolist() == [0., 9.]
+
+def test_integrate_nan():
+    joules, missing = integrate(np.zeros(3, dtype=np.int64),
+                                np.array([0, 1, 2], dtype=np.int64) * 10**9,
+                                np.array([10., np.nan, 10.]), 1)
+    assert joules.tolist() == [0.]
+    assert missing.tolist() == [2.]
+
+def test_integrate_windows():
+    timestamps = np.array([0, 1, 2, 3, 10, 11], dtype=np.int64) * 10**9
+    power = np.array([10., 10., 20., 20., 20., 20.])
+    starts = np.array([0, 1, 0, 3], dtype=np.int64) * 10**9
+    ends = np.array([4, 3, 1, 12], dtype=np.int64) * 10**9
+    joules = integrate_windows(timestamps, power, starts, ends, max_gap=5.)
+    ## windows are integrated up to their edges, gaps are not integrated
+    assert joules.tolist() == [10. + 15. + 20., 15. + 20., 10., 20.]
+
+def test_integrate_windows_edges():
+    ## 100 W sampled every second: windows between samples are not truncated
+    timestamps = np.arange(21, dtype=np.int64) * 10**9
+    power = np.full(21, 100.)
+    starts = np.array([0.5, 2.2, -5, 19], dtype=float) * 10**9
+    ends = np.array([9.5, 2.7, 3, 25], dtype=float) * 10**9
+    joules = integrate_windows(timestamps, power, starts.astype(np.int64),
+                               ends.astype(np.int64), max_gap=5.)
+    assert np.allclose(joules, [900., 50., 300., 100.])
+
+def test_read_energy_sensors():
+    ## every sensor reports rapl: their points must not be interleaved
+    reader = FakeReader([get_series('sensor-a', 'rapl', 10., 3),
+                         get_series('sensor-b', 'rapl', 20., 3)])
+    energy = reader.read_energy(0, 10)
+    assert np.isclose(energy['rapl']['0'], 90.)
+
+def test_read_energy_edges():
+    ## 100 W sampled every second: windows between samples are not truncated
+    series = get_series('sensor-0', 'meow', 100., 20)
+    reader = FakeReader([series])
+    assert np.isclose(reader.read_energy(0.5, 9.5)['meow']['0'], 900.)
+    assert np.isclose(reader.read_energy(2.2, 2.7)['meow']['0'], 50.)
+    assert np.isclose(reader.read_energy(-5, 3)['meow']['0'], 300.)
+
+def test_integrate_edges():
+    ## 10 W more every second: the power is interpolated at the edges
+    timestamps = np.arange(5, dtype=np.int64) * 10**9
+    power = 10. * np.arange(5)
+    joules, missing = integrate(np.zeros(5, dtype=np.int64), timestamps, power, 1,
+                                start=int(0.5e9), end=int(1.5e9))
+    assert np.isclose(joules[0], 10.) and missing[0] == 0.
+
+def test_read_power_sensors():
+    reader = FakeReader([get_series('sensor-a', 'rapl', 10., 3),
+                         get_series('sensor-b', 'rapl', 20., 3)])
+    key_to_power = reader.read_power(0, 10)
+    assert sorted(key_to_power) == [('sensor-a', 'rapl'), ('sensor-b', 'rapl')]
+    timestamps, power = key_to_power['sensor-b', 'rapl']
+    assert len(timestamps) == 4 and (power == 20.).all()
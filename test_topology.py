@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+
+from topology import TopologyPlan
+
+
+
+CPUS = [SimpleNamespace(cpu_name=f'Model {index}', cpu_shortname=f'model{index}')
+        for index in range(3)]
+COLLECTORS = [SimpleNamespace(alias=f'control-{index}') for index in range(3)]
+
+def get_plan(hostnames, **kwargs) -> TopologyPlan:
+    """Plan fake hosts node-<index>, a quarter of them with the first
+    CPU model, and the others split among the other models."""
+    hostname_to_cpu = {}
+    for hostname in hostnames:
+        index = int(hostname.split('.')[0].split('-')[1])
+        hostname_to_cpu[hostname] = CPUS[0 if index % 4 == 0 else 1 + index % 2]
+    return TopologyPlan(hostname_to_cpu, mongos=COLLECTORS, formulas=COLLECTORS,
+                        influxdbs=COLLECTORS[:1], **kwargs)
+
+def get_assignment(plan: TopologyPlan):
+    """Get the shard, collection, and collectors of each sensored host."""
+    return {hostname: (shard['name'], shard['collection'],
+                       shard['mongo'].alias, shard['formula'].alias)
+            for hostname, shard in plan.hostname_to_shard.items()}
+
+
+
+def test_plan():
+    hostnames = [f'node-{index}.bench' for index in range(40)]
+    plan = get_plan(hostnames)
+    assert sorted(plan.hostname_to_shard) == sorted(hostnames)
+    assert sum(len(shard['hostnames']) for shard in plan.shards) == len(hostnames)
+    ## heavy models are split across collections
+    assert len(plan.shards) > len(CPUS)
+    assert all(shard['hostnames'] for shard in plan.shards)
+
+def test_plan_stable():
+    hostnames = [f'node-{index}.bench' for index in range(40)]
+    before = get_assignment(get_plan(hostnames))
+    for removed in hostnames:
+        after = get_assignment(get_plan([hostname for hostname in hostnames
+                                         if hostname != removed]))
+        moved = [hostname for hostname in after if after[hostname] != before[hostname]]
+        assert not moved, f'removing {removed} moved {moved}'
+
+def test_plan_edge():
+    hostnames = [f'node-{index}.bench' for index in range(4)]
+    hosts = [SimpleNamespace(alias=hostname) for hostname in hostnames]
+    plan = TopologyPlan({hostname: CPUS[0] for hostname in hostnames}, mongos=hosts,
+                        formulas=hosts, influxdbs=COLLECTORS[:1], strategy='edge')
+    assert {hostname: shard['mongo'].alias
+            for hostname, shard in plan.hostname_to_shard.items()} == dict(zip(hostnames, hostnames))
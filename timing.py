@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from lineprotocol import escape_tag
+
+
+
+MEASUREMENT = 'energyservice_deploy'
+
+
+
+class Phase:
+    """A timed part of a deployment: a stage, or a step of a stage."""
+    def __init__(self, name: str, start: float, end: float, *,
+                 stage: Optional[str] = None, hosts: Iterable[str] = (),
+                 error: Optional[str] = None):
+        """Args:
+            name: the name of the phase, e.g. mongos or cpus.probe
+            start: the beginning of the phase in seconds since epoch
+            end: the end of the phase in seconds since epoch
+            stage: the stage that contains the phase, None if it is a stage
+            hosts: the inventory hostnames the phase acts on
+            error: the error that ended the phase, None if it succeeded"""
+        self.name = name
+        self.start = start
+        self.end = end
+        self.stage = stage
+        self.hosts = list(hosts)
+        self.error = error
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+    def to_dict(self) -> Dict:
+        return {'name': self.name, 'stage': self.stage, 'start': self.start,
+                'end': self.end, 'duration': self.duration, 'hosts': self.hosts,
+                'error': self.error}
+
+
+
+class DeploymentTiming:
+    """Record how long each phase of a deployment lasts, to find where
+    its time goes and track it across runs. Phases may be recorded from
+    concurrent stages."""
+    def __init__(self):
+        self.phases: List[Phase] = []
+        self._lock = threading.Lock()
+
+    def record(self, phase: Phase):
+        with self._lock:
+            self.phases.append(phase)
+
+    @contextmanager
+    def phase(self, name: str, *, stage: Optional[str] = None, hosts: Iterable[str] = ()):
+        """Time the body of a with statement, e.g.
+        `with timing.phase('cpus.probe', stage='cpus', hosts=stale): …`"""
+        start = time.time()
+        try:
+            yield
+        except BaseException as error:
+            self.record(Phase(name, start, time.time(), stage=stage, hosts=hosts,
+                              error=repr(error)))
+            raise
+        self.record(Phase(name, start, time.time(), stage=stage, hosts=hosts))
+
+    def timed(self, name: str, run: Callable[[], None], *, hosts: Iterable[str] = ()) -> Callable[[], None]:
+        """Wrap the function of a stage so that each run is recorded."""
+        def timed_run():
+            with self.phase(name, hosts=hosts):
+                run()
+        return timed_run
+
+    @property
+    def stages(self) -> List[Phase]:
+        return [phase for phase in self.phases if phase.stage is None]
+
+    @property
+    def duration(self) -> float:
+        """The end-to-end duration of the recorded stages in seconds."""
+        stages = self.stages
+        if not stages:
+            return 0.
+        return max(phase.end for phase in stages) - min(phase.start for phase in stages)
+
+    def per_host(self) -> Dict[str, Dict[str, float]]:
+        """Get the duration of the stages each host took part in. Plays
+        run on all their hosts at once, so this is the time a host spent
+        in a stage, not the time the stage spent on that host.
+        Returns: a dictionary inventory hostname -> stage -> seconds."""
+        hostname_to_stages = {}
+        for phase in self.stages:
+            for hostname in phase.hosts:
+                hostname_to_stages.setdefault(hostname, {})[phase.name] = phase.duration
+        return hostname_to_stages
+
+    def summary(self) -> str:
+        """Describe the duration of each phase, ordered by start."""
+        lines = [f'Deployment in {self.duration:.1f}s']
+        for phase in sorted(self.phases, key=lambda phase: phase.start):
+            indent = '    ' if phase.stage is None else '        '
+            status = '' if phase.error is None else f' (failed: {phase.error})'
+            lines.append(f'{indent}{phase.name}: {phase.duration:.1f}s'
+                         f' on {len(phase.hosts)} hosts{status}')
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+    def to_dict(self) -> Dict:
+        return {'duration': self.duration,
+                'phases': [phase.to_dict() for phase in self.phases],
+                'per_host': self.per_host()}
+
+    def to_json(self, path: Optional[str] = None) -> str:
+        """Export the timing as JSON, and write it in path if any."""
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            Path(path).write_text(text)
+        return text
+
+    def to_line_protocol(self, path: Optional[str] = None,
+                         tags: Dict[str, str] = {}) -> str:
+        """Export the timing as InfluxDB line protocol, one point per
+        phase at its beginning, and write it in path if any.
+        Args:
+            path: the output file, e.g. to be written with `influx -import`
+            tags: tags of all points, e.g. {'run': 'baseline'}
+        """
+        lines = []
+        for phase in self.phases:
+            point_tags = dict(tags, phase=phase.name, stage=phase.stage or phase.name,
+                              status='ok' if phase.error is None else 'failed')
+            tag_set = ','.join(f'{escape_tag(key)}={escape_tag(value)}'
+                               for key, value in sorted(point_tags.items()))
+            lines.append(f'{MEASUREMENT},{tag_set} duration={phase.duration},'
+                         f'hosts={len(phase.hosts)}i {int(phase.start * 1e9)}')
+        text = '\n'.join(lines) + '\n'
+        if path is not None:
+            Path(path).write_text(text)
+        return text
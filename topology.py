@@ -0,0 +1,311 @@
+import hashlib
+import math
+import re
+from array import array
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+
+DEFAULT_FREQUENCY_MS = 1000 # default sampling period of hwpc-sensor
+## centralized: collectors are shared by all sensored hosts
+## edge: each sensored host runs its own MongoDB and formula
+## cluster: the sensored hosts of a cluster share the same collectors
+STRATEGIES = ('centralized', 'edge', 'cluster')
+BALANCE_SLACK = 0.25 # load above the average that a collector accepts
+
+
+
+def get_cluster(hostname: str) -> str:
+    """Get the cluster of a host from its name, e.g. econome for
+    econome-3.nantes.grid5000.fr"""
+    return hostname.split('.')[0].rsplit('-', 1)[0]
+
+def _to_name(text: str) -> str:
+    return re.sub('[^a-zA-Z0-9_-]', '', text)
+
+def _hash(*names: str) -> int:
+    """Hash names the same way in every process, unlike hash()."""
+    return int(hashlib.sha1('/'.join(names).encode()).hexdigest(), 16)
+
+def _get_slot(hostname: str, count: int) -> int:
+    """Get the shard of a host among count, from its name only, so
+    adding or removing other hosts does not move it."""
+    return _hash(hostname) % count
+
+
+
+class TopologyPlan:
+    """Assign the collectors of sensored hosts (mongos, formulas,
+    influxdbs) according to the load they generate, i.e., number of
+    sensors times sampling frequency. It only needs objects that have
+    an `alias`, so it can be built and inspected without any
+    deployment."""
+    def __init__(self, hostname_to_cpu: Dict, *, mongos: List, formulas: List,
+                 influxdbs: List, frequency_ms: float = DEFAULT_FREQUENCY_MS,
+                 hostname_to_frequency_ms: Dict[str, float] = {},
+                 split: bool = True, strategy: str = 'centralized'):
+        """Args:
+            hostname_to_cpu: the :py:class:`CPU` of each sensored host
+            mongos: hosts of MongoDBs that store the reports of sensors
+            formulas: hosts of SmartWatts formulas
+            influxdbs: hosts of InfluxDBs that store the output of formulas
+            frequency_ms: the sampling period of sensors in milliseconds
+            hostname_to_frequency_ms: sampling period of specific sensors
+            split: split the sensors of a CPU model across multiple
+                collections and formulas when its load exceeds the fair
+                share of a MongoDB or a formula host (centralized only)
+            strategy: how sensored hosts share collectors (see STRATEGIES),
+                with edge, mongos and formulas must be the sensored hosts
+        """
+        assert mongos and formulas and influxdbs
+        assert strategy in STRATEGIES, f'strategy must be one of {STRATEGIES}'
+        self.strategy = strategy
+        self.hostname_to_cpu = hostname_to_cpu
+        self.mongos = list(mongos)
+        self.formulas = list(formulas)
+        self.influxdbs = list(influxdbs)
+        self.hostname_to_weight = {
+            hostname: 1000. / hostname_to_frequency_ms.get(hostname, frequency_ms)
+            for hostname in hostname_to_cpu}
+
+        self.cpuname_to_cpu = {}
+        self.cpuname_to_hostnames = {}
+        for hostname, cpu in hostname_to_cpu.items():
+            self.cpuname_to_cpu.setdefault(cpu.cpu_name, cpu)
+            self.cpuname_to_hostnames.setdefault(cpu.cpu_name, []).append(hostname)
+
+        self.shards = self._get_shards(split and strategy == 'centralized')
+        self._assign()
+
+    def _get_weight(self, hostnames: Iterable[str]) -> float:
+        return sum(self.hostname_to_weight[hostname] for hostname in hostnames)
+
+    def _get_groups(self) -> Dict[str, List[str]]:
+        """Group sensored hosts that share collectors, depending on the
+        strategy.
+        Returns: a dictionary group -> hostnames."""
+        if self.strategy == 'edge':
+            return {_to_name(hostname.split('.')[0]): [hostname]
+                    for hostname in self.hostname_to_cpu}
+        if self.strategy == 'cluster':
+            groups = {}
+            for hostname in self.hostname_to_cpu:
+                groups.setdefault(_to_name(get_cluster(hostname)), []).append(hostname)
+            return groups
+        return {'': list(self.hostname_to_cpu)}
+
+    def _get_shards(self, split: bool) -> List[Dict]:
+        """Group sensored hosts in shards, each with its own collection
+        and formula. There is one shard per CPU model and group of hosts
+        sharing collectors, unless the model is too heavy for a single
+        collector. Hosts go to shards by the hash of their name, so that
+        removing a host leaves the shards of other hosts untouched (and
+        their formulas and sensors are kept by reconcile)."""
+        fair_share = (self._get_weight(self.hostname_to_cpu) /
+                      max(len(self.mongos), len(self.formulas)))
+        shards = []
+        for group, group_hostnames in self._get_groups().items():
+            for cpu_name, hostnames in self.cpuname_to_hostnames.items():
+                hostnames = [hostname for hostname in hostnames if hostname in group_hostnames]
+                if not hostnames:
+                    continue
+                cpu = self.cpuname_to_cpu[cpu_name]
+                count = 1
+                if split and fair_share > 0:
+                    count = max(1, min(len(hostnames), math.ceil(
+                        round(self._get_weight(hostnames) / fair_share, 6))))
+                parts = [[] for _ in range(count)]
+                for hostname in hostnames:
+                    parts[_get_slot(hostname, count)].append(hostname)
+                for index, part in enumerate(parts):
+                    if not part:
+                        continue
+                    suffix = ''.join([f'_{group}' if group else '',
+                                      '' if count == 1 else f'_{index}'])
+                    shards.append({
+                        'cpu': cpu,
+                        'group': group,
+                        'name': f'smartwatts_{cpu.cpu_shortname}{suffix}',
+                        'collection': f'col_{cpu.cpu_shortname}{suffix}',
+                        'database': f'power_{cpu.cpu_shortname}',
+                        'hostnames': part,
+                        'weight': self._get_weight(part),
+                    })
+        return shards
+
+    @staticmethod
+    def _balance(keys: List[str], weights: List[float], bins: List) -> List:
+        """Assign weighted items, heaviest first, to bins. Each item goes
+        to the bin it prefers (the highest hash of their names), unless
+        this bin is loaded above the average load plus some slack: then it
+        goes to its next preferred bin. Preferences do not depend on the
+        other items, so small changes of the topology move few items.
+        Args:
+            keys: the name of each item, e.g. the name of a shard
+            weights: the weight of each item
+            bins: the hosts to assign items to
+        Returns: the bin of each item."""
+        capacity = sum(weights) / len(bins) * (1 + BALANCE_SLACK)
+        loads = [0.] * len(bins)
+        assignment = [None] * len(weights)
+        for item in sorted(range(len(weights)), key=lambda item: -weights[item]):
+            preferences = sorted(range(len(bins)), reverse=True,
+                                 key=lambda index: _hash(keys[item], bins[index].alias))
+            ## a bin is at most loaded on average, so one always fits
+            index = next((index for index in preferences if loads[index] < capacity),
+                         min(range(len(bins)), key=loads.__getitem__))
+            assignment[item] = bins[index]
+            loads[index] += weights[item]
+        return assignment
+
+    def _assign(self):
+        if self.strategy == 'edge':
+            ## the collectors of a host are the host itself
+            alias_to_mongo = {host.alias: host for host in self.mongos}
+            alias_to_formula = {host.alias: host for host in self.formulas}
+            for shard in self.shards:
+                hostname, = shard['hostnames']
+                shard['mongo'] = alias_to_mongo[hostname]
+                shard['formula'] = alias_to_formula[hostname]
+        elif self.strategy == 'cluster':
+            ## all shards of a cluster go to the same collectors
+            groups = list(dict.fromkeys(shard['group'] for shard in self.shards))
+            weights = [sum(shard['weight'] for shard in self.shards if shard['group'] == group)
+                       for group in groups]
+            group_to_mongo = dict(zip(groups, self._balance(groups, weights, self.mongos)))
+            group_to_formula = dict(zip(groups, self._balance(groups, weights, self.formulas)))
+            for shard in self.shards:
+                shard['mongo'] = group_to_mongo[shard['group']]
+                shard['formula'] = group_to_formula[shard['group']]
+        else:
+            names = [shard['name'] for shard in self.shards]
+            weights = [shard['weight'] for shard in self.shards]
+            for shard, mongo, formula in zip(self.shards,
+                                             self._balance(names, weights, self.mongos),
+                                             self._balance(names, weights, self.formulas)):
+                shard['mongo'] = mongo
+                shard['formula'] = formula
+
+        ## all shards of a CPU model write in the same database
+        cpunames = list(self.cpuname_to_hostnames.keys())
+        self.cpuname_to_influxdb = dict(zip(cpunames, self._balance(
+            cpunames, [self._get_weight(self.cpuname_to_hostnames[cpu_name]) for cpu_name in cpunames],
+            self.influxdbs)))
+
+        self.hostname_to_shard = {}
+        self.hostname_to_formulas = {}
+        for shard in self.shards:
+            shard['influxdb'] = self.cpuname_to_influxdb[shard['cpu'].cpu_name]
+            for hostname in shard['hostnames']:
+                self.hostname_to_shard[hostname] = shard
+            self.hostname_to_formulas.setdefault(shard['formula'].alias, []).append(shard)
+
+    def get_containers(self) -> Dict[str, List[str]]:
+        """Get the containers hosted by each machine of the plan.
+        Returns: dictionary host alias -> list of container descriptions."""
+        containers = {}
+        def add(host, container):
+            containers.setdefault(host.alias, []).append(container)
+
+        loads = {}
+        for shard in self.shards:
+            loads[shard['mongo'].alias] = loads.get(shard['mongo'].alias, 0) + shard['weight']
+        for host in self.mongos:
+            add(host, f'mongodb (load {loads.get(host.alias, 0):g} reports/s)')
+        for host in self.influxdbs:
+            databases = sorted({shard['database'] for shard in self.shards
+                                if shard['influxdb'] is host})
+            add(host, f'influxdb ({", ".join(databases) or "unused"})')
+        for shard in self.shards:
+            add(shard['formula'], f'{shard["name"]} ({shard["mongo"].alias}/{shard["collection"]}'
+                f' -> {shard["influxdb"].alias}/{shard["database"]})')
+        for hostname, shard in self.hostname_to_shard.items():
+            containers.setdefault(hostname, []).append(
+                f'powerapi-sensor (-> {shard["mongo"].alias}/{shard["collection"]})')
+        return containers
+
+    def summary(self) -> str:
+        """Describe which machines host which containers."""
+        lines = [f'{len(self.hostname_to_cpu)} sensors, {len(self.cpuname_to_cpu)} CPU models, '
+                 f'{len(self.shards)} formulas ({self.strategy})']
+        for alias, containers in self.get_containers().items():
+            lines.append(f'{alias}:')
+            lines.extend(f'    {container}' for container in containers)
+        return '\n'.join(lines)
+
+    def __str__(self):
+        return self.summary()
+
+
+
+class TopologyIndex:
+    """Compact view of a plan for the consumers of its databases, e.g.
+    sensors and applications that read their own energy. Hosts map to
+    small integer ids, and ids to the index of the view they share with
+    the other hosts of their shard: mongo_uri, influx_url, database, and
+    collection. Its Ansible variables grow by one integer per host,
+    instead of one copy of these fields (and of the CPU) per host.
+
+        with play_on(pattern_hosts='compute', roles=roles,
+                     extra_vars=energy.index.get_extra_vars()) as p:
+            p.docker_container(…, env={'INFLUX': energy.index.template('influx_url')})
+    """
+    FIELDS = ('mongo_uri', 'influx_url', 'database', 'collection')
+
+    def __init__(self, plan: TopologyPlan, *, mongo_port: int, influx_port: int,
+                 get_address: Callable = lambda host: host.address):
+        """Args:
+            plan: the plan of the deployment
+            mongo_port: the port of MongoDBs
+            influx_port: the port of InfluxDBs
+            get_address: the address of a host of the plan, as reached by
+                sensored hosts"""
+        self.hostnames: List[str] = list(plan.hostname_to_shard) # id -> hostname
+        self.hostname_to_id = {hostname: index for index, hostname in enumerate(self.hostnames)}
+        self.views: List[Dict[str, str]] = []
+        self.cpus = [] # view -> CPU
+        view_ids = {}
+        self.host_views = array('I') # id -> view
+        for hostname in self.hostnames:
+            shard = plan.hostname_to_shard[hostname]
+            if id(shard) not in view_ids:
+                view_ids[id(shard)] = len(self.views)
+                self.views.append({
+                    'mongo_uri': f'mongodb://{get_address(shard["mongo"])}:{mongo_port}',
+                    'influx_url': f'http://{get_address(shard["influxdb"])}:{influx_port}',
+                    'database': shard['database'], 'collection': shard['collection']})
+                self.cpus.append(shard['cpu'])
+            self.host_views.append(view_ids[id(shard)])
+
+    def __len__(self):
+        return len(self.hostnames)
+
+    def view(self, hostname: str) -> Dict[str, str]:
+        """Get the minimal view of a sensored host: mongo_uri, influx_url,
+        database, and collection."""
+        return self.views[self.host_views[self.hostname_to_id[hostname]]]
+
+    def cpu(self, hostname: str):
+        """Get the (interned) CPU of a sensored host."""
+        return self.cpus[self.host_views[self.hostname_to_id[hostname]]]
+
+    def get_extra_vars(self, hostnames: Optional[Iterable[str]] = None) -> Dict:
+        """Get the Ansible variables that template expects, for some
+        sensored hosts or all of them. Views are shared by hosts, so each
+        host only adds the index of its view."""
+        hostnames = self.hostnames if hostnames is None else hostnames
+        return {'ansible_energy_views': self.views,
+                'ansible_energy_hosts': {hostname: self.host_views[self.hostname_to_id[hostname]]
+                                         for hostname in hostnames}}
+
+    @staticmethod
+    def template(field: str) -> str:
+        """Get the Jinja expression of a field of the view of the current
+        host, e.g. template('influx_url'), see get_extra_vars."""
+        assert field in TopologyIndex.FIELDS, f'field must be one of {TopologyIndex.FIELDS}'
+        return f"{{{{ansible_energy_views[ansible_energy_hosts[inventory_hostname]]['{field}']}}}}"
+
+    def to_dict(self) -> Dict:
+        """Get the index as plain lists, e.g. to serve it to applications."""
+        return {'hosts': self.hostnames, 'views': self.views,
+                'host_views': self.host_views.tolist()}